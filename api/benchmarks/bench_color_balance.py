@@ -0,0 +1,43 @@
+"""
+Compares the histogram/LUT simplest_cb against the original sort-based implementation.
+
+Run from the api folder:
+    python -m benchmarks.bench_color_balance --megapixels 50 100 200
+"""
+import argparse
+import time
+import numpy as np
+
+from corr.color_balance import simplest_cb, simplest_cb_sorted
+from benchmarks.synthetic import make_synthetic_scan
+
+
+def time_call(function, *args) -> tuple:
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[50, 100, 200])
+    parser.add_argument("--percent", type=float, default=1)
+    parser.add_argument("--sixteen-bit", action="store_true", help="Benchmark 16-bit images instead of 8-bit ones")
+    args = parser.parse_args()
+
+    dtype = np.uint16 if args.sixteen_bit else np.uint8
+    print(f"{'MP':>8} {'sorted (s)':>12} {'histogram (s)':>14} {'speedup':>9} {'identical':>10}")
+    for megapixels in args.megapixels:
+        img = make_synthetic_scan(megapixels, dtype)
+
+        sorted_seconds, sorted_out = time_call(simplest_cb_sorted, img, args.percent)
+        histogram_seconds, histogram_out = time_call(simplest_cb, img, args.percent)
+        identical = np.array_equal(sorted_out, histogram_out)
+        del sorted_out, histogram_out
+
+        print(f"{megapixels:>8g} {sorted_seconds:>12.2f} {histogram_seconds:>14.2f} "
+              f"{sorted_seconds / histogram_seconds:>8.1f}x {str(identical):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""
+Benchmarks correcting synthetic media: each correction delegate on its own, simplest_cb, and a CompleteCorrector
+run over a project mixing every media type. Reports per-file latency, files per second, peak RSS and CPU
+utilization, and writes them as JSON so runs on different commits can be compared.
+
+Each benchmark runs in a fresh process. Its peak RSS and CPU time include every process it starts (workers,
+ffmpeg), sampled through psutil every --sample-ms, so processes living less than that can be missed.
+The audio and VHS benchmarks need ffmpeg on the PATH.
+
+Run from the api folder:
+    python -m benchmarks.bench_correction --output before.json
+    python -m benchmarks.bench_correction --output after.json --compare before.json
+    python -m benchmarks.bench_correction --only correct_audio --audio-minutes 180
+"""
+import argparse
+import concurrent.futures
+from dataclasses import dataclass, field
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+import cv2
+import numpy as np
+import psutil
+
+from benchmarks.synthetic import (
+    make_synthetic_print,
+    make_synthetic_scan,
+    make_synthetic_slide,
+    write_synthetic_mp4,
+    write_synthetic_wav,
+)
+
+BENCHMARK_NAMES = ["correct_slide", "correct_print", "correct_audio", "correct_vhs", "simplest_cb", "CompleteCorrector"]
+# Named so CompleteCorrector dispatches them the same way as a real project's files
+RAW_FILE_NAMES = {
+    "correct_slide" : "BenchJ_slides_1_{}.jpg",
+    "correct_print" : "BenchJ_prints_1_{}.jpg",
+    "correct_audio" : "BenchJ_audio_{}.wav",
+    "correct_vhs" : "BenchJ_vhs_{}.mp4",
+}
+
+
+@dataclass
+class ResourceSampler:
+    """Samples the RSS and CPU time of this process and all its descendants on a background thread."""
+    interval_seconds : float = 0.05
+    peak_rss_bytes : int = 0
+    # The latest user + system time seen for each process, including ones that have exited since
+    cpu_seconds_by_pid : Dict[int, float] = field(default_factory=dict)
+    # CPU time already used before sampling started, e.g. importing libraries, which isn't counted
+    starting_cpu_seconds : float = 0
+    stop_event : threading.Event = field(default_factory=threading.Event)
+    thread : threading.Thread = None
+
+    def sample(self):
+        root = psutil.Process()
+        total_rss = 0
+        for process in [root] + root.children(recursive=True):
+            try:
+                with process.oneshot():
+                    total_rss += process.memory_info().rss
+                    cpu_times = process.cpu_times()
+                self.cpu_seconds_by_pid[process.pid] = cpu_times.user + cpu_times.system
+            except psutil.Error:
+                pass
+        self.peak_rss_bytes = max(self.peak_rss_bytes, total_rss)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval_seconds):
+            self.sample()
+
+    def __enter__(self) -> "ResourceSampler":
+        self.sample()
+        self.starting_cpu_seconds = sum(self.cpu_seconds_by_pid.values())
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+
+    def get_cpu_seconds(self) -> float:
+        return sum(self.cpu_seconds_by_pid.values()) - self.starting_cpu_seconds
+
+
+@dataclass
+class BenchmarkResult:
+    name : str
+    files : int
+    total_seconds : float
+    # Seconds each file took, in the order they ran
+    file_seconds : List[float]
+    peak_rss_bytes : int
+    cpu_seconds : float
+    parameters : Dict[str, any] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict[str, any]:
+        num_cores = os.cpu_count() or 1
+        latencies = np.array(self.file_seconds) if self.file_seconds else np.zeros(1)
+        return {
+            "name" : self.name,
+            "files" : self.files,
+            "total_seconds" : round(self.total_seconds, 3),
+            "files_per_second" : round(self.files / self.total_seconds, 3) if self.total_seconds > 0 else 0,
+            "latency_seconds" : {
+                "mean" : round(float(latencies.mean()), 3),
+                "p50" : round(float(np.percentile(latencies, 50)), 3),
+                "p95" : round(float(np.percentile(latencies, 95)), 3),
+                "max" : round(float(latencies.max()), 3),
+            },
+            "peak_rss_mb" : round(self.peak_rss_bytes / (1024 * 1024), 1),
+            "cpu_seconds" : round(self.cpu_seconds, 2),
+            # Share of every core on the machine that was busy while the benchmark ran
+            "cpu_utilization" : round(self.cpu_seconds / (self.total_seconds * num_cores), 3) if self.total_seconds > 0 else 0,
+            "parameters" : self.parameters,
+        }
+
+
+def make_media(raw_folder : str, args : argparse.Namespace) -> Dict[str, List[str]]:
+    """Writes the synthetic files each delegate benchmark corrects. Returns their paths by delegate name."""
+    os.makedirs(raw_folder, exist_ok=True)
+    paths : Dict[str, List[str]] = {name : [] for name in RAW_FILE_NAMES}
+
+    slide_width, slide_height = args.slide_size
+    for i in range(args.slides):
+        image, _ = make_synthetic_slide(slide_width, slide_height, slide_width * 0.6, slide_height * 0.6, tilt_degrees=2, seed=i)
+        paths["correct_slide"].append(os.path.join(raw_folder, RAW_FILE_NAMES["correct_slide"].format(i)))
+        cv2.imwrite(paths["correct_slide"][-1], image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+
+    print_width, print_height = args.print_size
+    for i in range(args.prints):
+        paths["correct_print"].append(os.path.join(raw_folder, RAW_FILE_NAMES["correct_print"].format(i)))
+        cv2.imwrite(paths["correct_print"][-1], make_synthetic_print(print_width, print_height, seed=i), [cv2.IMWRITE_JPEG_QUALITY, 95])
+
+    for i in range(args.audio_files):
+        paths["correct_audio"].append(os.path.join(raw_folder, RAW_FILE_NAMES["correct_audio"].format(i)))
+        write_synthetic_wav(paths["correct_audio"][-1], args.audio_minutes * 60, seed=i)
+
+    for i in range(args.videos):
+        paths["correct_vhs"].append(os.path.join(raw_folder, RAW_FILE_NAMES["correct_vhs"].format(i)))
+        write_synthetic_mp4(paths["correct_vhs"][-1], args.video_seconds)
+
+    return paths
+
+
+def measure_delegate(delegate_name : str, file_paths : List[str], to_folder : str, sample_seconds : float) -> BenchmarkResult:
+    """Runs in its own process. Corrects each file one after the other, the way a single worker would."""
+    from corr.delegates import get_delegate
+    delegate = get_delegate(delegate_name)
+
+    file_seconds = []
+    with ResourceSampler(sample_seconds) as sampler:
+        start = time.perf_counter()
+        for file_path in file_paths:
+            file_start = time.perf_counter()
+            delegate(file_path, to_folder, {})
+            file_seconds.append(time.perf_counter() - file_start)
+        total_seconds = time.perf_counter() - start
+
+    return BenchmarkResult(delegate_name, len(file_paths), total_seconds, file_seconds, sampler.peak_rss_bytes, sampler.get_cpu_seconds())
+
+
+def measure_simplest_cb(megapixels : float, repeats : int, sample_seconds : float) -> BenchmarkResult:
+    """Runs in its own process. Color balances the same synthetic scan repeats times."""
+    from corr.color_balance import simplest_cb
+    image = make_synthetic_scan(megapixels)
+
+    file_seconds = []
+    with ResourceSampler(sample_seconds) as sampler:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            file_start = time.perf_counter()
+            simplest_cb(image, 1)
+            file_seconds.append(time.perf_counter() - file_start)
+        total_seconds = time.perf_counter() - start
+
+    return BenchmarkResult("simplest_cb", repeats, total_seconds, file_seconds, sampler.peak_rss_bytes, sampler.get_cpu_seconds(), { "megapixels" : megapixels })
+
+
+def measure_complete_corrector(project_folder : str, sample_seconds : float) -> BenchmarkResult:
+    """Runs in its own process. Corrects the whole project, starting the worker pool from cold."""
+    from corr.base_correct import CompleteCorrector, CorrectionProgress, CorrectResult
+    from corr.worker_pool import get_worker_pool
+
+    file_seconds = []
+    class RecordDurations(CorrectionProgress):
+        def on_task_finished(self, result : CorrectResult):
+            file_seconds.append(result.duration_seconds)
+
+    with ResourceSampler(sample_seconds) as sampler:
+        start = time.perf_counter()
+        summary = CompleteCorrector(project_folder, { "force" : True }, RecordDurations()).correct_everything()
+        total_seconds = time.perf_counter() - start
+    get_worker_pool().shutdown()
+
+    return BenchmarkResult(
+        "CompleteCorrector", summary.processed + summary.failed, total_seconds, file_seconds, sampler.peak_rss_bytes, sampler.get_cpu_seconds(),
+        { "failed" : summary.failed }
+    )
+
+
+def run_in_fresh_process(function : Callable, *args) -> BenchmarkResult:
+    # Not a multiprocessing.Pool, its daemonic workers can't start the worker pool CompleteCorrector uses
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1) as executor:
+        return executor.submit(function, *args).result()
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results : List[Dict[str, any]], baseline_path : str):
+    with open(baseline_path) as file:
+        baseline = { result["name"] : result for result in json.load(file)["results"] }
+
+    print(f"\nCompared to {baseline_path}:")
+    print(f"{'benchmark':<18} {'files/s':>10} {'change':>8} {'peak RSS (MB)':>14} {'change':>8}")
+    for result in results:
+        old = baseline.get(result["name"])
+        if old is None:
+            continue
+        speed_change = 100 * (result["files_per_second"] / old["files_per_second"] - 1) if old["files_per_second"] else 0
+        rss_change = 100 * (result["peak_rss_mb"] / old["peak_rss_mb"] - 1) if old["peak_rss_mb"] else 0
+        print(f"{result['name']:<18} {result['files_per_second']:>10.3f} {speed_change:>+7.1f}% {result['peak_rss_mb']:>14.0f} {rss_change:>+7.1f}%")
+
+
+def parse_size(size : str) -> List[int]:
+    width, height = size.lower().split("x")
+    return [int(width), int(height)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARK_NAMES, default=BENCHMARK_NAMES)
+    parser.add_argument("--slides", type=int, default=8)
+    parser.add_argument("--slide-size", type=parse_size, default=[4800, 3200], help="e.g. 4800x3200")
+    parser.add_argument("--prints", type=int, default=8)
+    parser.add_argument("--print-size", type=parse_size, default=[3600, 2400], help="e.g. 3600x2400")
+    parser.add_argument("--audio-files", type=int, default=2)
+    parser.add_argument("--audio-minutes", type=float, default=10)
+    parser.add_argument("--videos", type=int, default=2)
+    parser.add_argument("--video-seconds", type=float, default=30)
+    parser.add_argument("--cb-megapixels", type=float, default=50)
+    parser.add_argument("--cb-repeats", type=int, default=5)
+    parser.add_argument("--sample-ms", type=float, default=50, help="How often RSS and CPU time are sampled")
+    parser.add_argument("--output", help="Where to write the results as JSON")
+    parser.add_argument("--compare", help="Results JSON from an earlier run to compare against")
+    parser.add_argument("--keep-files", help="Folder to generate the media in and leave behind, instead of a temporary one")
+    args = parser.parse_args()
+
+    sample_seconds = args.sample_ms / 1000
+    with tempfile.TemporaryDirectory() as temp_folder:
+        project_folder = args.keep_files or temp_folder
+        raw_folder = os.path.join(project_folder, "Raw")
+        print(f"Generating media in {raw_folder}")
+        paths = make_media(raw_folder, args)
+
+        results : List[BenchmarkResult] = []
+        for name in args.only:
+            if name in paths and not paths[name]:
+                continue
+            print(f"Running {name}")
+            if name == "simplest_cb":
+                result = run_in_fresh_process(measure_simplest_cb, args.cb_megapixels, args.cb_repeats, sample_seconds)
+            elif name == "CompleteCorrector":
+                result = run_in_fresh_process(measure_complete_corrector, project_folder, sample_seconds)
+            else:
+                to_folder = os.path.join(project_folder, "Corrected", name)
+                os.makedirs(to_folder, exist_ok=True)
+                result = run_in_fresh_process(measure_delegate, name, paths[name], to_folder, sample_seconds)
+            results.append(result)
+
+    result_dicts = [result.to_dict() for result in results]
+    print(f"\n{'benchmark':<18} {'files':>6} {'files/s':>10} {'p50 (s)':>8} {'max (s)':>8} {'peak RSS (MB)':>14} {'CPU util':>9}")
+    for result in result_dicts:
+        latency = result["latency_seconds"]
+        print(f"{result['name']:<18} {result['files']:>6} {result['files_per_second']:>10.3f} {latency['p50']:>8.2f} {latency['max']:>8.2f} {result['peak_rss_mb']:>14.0f} {result['cpu_utilization']:>9.2f}")
+
+    if args.compare:
+        print_comparison(result_dicts, args.compare)
+
+    if args.output:
+        output = {
+            "metadata" : {
+                "git_commit" : get_git_commit(),
+                "time" : datetime.datetime.now().isoformat(),
+                "python" : platform.python_version(),
+                "platform" : platform.platform(),
+                "cpu_count" : os.cpu_count(),
+                "memory_gb" : round(psutil.virtual_memory().total / 1024 ** 3, 1),
+                "arguments" : { key : value for key, value in vars(args).items() if key not in ("output", "compare") },
+            },
+            "results" : result_dicts,
+        }
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=4)
+        print(f"Wrote results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
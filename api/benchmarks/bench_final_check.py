@@ -0,0 +1,161 @@
+"""
+Compares manual_final_check's folder scan reading one file at a time against reading them on a MetadataScanner's
+threads, on a synthetic client folder of small images, audio and video, and checks both give the same result.
+
+A local disk answers from the page cache after the first run, so --latency-ms adds a sleep to every header read and
+stat to stand in for a NAS round trip. Each run starts with an empty media metadata cache, and is followed by one
+reusing it, like checking a project again. Video files need ffmpeg on the PATH and are left out without it.
+
+Run from the api folder:
+    python -m benchmarks.bench_final_check --files 100000 --latency-ms 2
+"""
+import argparse
+import functools
+import io
+import os
+import shutil
+import tempfile
+import time
+import wave
+from typing import Callable, Dict
+import django
+from PIL import Image
+
+from benchmarks.synthetic import write_synthetic_mp4
+
+# Share of the files of each kind, the rest are misnamed images and files of unrecognized types
+FILE_KINDS = [
+    ("jpg", 0.6),
+    ("tif", 0.1),
+    ("wav", 0.15),
+    ("mp4", 0.05),
+    ("misnamed", 0.05),
+    ("txt", 0.05),
+]
+CLIENT_FOLDER_NAME = "Bench, John"
+FILE_PREFIX = "BenchJ_"
+DPI = 600
+
+
+def make_templates(folder : str) -> Dict[str, bytes]:
+    """The bytes of one small file of each kind, copied for every file of that kind."""
+    templates = {}
+    image = Image.new("RGB", (16, 16), (120, 80, 40))
+    for extension, format in (("jpg", "JPEG"), ("tif", "TIFF")):
+        buffer = io.BytesIO()
+        image.save(buffer, format, dpi=(DPI, DPI))
+        templates[extension] = buffer.getvalue()
+    templates["misnamed"] = templates["jpg"]
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(8000)
+        file.writeframes(bytes(2 * 8000))
+    templates["wav"] = buffer.getvalue()
+    templates["txt"] = b"notes"
+
+    if shutil.which("ffmpeg"):
+        mp4_path = os.path.join(folder, "template.mp4")
+        write_synthetic_mp4(mp4_path, 2, width=64, height=48, silence_seconds=0.5)
+        with open(mp4_path, "rb") as file:
+            templates["mp4"] = file.read()
+        os.remove(mp4_path)
+    return templates
+
+
+def make_client_folder(folder : str, files : int, subfolders : int) -> str:
+    """Writes files small files spread over subfolders of a client folder, plus a few in the folder itself."""
+    templates = make_templates(folder)
+    client_folder = os.path.join(folder, CLIENT_FOLDER_NAME)
+    kinds = [kind for kind, share in FILE_KINDS for _ in range(round(share * 100)) if kind in templates]
+
+    for index in range(files):
+        subfolder = index % (subfolders + 1)
+        dir_path = client_folder if subfolder == 0 else os.path.join(client_folder, f"Box {subfolder}")
+        os.makedirs(dir_path, exist_ok=True)
+        kind = kinds[index % len(kinds)]
+        extension = "jpg" if kind == "misnamed" else kind
+        prefix = "Wrong_" if kind == "misnamed" else FILE_PREFIX
+        with open(os.path.join(dir_path, f"{prefix}{index}.{extension}"), "wb") as file:
+            file.write(templates[kind])
+    return client_folder
+
+
+def with_latency(function : Callable, latency_seconds : float) -> Callable:
+    @functools.wraps(function)
+    def delayed(*args):
+        time.sleep(latency_seconds)
+        return function(*args)
+    return delayed
+
+
+def measure(client_folder : str, threads : int, cache) -> tuple:
+    from other.metadata_scan import MetadataScanner
+    from other.views import check_folder
+
+    start = time.perf_counter()
+    subdirs = [entry.path for entry in os.scandir(client_folder) if entry.is_dir()]
+    with MetadataScanner(threads=threads, cache=cache) as scanner:
+        result = check_folder(client_folder, subdirs, scanner)
+    return time.perf_counter() - start, result
+
+
+def measure_cold_and_warm(client_folder : str, threads : int, cache_folder : str) -> tuple:
+    """Checks the folder with an empty cache, then again with what that filled it with."""
+    from mwlocal.media_metadata import MetadataCache
+
+    cache_path = os.path.join(cache_folder, f"media_metadata_{threads}_{time.time_ns()}.sqlite3")
+    cache = MetadataCache(cache_path)
+    cold_seconds, cold_result = measure(client_folder, threads, cache)
+    warm_seconds, warm_result = measure(client_folder, threads, cache)
+    return cold_seconds, warm_seconds, cold_result, warm_result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--subfolders", type=int, default=100)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32, 64], help="1 reads one file at a time, like before")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every header read, e.g. 2 for a NAS")
+    parser.add_argument("--repeats", type=int, default=2, help="Runs of each thread count, the fastest is reported")
+    parser.add_argument("--keep-files", help="Folder to generate the client folder in and leave behind, instead of a temporary one")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mwlocal.settings")
+    # Keeps each check's summary out of the table
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    django.setup()
+    import mwlocal.media_metadata as media_metadata
+    if args.latency_ms:
+        latency_seconds = args.latency_ms / 1000
+        media_metadata.read_media_metadata = with_latency(media_metadata.read_media_metadata, latency_seconds)
+        media_metadata.get_file_key = with_latency(media_metadata.get_file_key, latency_seconds)
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        folder = args.keep_files or temp_folder
+        os.makedirs(folder, exist_ok=True)
+        print(f"Writing {args.files} files in {folder}")
+        client_folder = make_client_folder(folder, args.files, args.subfolders)
+
+        cache_folder = os.path.join(folder, "cache")
+        os.makedirs(cache_folder, exist_ok=True)
+
+        # Once first, so every thread count reads from a warm page cache
+        measure_cold_and_warm(client_folder, max(args.threads), cache_folder)
+        baseline_seconds = None
+        expected = None
+        print(f"{'threads':>8} {'cold (s)':>9} {'files/s':>9} {'speedup':>8} {'warm (s)':>9}  same result as {args.threads[0]} thread(s)")
+        for threads in args.threads:
+            runs = [measure_cold_and_warm(client_folder, threads, cache_folder) for _ in range(args.repeats)]
+            cold_seconds = min(run[0] for run in runs)
+            warm_seconds = min(run[1] for run in runs)
+            baseline_seconds = baseline_seconds or cold_seconds
+            expected = expected or runs[0][2]
+            same = all(run[2] == expected and run[3] == expected for run in runs)
+            print(f"{threads:>8} {cold_seconds:>9.2f} {args.files / cold_seconds:>9.0f} {baseline_seconds / cold_seconds:>7.1f}x {warm_seconds:>9.2f}  {same}")
+
+
+if __name__ == "__main__":
+    main()
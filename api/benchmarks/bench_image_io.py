@@ -0,0 +1,97 @@
+"""
+Compares reading and writing scans through corr.image_io against the old path, which decoded with OpenCV,
+opened the file again with PIL for its DPI, then converted to RGB and copied into a PIL image to save it.
+
+Each measurement runs in a fresh process so its peak RSS is its own. Peak RSS is read from /proc, so Linux only.
+
+Run from the api folder:
+    python -m benchmarks.bench_image_io --dpis 600 1200 --format tif
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+import cv2
+from PIL import Image
+
+from corr.image_io import read_scan, write_scan
+from benchmarks.synthetic import make_synthetic_scan
+
+
+def old_read_write(from_path : str, to_path : str) -> tuple:
+    start = time.perf_counter()
+    image = cv2.imread(from_path)
+    pil_image = Image.open(from_path)
+    dpi = pil_image.info.get("dpi", (None, None))[0]
+    read_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    out_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    pil_image_out = Image.fromarray(out_rgb)
+    pil_image_out.save(to_path, dpi=(dpi, dpi), subsampling=0, quality=95)
+    return read_seconds, time.perf_counter() - start
+
+
+def new_read_write(from_path : str, to_path : str) -> tuple:
+    start = time.perf_counter()
+    scan = read_scan(from_path)
+    read_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write_scan(to_path, scan.pixels, scan.dpi)
+    return read_seconds, time.perf_counter() - start
+
+
+def get_peak_rss_kb() -> int:
+    # ru_maxrss survives exec, so a spawned worker would start with the parent's peak. VmHWM doesn't.
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def measure(method_name : str, from_path : str, to_path : str) -> tuple:
+    """Runs in its own process. Returns the read and write seconds and the peak RSS the method added, in MB."""
+    method = old_read_write if method_name == "old" else new_read_write
+    base_peak_kb = get_peak_rss_kb()
+    read_seconds, write_seconds = method(from_path, to_path)
+    return read_seconds, write_seconds, (get_peak_rss_kb() - base_peak_kb) / 1024
+
+
+def make_scan_file(folder : str, dpi : int, width_inches : float, height_inches : float, extension : str) -> str:
+    megapixels = dpi * width_inches * dpi * height_inches / 1_000_000
+    image = make_synthetic_scan(megapixels)
+    path = os.path.join(folder, f"scan_{dpi}dpi{extension}")
+    Image.fromarray(image).save(path, dpi=(dpi, dpi), quality=95)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dpis", type=int, nargs="+", default=[600, 1200])
+    parser.add_argument("--inches", type=float, nargs=2, default=[6, 4], help="Width and height of the scanned print")
+    parser.add_argument("--format", default="tif", help="Extension of the scans to read and write, e.g. tif or jpg")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    extension = f".{args.format.lstrip('.')}"
+    context = multiprocessing.get_context("spawn")
+    print(f"{'DPI':>6} {'MP':>6} {'path':>5} {'read (s)':>9} {'write (s)':>10} {'peak RSS (MB)':>14}")
+    with tempfile.TemporaryDirectory() as folder, context.Pool(1, maxtasksperchild=1) as pool:
+        for dpi in args.dpis:
+            from_path = make_scan_file(folder, dpi, args.inches[0], args.inches[1], extension)
+            megapixels = dpi * args.inches[0] * dpi * args.inches[1] / 1_000_000
+
+            for method_name in ["old", "new"]:
+                to_path = os.path.join(folder, f"out_{method_name}{extension}")
+                runs = [pool.apply(measure, (method_name, from_path, to_path)) for _ in range(args.repeats)]
+                read_seconds = min(run[0] for run in runs)
+                write_seconds = min(run[1] for run in runs)
+                peak_mb = max(run[2] for run in runs)
+                print(f"{dpi:>6} {megapixels:>6.1f} {method_name:>5} {read_seconds:>9.2f} {write_seconds:>10.2f} {peak_mb:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Measures what importing the server and each correction delegate costs, using python -X importtime in a fresh
+interpreter per target, and checks the heavy media libraries are only imported by the delegates that need them.
+
+Exits with 1 if a target imports a heavy library it shouldn't, or takes longer than --max-ms, so it can be run
+to catch import time regressions.
+
+Run from the api folder:
+    python -m benchmarks.bench_import_time --repeats 3
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# Imported by some correction delegates, and by nothing else in the server
+HEAVY_MODULES = ["cv2", "librosa", "pydub", "soundfile", "scipy", "numba"]
+
+SERVER_STARTUP = "import django; django.setup(); import mwlocal.urls"
+
+# Name, the code to import and the heavy modules it's allowed to import
+TARGETS : List[Tuple[str, str, List[str]]] = [
+    ("server startup", SERVER_STARTUP, []),
+    ("corr.base_correct", "import corr.base_correct", []),
+    ("corr.worker_pool", "import corr.worker_pool", []),
+    ("correct_slide", "import corr.slides.slides_correct", ["cv2"]),
+    ("correct_print", "import corr.prints.prints_correct", ["cv2"]),
+    ("correct_audio", "import corr.audio.audio_correct; import librosa.core, librosa.effects", ["librosa", "pydub", "soundfile", "scipy", "numba"]),
+    ("correct_vhs", "import corr.video.vhs_correct; import librosa.core, librosa.effects", ["librosa", "pydub", "soundfile", "scipy", "numba"]),
+    ("corr.pipeline", "import corr.pipeline", ["cv2"]),
+]
+
+
+def measure_import(code : str) -> Tuple[float, Dict[str, float]]:
+    """
+    Runs code in a fresh interpreter with -X importtime.
+
+    :returns: The total import time in ms and the cumulative ms of every module imported, including its own imports
+    """
+    env = os.environ | { "DJANGO_SETTINGS_MODULE" : "mwlocal.settings", "PYTHONPATH" : os.getcwd() }
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, env=env, check=True
+    )
+
+    module_ms : Dict[str, float] = {}
+    total_ms = 0
+    for line in completed.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nesting is shown by indenting the name
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        cumulative_ms = int(cumulative_us) / 1000
+        module_ms[name.strip()] = cumulative_ms
+        if not name[1:].startswith(" "):
+            total_ms += cumulative_ms
+    return total_ms, module_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=3, help="Imports of each target, the fastest is reported")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if server startup's imports take longer than this")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'target':<20} {'import (ms)':>12}  heavy modules imported")
+    for name, code, allowed_heavy_modules in TARGETS:
+        runs = [measure_import(code) for _ in range(args.repeats)]
+        total_ms, module_ms = min(runs, key=lambda run: run[0])
+        heavy_imported = [module for module in HEAVY_MODULES if module in module_ms]
+        unexpected = [module for module in heavy_imported if module not in allowed_heavy_modules]
+
+        heavy_summary = ", ".join(f"{module} {module_ms[module]:.0f}ms" for module in heavy_imported) or "none"
+        print(f"{name:<20} {total_ms:>12.0f}  {heavy_summary}")
+        if unexpected:
+            print(f"    {name} should not import {unexpected}")
+            failed = True
+        if name == "server startup" and args.max_ms is not None and total_ms > args.max_ms:
+            print(f"    Server startup took longer than {args.max_ms:.0f}ms")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
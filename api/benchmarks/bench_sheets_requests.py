@@ -0,0 +1,225 @@
+"""
+Compares the two ways of fetching every group in Photo Trns for check_all_photo_rows: a range per group's row, each
+flattened into a list, after a request for the identifiers to know how many rows there are, against the whole table
+as one range, sent column by column and split into rows locally.
+
+Runs against a stand-in Sheets server on localhost, serving a synthetic project, so no credentials are needed.
+It answers batchGet and title requests like the Sheets API does, leaving off trailing empty cells, after waiting
+--latency-ms to stand in for the round trip to Google. googleapiclient sends a URL over 2KB as a POST with the query
+in its body, which is answered the same way. Both ways are checked to read the same groups.
+
+Run from the api folder:
+    python -m benchmarks.bench_sheets_requests --groups 50 200 1000 --latency-ms 150
+"""
+import argparse
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+from googleapiclient.discovery import build
+import httplib2
+
+from sheets.photo_row import PHOTO_CORRECTED_COLUMN, PHOTO_IDENTIFIER_COLUMN, PHOTO_ROW_LENGTH, PHOTO_TABLE_FIRST_ROW
+from sheets.sheets_requests import RangeRequest, SheetsRequest, SheetTable
+
+# 'Tab name'!A11:X, where either row can be left out
+A1_RANGE_PATTERN = re.compile(r"^'(.+)'!([A-Z]+)(\d*):([A-Z]+)(\d*)$")
+SPREADSHEET_ID = "bench"
+
+# What fetching a project gives: the identifiers, each group's row, the corrected column, the client's name and the title
+FetchedGroups = Tuple[List[str], List[List[str]], List[str], List[str], str]
+
+
+def column_index(letters : str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def trim_trailing(cells : List[str]) -> List[str]:
+    end = len(cells)
+    while end > 0 and cells[end - 1] in ("", []):
+        end -= 1
+    return cells[:end]
+
+
+@dataclass
+class StandInSheet:
+    title : str
+    # Each tab's rows of cells, row 1 first
+    tabs : Dict[str, List[List[str]]]
+
+    def get_values(self, a1_range : str, major_dimension : str) -> Optional[List[List[str]]]:
+        """The cells in a range the way the Sheets API sends them, or None for an empty range."""
+        match = A1_RANGE_PATTERN.match(a1_range)
+        rows = self.tabs[match[1]]
+        first_column, last_column = column_index(match[2]), column_index(match[4])
+        first_row = int(match[3]) - 1 if match[3] else 0
+        last_row = int(match[5]) - 1 if match[5] else len(rows) - 1
+
+        cells = [
+            [row[column] if column < len(row) else "" for column in range(first_column, last_column + 1)]
+            for row in rows[first_row:last_row + 1]
+        ]
+        if major_dimension == "COLUMNS":
+            cells = [list(column) for column in zip(*cells)]
+        values = trim_trailing([trim_trailing(line) for line in cells])
+        return values or None
+
+
+def make_photo_sheet(groups : int) -> StandInSheet:
+    """A project with a row in Photo Trns for each group, every third one corrected and every fifth in a custom folder."""
+    customer_info = [[] for _ in range(5)] + [["", "", "", "", "John", "Doe"]]
+    photo_trns = [[] for _ in range(PHOTO_TABLE_FIRST_ROW - 1)]
+    for group in range(1, groups + 1):
+        row = [""] * PHOTO_ROW_LENGTH
+        row[0] = str(group)
+        row[1] = "Slides"
+        row[2] = "600"
+        row[3] = "Y" if group % 3 == 0 else ""
+        row[7] = str(20 + group % 30)
+        row[8] = str(group % 4) if group % 4 else ""
+        row[23] = f"Box {group}" if group % 5 == 0 else ""
+        photo_trns.append(trim_trailing(row))
+    return StandInSheet("P123_Slides_001", {"Customer Info" : customer_info, "Photo Trns" : photo_trns})
+
+
+@dataclass
+class RequestLog:
+    requests : int = 0
+    url_bytes : int = 0
+    response_bytes : int = 0
+    lock : threading.Lock = field(default_factory=threading.Lock)
+
+    def add(self, url_bytes : int, response_bytes : int):
+        with self.lock:
+            self.requests += 1
+            self.url_bytes += url_bytes
+            self.response_bytes += response_bytes
+
+
+def make_handler(sheet : StandInSheet, latency_seconds : float, log : RequestLog) -> type:
+    class StandInSheetsHandler(BaseHTTPRequestHandler):
+        def do_GET(self, body_query : str = ""):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            for name, values in parse_qs(body_query).items():
+                query.setdefault(name, []).extend(values)
+            path = unquote(url.path)
+            time.sleep(latency_seconds)
+
+            if path.endswith("/values:batchGet"):
+                major_dimension = query.get("majorDimension", ["ROWS"])[0]
+                value_ranges = []
+                for a1_range in query.get("ranges", []):
+                    value_range = {"range" : a1_range, "majorDimension" : major_dimension}
+                    values = sheet.get_values(a1_range, major_dimension)
+                    if values is not None:
+                        value_range["values"] = values
+                    value_ranges.append(value_range)
+                body = {"spreadsheetId" : SPREADSHEET_ID, "valueRanges" : value_ranges}
+            else:
+                body = {"properties" : {"title" : sheet.title}}
+
+            data = json.dumps(body).encode()
+            log.add(len(self.path) + len(body_query), len(data))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            # googleapiclient sends requests with URLs over 2KB as a POST with the query in the body
+            body_query = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            self.do_GET(body_query)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StandInSheetsHandler
+
+
+def fetch_by_rows(service) -> FetchedGroups:
+    """A request for the identifiers, then one with a range per group's row."""
+    identifiers_request = SheetsRequest(SPREADSHEET_ID, [RangeRequest("Photo Trns", f"A{PHOTO_TABLE_FIRST_ROW}", "A")])
+    identifiers_request.service = service
+    identifiers = identifiers_request.execute().values[0]
+
+    ranges = [
+        RangeRequest("Customer Info", "E6", "F6", 2),
+        RangeRequest("Photo Trns", f"D{PHOTO_TABLE_FIRST_ROW}", "D"),
+    ]
+    for i, _ in enumerate(identifiers):
+        row_number = PHOTO_TABLE_FIRST_ROW + i
+        ranges.append(RangeRequest("Photo Trns", f"A{row_number}", f"X{row_number}", PHOTO_ROW_LENGTH))
+    all_groups_request = SheetsRequest(SPREADSHEET_ID, ranges, True)
+    all_groups_request.service = service
+    response = all_groups_request.execute()
+    return identifiers, response.values[2:], response.values[1], response.values[0], response.title
+
+
+def fetch_as_table(service) -> FetchedGroups:
+    """The whole table as one range, sent by column, as check_all_photo_rows does."""
+    request = SheetsRequest(SPREADSHEET_ID, [
+        RangeRequest("Customer Info", "E6", "F6", 2),
+        RangeRequest("Photo Trns", f"A{PHOTO_TABLE_FIRST_ROW}", "X", PHOTO_ROW_LENGTH, as_table=True),
+    ], get_title=True, columnar=True)
+    request.service = service
+    response = request.execute()
+    table : SheetTable = response.values[1]
+    identifiers = [identifier for identifier in table.get_column(PHOTO_IDENTIFIER_COLUMN) if identifier != ""]
+    group_rows = [table.get_row(i) for i, identifier in enumerate(table.get_column(PHOTO_IDENTIFIER_COLUMN)) if identifier != ""]
+    return identifiers, group_rows, table.get_column(PHOTO_CORRECTED_COLUMN), response.values[0], response.title
+
+
+METHODS = {
+    "rows" : fetch_by_rows,
+    "table" : fetch_as_table,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--latency-ms", type=float, default=150, help="Waited before answering each request")
+    parser.add_argument("--repeats", type=int, default=3, help="Fetches by each method, the fastest is reported")
+    args = parser.parse_args()
+
+    print(f"{'groups':>7} {'method':>6} {'requests':>9} {'url KB':>8} {'response KB':>12} {'seconds':>8}  same groups")
+    for groups in args.groups:
+        sheet = make_photo_sheet(groups)
+        log = RequestLog()
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(sheet, args.latency_ms / 1000, log))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        service = build(
+            "sheets", "v4",
+            http=httplib2.Http(),
+            static_discovery=True,
+            client_options={"api_endpoint" : f"http://127.0.0.1:{server.server_address[1]}/"}
+        )
+
+        expected = None
+        for method_name, method in METHODS.items():
+            seconds = []
+            for _ in range(args.repeats):
+                log.requests = log.url_bytes = log.response_bytes = 0
+                start = time.perf_counter()
+                fetched = method(service)
+                seconds.append(time.perf_counter() - start)
+            # The rows method flattens the corrected column without its blanks, and only "Y" being in it matters
+            comparable = fetched[:2] + ("Y" in fetched[2],) + fetched[3:]
+            expected = expected or comparable
+            print(f"{groups:>7} {method_name:>6} {log.requests:>9} {log.url_bytes / 1024:>8.1f} {log.response_bytes / 1024:>12.1f} {min(seconds):>8.3f}  {comparable == expected}")
+
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Times the slide background search before and after computing the background distance map once per image.
+
+"Before" recomputes four float64 color distance norms over a 3 channel mask for every threshold tried, like
+correct_slide used to. "After" is find_slide_crop's current approach. Both try every threshold, which is the
+worst case for a slide that never matches an acceptable aspect ratio.
+
+Run from the api folder:
+    python -m benchmarks.bench_slide_detection --sizes 4800x3200 6000x4000
+"""
+import argparse
+import time
+from typing import List, Tuple
+import cv2
+import numpy as np
+
+from benchmarks.synthetic import make_synthetic_slide
+from corr.slides.slides_correct import (
+    BACKGROUND_CROPPING_AGGRESSION,
+    BACKGROUND_KERNEL_SIZE,
+    SAMPLING_OFFSET_DISTANCE,
+    THRESHHOLD_OFFSETS,
+    find_largest_box,
+    get_background_distance_map,
+    make_detection_proxy,
+)
+
+
+def find_largest_box_per_threshhold(image : np.ndarray, bg_colors : List[Tuple], threshhold : int, kernel_size : int):
+    """The search correct_slide did for every threshold before the distance map was shared."""
+    output_image = np.ones_like(image) * 0
+
+    for color in bg_colors:
+        distance = np.linalg.norm(image - np.array(color, dtype=np.int16), axis=2)
+        output_image[distance < threshhold] = (255, 255, 255)
+
+    kernel = np.ones((kernel_size, kernel_size), np.float32)
+    output_image = cv2.bitwise_not(cv2.filter2D(output_image, -1, kernel))
+    gray_output = cv2.cvtColor(output_image, cv2.COLOR_BGR2GRAY)
+    _, binary_output = cv2.threshold(gray_output, 1, 255, cv2.THRESH_BINARY)
+    (contours, _) = cv2.findContours(binary_output, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    return max(contours, key=cv2.contourArea, default=None)
+
+
+def get_bg_colors(image : np.ndarray) -> List[Tuple]:
+    height, width, _ = image.shape
+    offset = SAMPLING_OFFSET_DISTANCE
+    return [
+        tuple(image[height - offset, width // 2]),
+        tuple(image[height // 2, width - offset]),
+        tuple(image[offset, width // 2]),
+        tuple(image[height // 2, offset])
+    ]
+
+
+def time_before(image : np.ndarray, long_edge : int) -> float:
+    start = time.perf_counter()
+    bg_colors = get_bg_colors(image)
+    detection_image, scale = make_detection_proxy(image, long_edge)
+    kernel_size = max(1, round(BACKGROUND_KERNEL_SIZE * scale))
+    for threshhold_offset in THRESHHOLD_OFFSETS:
+        find_largest_box_per_threshhold(detection_image, bg_colors, BACKGROUND_CROPPING_AGGRESSION + threshhold_offset, kernel_size)
+    return time.perf_counter() - start
+
+
+def time_after(image : np.ndarray, long_edge : int) -> float:
+    start = time.perf_counter()
+    bg_colors = get_bg_colors(image)
+    detection_image, scale = make_detection_proxy(image, long_edge)
+    kernel_size = max(1, round(BACKGROUND_KERNEL_SIZE * scale))
+    distance_map = get_background_distance_map(detection_image, bg_colors)
+    for threshhold_offset in THRESHHOLD_OFFSETS:
+        find_largest_box(distance_map, BACKGROUND_CROPPING_AGGRESSION + threshhold_offset, kernel_size)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["4800x3200", "6000x4000"], help="Scan sizes as WIDTHxHEIGHT")
+    parser.add_argument("--long-edges", type=int, nargs="+", default=[0, 1500], help="Detection long edges, 0 for full resolution")
+    args = parser.parse_args()
+
+    print(f"{'size':>10} {'long edge':>10} {'before (s)':>11} {'after (s)':>10} {'speedup':>8}")
+    for size in args.sizes:
+        width, height = (int(value) for value in size.split("x"))
+        image, _ = make_synthetic_slide(width, height, width * 0.625, width * 0.625 / 1.5, 2)
+
+        for long_edge in args.long_edges:
+            before_seconds = time_before(image, long_edge)
+            after_seconds = time_after(image, long_edge)
+            print(f"{size:>10} {long_edge or 'full':>10} {before_seconds:>11.2f} {after_seconds:>10.2f} "
+                  f"{before_seconds / after_seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Generators for synthetic media used by the benchmarks and tests."""
+import subprocess
+from typing import Tuple
+import cv2
+import numpy as np
+
+SLIDE_BACKGROUND_COLOR = (205, 210, 215)
+# BGR gains giving a print the faded, warm cast simplest_cb is there to remove
+PRINT_COLOR_CAST = (0.7, 0.85, 1.0)
+# Blocks WAVs are written in, so hours of audio never have to fit in memory
+WAV_BLOCK_SECONDS = 60
+TONE_FREQUENCY_HZ = 440
+
+
+def make_synthetic_scan(megapixels: float, dtype=np.uint8, seed: int = 0) -> np.ndarray:
+    """Makes a smooth, scan-like 3:2 image by upscaling a small random image."""
+    height = int(np.sqrt(megapixels * 1_000_000 / 1.5))
+    width = int(height * 1.5)
+    max_value = np.iinfo(dtype).max
+
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, max_value + 1, (48, 72, 3)).astype(dtype)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def make_synthetic_slide(
+width: int,
+height: int,
+slide_width: float,
+slide_height: float,
+tilt_degrees: float = 0,
+seed: int = 0,
+noise: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Makes a fake slide scan: a tilted, anti-aliased rectangle of colorful content on a noisy, uniform background.
+
+    :returns: The BGR image and the 4 corners of the slide in full resolution pixel coordinates
+    """
+    rng = np.random.default_rng(seed)
+
+    image = np.full((height, width, 3), SLIDE_BACKGROUND_COLOR, np.uint8)
+    if noise:
+        image = cv2.add(image, rng.integers(0, noise + 1, (height, width, 3)).astype(np.uint8))
+
+    center = (width / 2 + rng.uniform(-0.05, 0.05) * width, height / 2 + rng.uniform(-0.05, 0.05) * height)
+    corners = cv2.boxPoints((center, (slide_width, slide_height), tilt_degrees))
+
+    content = cv2.resize(rng.integers(20, 160, (6, 9, 3)).astype(np.uint8), (width, height))
+
+    # Draw the slide with 4 bits of subpixel precision so its edges blend like a real scan
+    mask = np.zeros((height, width), np.uint8)
+    cv2.fillConvexPoly(mask, np.int32(np.round(corners * 16)), 255, cv2.LINE_AA, shift=4)
+    alpha = (mask.astype(np.float32) / 255)[..., None]
+    image = (image * (1 - alpha) + content * alpha).astype(np.uint8)
+
+    return image, corners
+
+
+def make_synthetic_print(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Makes a fake print scan: smooth random content with a color cast and a little noise."""
+    rng = np.random.default_rng(seed)
+    content = cv2.resize(rng.integers(30, 230, (48, 72, 3)).astype(np.uint8), (width, height), interpolation=cv2.INTER_LINEAR)
+    image = cv2.multiply(content, np.array(PRINT_COLOR_CAST + (1.0,)), dtype=cv2.CV_8U)
+    return cv2.add(image, rng.integers(0, 3, (height, width, 3)).astype(np.uint8))
+
+
+def write_synthetic_wav(
+path: str,
+seconds: float,
+sample_rate: int = 44100,
+channels: int = 2,
+silence_seconds: float = 5,
+seed: int = 0):
+    """
+    Writes a 16-bit WAV of a noisy tone with silence_seconds of near silence at each end, like a tape transfer
+    with lead-in and lead-out. Written a block at a time, so multi-hour files are fine.
+    """
+    import soundfile as sf
+
+    rng = np.random.default_rng(seed)
+    total_frames = int(seconds * sample_rate)
+    silence_frames = int(silence_seconds * sample_rate)
+    block_frames = WAV_BLOCK_SECONDS * sample_rate
+
+    with sf.SoundFile(path, "w", sample_rate, channels, subtype="PCM_16") as file:
+        for start in range(0, total_frames, block_frames):
+            frames = np.arange(start, min(start + block_frames, total_frames))
+            tone = 0.3 * np.sin(2 * np.pi * TONE_FREQUENCY_HZ * frames / sample_rate)
+            is_silent = (frames < silence_frames) | (frames >= total_frames - silence_frames)
+            block = np.where(is_silent, 0, tone) + rng.normal(0, 0.001, len(frames))
+            file.write(np.repeat(block[:, None], channels, axis=1).astype(np.float32))
+
+
+def write_synthetic_mp4(
+path: str,
+seconds: float,
+width: int = 320,
+height: int = 240,
+fps: int = 15,
+silence_seconds: float = 5):
+    """
+    Writes a small MP4 of ffmpeg's test pattern, with a tone that's silent for silence_seconds at each end
+    so correct_vhs has something to trim. Needs ffmpeg on the PATH.
+    """
+    # Commas inside a filter's expression have to be escaped
+    tone = f"if(between(t\\,{silence_seconds}\\,{seconds - silence_seconds})\\,0.3*sin(2*PI*{TONE_FREQUENCY_HZ}*t)\\,0)"
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc=size={width}x{height}:rate={fps}",
+        "-f", "lavfi", "-i", f"aevalsrc={tone}:s=44100",
+        "-t", str(seconds),
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+        "-c:a", "aac",
+        path
+    ]
+    subprocess.run(command, check=True)
@@ -1,6 +1,8 @@
 import gc
 import io
+import logging
 import os
+import subprocess
 from typing import Dict, List, Tuple
 import librosa
 import numpy as np
@@ -8,18 +10,29 @@ from pydub import AudioSegment
 import soundfile as sf
 
 from corr.correction_problem import GenericProblem
+from corr.instrumentation import STAGE_DECODE, STAGE_DETECT, STAGE_ENCODE, STAGE_GAIN, record_detail, stage
 
 """
     - Loading as many 30-120 minute .WAV files as the server has cores is incredibly memory intensive.
     It's a little excessive, but all the gc.collect() calls are to help reduce memory usage.
+    - correct_audio streams by default (see correct_audio_streaming), which keeps memory to a few MB per file
+    no matter how long it is. The in-memory path is still used if streaming is disabled or soundfile can't read the file.
 """
 
+logger = logging.getLogger(__name__)
+
 MIN_ALLOWED_BURST_OF_AUDIO_DURING_SILENCE_SECONDS = 1
 CLIPPED_AUDIO_PADDING_SECONDS = 3
 QUIET_THRESHHOLD = 20
 
 FINAL_DBFS = -3 
 
+# Must match librosa.effects.split's defaults so streamed silence detection finds the same start and end
+SPLIT_FRAME_LENGTH = 2048
+SPLIT_HOP_LENGTH = 512
+# Samples read per block when streaming. Must be a multiple of SPLIT_HOP_LENGTH.
+STREAM_BLOCK_SIZE = SPLIT_HOP_LENGTH * 128
+
 
 def adaptive_hard_clip(y: np.ndarray, clip_factor: float = 1.66) -> bool:
     """Mutates audio passed in.
@@ -27,16 +40,16 @@ def adaptive_hard_clip(y: np.ndarray, clip_factor: float = 1.66) -> bool:
     # Compute the 90th and 99th percentile levels
     loudish = np.percentile(np.abs(y), 99)
     spike_level = np.percentile(np.abs(y), 99.98)
-    print(f"Loudish level (90th percentile): {loudish}, Spike level (99th percentile): {spike_level}")
+    logger.debug("Loudish level (90th percentile): %s, Spike level (99th percentile): %s", loudish, spike_level)
 
     # Only apply clipping if the spike level is significantly higher than the loudish level.
     if spike_level > loudish * clip_factor:
-        print(f"Significant spikes detected. Clipping values above {spike_level}.")
+        logger.debug("Significant spikes detected. Clipping values above %s.", spike_level)
         # Only modify samples that exceed the 99th percentile.
         y = np.where(np.abs(y) > spike_level, np.sign(y) * spike_level, y)
         return True
     else:
-        print("No significant spikes detected. No clipping applied.")
+        logger.debug("No significant spikes detected. No clipping applied.")
         return False
 
 
@@ -44,12 +57,18 @@ def compute_gain(y: np.ndarray, target_dbfs: float) -> float:
     """
     Computes the gain required to boost the maximum absolute amplitude of y to the target_dbfs.
     """
-    peak = np.max(np.abs(y))
+    return compute_gain_from_peak(np.max(np.abs(y)), target_dbfs)
+
+
+def compute_gain_from_peak(peak: float, target_dbfs: float) -> float:
+    """
+    Computes the gain required to boost a peak absolute amplitude to the target_dbfs.
+    """
     if peak <= 0:
         return 1.0  # Avoid divide by zero if audio is silent
     peak_db = 20 * np.log10(peak)
     gain = 10 ** ((target_dbfs - peak_db) / 20)
-    print(f"Current peak: {peak} (dB: {peak_db:.2f}). Computed gain: {gain:.3f}")
+    logger.debug("Current peak: %s (dB: %.2f). Computed gain: %.3f", peak, peak_db, gain)
     return gain
 
 
@@ -58,23 +77,197 @@ def get_start_and_end(y: np.ndarray, sr: int, silence_threshhold : int = 20) ->
     Finds where a track starts and ends (with some padding).
     Returns the full range (0, len(y)) if no significant audio is detected.
     """
-    print(f"Analyzing audio with silence threshold: {silence_threshhold} dB")
+    logger.debug("Analyzing audio with silence threshold: %s dB", silence_threshhold)
     intervals = librosa.effects.split(y, top_db=silence_threshhold)
-    print(f"Found {len(intervals)} intervals above threshold")
+    return get_start_and_end_from_intervals(intervals, sr, len(y))
+
+
+def get_start_and_end_from_intervals(intervals: np.ndarray, sr: int, num_samples: int) -> Tuple[int, int]:
+    """
+    Picks where a track starts and ends (with some padding) from its non-silent intervals.
+    Returns the full range (0, num_samples) if no interval is long enough.
+    """
+    logger.debug("Found %d intervals above threshold", len(intervals))
     
     min_duration_samples = int(MIN_ALLOWED_BURST_OF_AUDIO_DURING_SILENCE_SECONDS * sr)
     filtered_intervals = [interval for interval in intervals if (interval[1] - interval[0]) >= min_duration_samples]
-    print(f"After filtering short bursts: {len(filtered_intervals)} intervals remain")
+    logger.debug("After filtering short bursts: %d intervals remain", len(filtered_intervals))
 
     if filtered_intervals:
         margin_samples = int(CLIPPED_AUDIO_PADDING_SECONDS * sr)
         track_start = max(0, filtered_intervals[0][0] - margin_samples)
-        track_end = min(len(y), filtered_intervals[-1][1] + margin_samples)
-        print(f"Audio detected from sample {track_start} to {track_end}")
+        track_end = min(num_samples, filtered_intervals[-1][1] + margin_samples)
+        logger.debug("Audio detected from sample %d to %d", track_start, track_end)
         return track_start, track_end
 
-    print("No significant audio detected, using full range")
-    return 0, len(y)  # Return full range if no intervals found
+    logger.debug("No significant audio detected, using full range")
+    return 0, num_samples  # Return full range if no intervals found
+
+
+def get_intervals_from_hop_energies(hop_energies: np.ndarray, num_samples: int, silence_threshhold: int) -> np.ndarray:
+    """
+    Finds non-silent intervals the same way librosa.effects.split does, from the sum of squares of
+    every SPLIT_HOP_LENGTH samples of a mono signal.
+    """
+    # Each centered frame spans the 2 hops before and 2 hops after its center, zero padded past either end
+    hops_per_side = SPLIT_FRAME_LENGTH // SPLIT_HOP_LENGTH // 2
+    num_frames = 1 + num_samples // SPLIT_HOP_LENGTH
+    padded_energies = np.concatenate([np.zeros(hops_per_side), hop_energies, np.zeros(hops_per_side + 1)])
+    window_sums = np.convolve(padded_energies, np.ones(2 * hops_per_side), mode="valid")[:num_frames]
+    mse = window_sums / SPLIT_FRAME_LENGTH
+
+    # Same as librosa.amplitude_to_db(rms, ref=np.max) > -top_db
+    db = 10 * np.log10(np.maximum(1e-10, mse)) - 10 * np.log10(max(1e-10, mse.max(initial=0)))
+    non_silent = db > -silence_threshhold
+
+    edges = [np.flatnonzero(np.diff(non_silent.astype(int))) + 1]
+    if non_silent[0]:
+        edges.insert(0, np.array([0]))
+    if non_silent[-1]:
+        edges.append(np.array([len(non_silent)]))
+    edges = np.minimum(np.concatenate(edges) * SPLIT_HOP_LENGTH, num_samples)
+
+    return edges.reshape((-1, 2))
+
+
+def record_trim(start: int, end: int, num_samples: int, sr: int) -> None:
+    """Keeps where a track was trimmed to in the metrics of the file being corrected, see corr.instrumentation."""
+    record_detail("duration_seconds", round(float(num_samples / sr), 2))
+    record_detail("trim_start_seconds", round(float(start / sr), 2))
+    record_detail("trim_end_seconds", round(float(end / sr), 2))
+
+
+def scan_audio_blocks(from_path: str) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    First streaming pass. Reads a file block by block and collects:
+    - the sum of squares of the mono mix for every SPLIT_HOP_LENGTH samples, for silence detection
+    - the peak absolute amplitude of each channel in every block, for gain
+
+    :returns: (hop energies, block peaks with shape (blocks, channels), number of samples)
+    """
+    hop_energies = []
+    block_peaks = []
+    num_samples = 0
+
+    for block in sf.blocks(from_path, blocksize=STREAM_BLOCK_SIZE, dtype="float32", always_2d=True):
+        num_samples += len(block)
+        block_peaks.append(np.max(np.abs(block), axis=0))
+
+        mono = block.mean(axis=1)
+        padding = -len(mono) % SPLIT_HOP_LENGTH
+        if padding:
+            mono = np.concatenate([mono, np.zeros(padding, dtype=mono.dtype)])
+        hops = mono.reshape(-1, SPLIT_HOP_LENGTH).astype(np.float64)
+        hop_energies.append(np.einsum("ij,ij->i", hops, hops))
+
+    if num_samples == 0:
+        raise GenericProblem(f"{from_path} has no audio")
+
+    return np.concatenate(hop_energies), np.vstack(block_peaks), num_samples
+
+
+def get_channel_peaks(from_path: str, block_peaks: np.ndarray, start: int, end: int) -> np.ndarray:
+    """
+    Finds each channel's peak between start and end. Blocks fully inside the range reuse their peaks from
+    the first pass; only the partial blocks at either edge are read again.
+    """
+    first_full_block = -(-start // STREAM_BLOCK_SIZE)
+    last_full_block = end // STREAM_BLOCK_SIZE
+    peaks = np.zeros(block_peaks.shape[1], dtype=np.float32)
+
+    if first_full_block < last_full_block:
+        peaks = np.max(block_peaks[first_full_block:last_full_block], axis=0)
+        edge_ranges = [(start, first_full_block * STREAM_BLOCK_SIZE), (last_full_block * STREAM_BLOCK_SIZE, end)]
+    else:
+        edge_ranges = [(start, end)]
+
+    for edge_start, edge_end in edge_ranges:
+        if edge_end > edge_start:
+            edge, _ = sf.read(from_path, start=edge_start, stop=edge_end, dtype="float32", always_2d=True)
+            if len(edge):
+                peaks = np.maximum(peaks, np.max(np.abs(edge), axis=0))
+
+    return peaks
+
+
+def correct_audio_streaming(from_path: str, to_path: str, silence_threshold_db: int) -> None:
+    """
+    Corrects audio in two block-wise passes so memory stays bounded regardless of duration:
+    1. Scans for silence and per-block peaks (scan_audio_blocks) to find the start, end and per-channel gain.
+    2. Reads only the trimmed range, applies gain and clipping, and pipes 16-bit PCM straight into an ffmpeg mp3 encoder.
+    Produces the same trimming and gain as the in-memory path. Spike percentiles (adaptive_hard_clip) aren't
+    computed since they only get reported there and never change the audio.
+    """
+    info = sf.info(from_path)
+    sr = info.samplerate
+
+    # The first pass decodes and detects silence block by block, so it's timed as detecting
+    with stage(STAGE_DETECT):
+        hop_energies, block_peaks, num_samples = scan_audio_blocks(from_path)
+        logger.debug("Analyzing audio with silence threshold: %s dB", silence_threshold_db)
+        intervals = get_intervals_from_hop_energies(hop_energies, num_samples, silence_threshold_db)
+        start, end = get_start_and_end_from_intervals(intervals, sr, num_samples)
+    record_trim(start, end, num_samples, sr)
+
+    with stage(STAGE_GAIN):
+        peaks = get_channel_peaks(from_path, block_peaks, start, end)
+        gains = np.array([compute_gain_from_peak(peak, FINAL_DBFS) for peak in peaks], dtype=np.float32)
+
+    encoder = subprocess.Popen([
+        "ffmpeg",
+        "-y",
+        "-nostats",
+        "-loglevel", "error",
+        "-f", "s16le",  # Raw 16-bit PCM coming from stdin
+        "-ar", str(sr),
+        "-ac", str(len(gains)),
+        "-i", "pipe:0",
+        "-f", "mp3",
+        to_path
+    ], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # Reading the trimmed audio, applying gain and encoding all overlap, so they're timed together as encoding
+    with stage(STAGE_ENCODE):
+        try:
+            write_trimmed_blocks(encoder, from_path, start, end, gains)
+        except BaseException:
+            # e.g. the file is corrupt partway through. Don't leave ffmpeg running or half an mp3 behind.
+            encoder.kill()
+            encoder.wait()
+            encoder.stderr.close()
+            remove_partial_output(to_path)
+            raise
+
+        error = encoder.stderr.read()
+        encoder.stderr.close()
+        return_code = encoder.wait()
+    if return_code != 0:
+        remove_partial_output(to_path)
+        raise GenericProblem(f"ffmpeg could not encode {to_path}: {error.decode('utf-8', errors='replace')}")
+
+
+def write_trimmed_blocks(encoder: subprocess.Popen, from_path: str, start: int, end: int, gains: np.ndarray) -> None:
+    """Pipes the samples from start to end, with gain applied, into the encoder as 16-bit PCM, then closes its input."""
+    try:
+        for block in sf.blocks(from_path, blocksize=STREAM_BLOCK_SIZE, start=start, stop=end, dtype="float32", always_2d=True):
+            block *= gains
+            np.clip(block, -1.0, 1.0, out=block)
+            encoder.stdin.write((block * 32767).astype(np.int16).tobytes())
+    except BrokenPipeError:
+        pass    # ffmpeg exited early; its error is reported by the caller
+    finally:
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass    # Flushing what's left fails the same way once ffmpeg has exited
+
+
+def remove_partial_output(to_path: str) -> None:
+    try:
+        os.remove(to_path)
+    except FileNotFoundError:
+        pass
+
 
 def correct_audio(from_path: str, to_dir: str, options : Dict[str, any]) -> List[str]:
     # Initialize options if None
@@ -83,19 +276,33 @@ def correct_audio(from_path: str, to_dir: str, options : Dict[str, any]) -> List
     
     # Get silence threshold option with default value
     silence_threshold_db = options.get("audioSilenceThreshholdDb", 20)
+    disable_streaming = bool(options.get("audioDisableStreaming", False))
     
     file_name, file_extension = os.path.splitext(os.path.basename(from_path))
     to_path = os.path.join(to_dir, f"{file_name}.mp3")
 
+    if not disable_streaming:
+        try:
+            sf.info(from_path)
+        except Exception as e:
+            logger.info("Can't stream %s (%s), loading it into memory instead", from_path, e)
+        else:
+            correct_audio_streaming(from_path, to_path, silence_threshold_db)
+            logger.debug("Processed audio saved as %s.", to_path)
+            return [to_path]
+
     # Load the audio file in stereo (preserving channels)
-    y, sr = librosa.load(from_path, sr=None, mono=False)
+    with stage(STAGE_DECODE):
+        y, sr = librosa.load(from_path, sr=None, mono=False)
 
     # For silence trimming, create a mono mix
-    if y.ndim == 2:
-        y_mono = librosa.to_mono(y)
-    else:
-        y_mono = y
-    start, end = get_start_and_end(y_mono, sr, silence_threshold_db)
+    with stage(STAGE_DETECT):
+        if y.ndim == 2:
+            y_mono = librosa.to_mono(y)
+        else:
+            y_mono = y
+        start, end = get_start_and_end(y_mono, sr, silence_threshold_db)
+    record_trim(start, end, len(y_mono), sr)
 
     # Trim silence from the beginning and end using the mono version
     # After that, we don't need y_mono anymore, so collect it
@@ -109,19 +316,20 @@ def correct_audio(from_path: str, to_dir: str, options : Dict[str, any]) -> List
         y = y[start:end]
 
     # Process the audio channels separately if stereo
-    if y.ndim == 2:
-        processed_channels = []
-        for channel in y:
-            _ = adaptive_hard_clip(channel)    # Clip channel
-            gain = compute_gain(channel, FINAL_DBFS)
-            channel = np.clip(channel * gain, -1.0, 1.0)  # Process channel
-            processed_channels.append(channel)
-        # Recombine channels (resulting array shape: (n_channels, n_samples))
-        y = np.vstack(processed_channels)
-    else:
-        _ = adaptive_hard_clip(y)
-        gain = compute_gain(y, FINAL_DBFS)
-        y = np.clip(y * gain, -1.0, 1.0)
+    with stage(STAGE_GAIN):
+        if y.ndim == 2:
+            processed_channels = []
+            for channel in y:
+                _ = adaptive_hard_clip(channel)    # Clip channel
+                gain = compute_gain(channel, FINAL_DBFS)
+                channel = np.clip(channel * gain, -1.0, 1.0)  # Process channel
+                processed_channels.append(channel)
+            # Recombine channels (resulting array shape: (n_channels, n_samples))
+            y = np.vstack(processed_channels)
+        else:
+            _ = adaptive_hard_clip(y)
+            gain = compute_gain(y, FINAL_DBFS)
+            y = np.clip(y * gain, -1.0, 1.0)
 
     # Convert to 16-bit PCM and save as a temporary WAV file.
     # For stereo audio, soundfile expects shape (n_samples, n_channels)
@@ -134,19 +342,20 @@ def correct_audio(from_path: str, to_dir: str, options : Dict[str, any]) -> List
     del y
     gc.collect()
 
-    wav_buffer = io.BytesIO()
-    sf.write(wav_buffer, audio_normalized_int, sr, format='WAV')
-    wav_buffer.seek(0)
+    with stage(STAGE_ENCODE):
+        wav_buffer = io.BytesIO()
+        sf.write(wav_buffer, audio_normalized_int, sr, format='WAV')
+        wav_buffer.seek(0)
 
-    # clean up audio_normalized_int since we aren't using it anymore
-    del audio_normalized_int
-    gc.collect()
+        # clean up audio_normalized_int since we aren't using it anymore
+        del audio_normalized_int
+        gc.collect()
 
-    # Load the WAV file with pydub and export as MP3
-    pydub_wav = AudioSegment.from_wav(wav_buffer)
-    # Optionally specify a bitrate, e.g., bitrate="320k", if needed.
-    pydub_wav.export(to_path, format="mp3")
-    print(f"Processed audio saved as {to_path}.")
+        # Load the WAV file with pydub and export as MP3
+        pydub_wav = AudioSegment.from_wav(wav_buffer)
+        # Optionally specify a bitrate, e.g., bitrate="320k", if needed.
+        pydub_wav.export(to_path, format="mp3")
+    logger.debug("Processed audio saved as %s.", to_path)
 
     del wav_buffer, pydub_wav
     gc.collect()
@@ -1,17 +1,30 @@
 from dataclasses import dataclass, field
+import concurrent.futures
+import contextvars
+import functools
+import logging
 import os
 from pathlib import Path
-from typing import Callable, Dict, List, Union, Tuple
-
-import concurrent
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Union, Tuple
 
+from corr.correct_result import CorrectResult
 from corr.correction_problem import GenericProblem
+from corr.delegates import can_pipeline, get_delegate
 from corr.exceptions import FolderNotFound, NoRawFolderToCorrectFrom
+from corr.instrumentation import CorrectionMetrics, FileMetrics, call_measured, get_metrics_log, measure_file
+from corr.manifest import ManifestTracker
+from corr.scheduler import MemoryAwareScheduler, MemoryBudget, SchedulerStats, estimate_task_bytes, get_memory_budget_bytes
+from corr.worker_pool import get_worker_pool
 from mwlocal.helpers import CustomException
-from corr.audio.audio_correct import correct_audio
-from corr.prints.prints_correct import correct_print
-from corr.slides.slides_correct import correct_slide
-from corr.video.vhs_correct import correct_vhs
+from mwlocal.logs import get_log_context, log_context, run_in_log_context
+
+if TYPE_CHECKING:
+    # The pipeline imports cv2, it's only imported once a batch of scans needs it
+    from corr.pipeline import ImagePipeline, PipelineStats
+
+logger = logging.getLogger(__name__)
 
 @dataclass
 class CorrectTask:
@@ -21,12 +34,336 @@ class CorrectTask:
     options : Dict[str, any]
 
 
-def do_correct_task(task : CorrectTask):
-    try:
-        saved_output_file_paths = task.correct_file_delegate(task.file_path, task.to_folder_path, task.options)
-        return f"Corrected {task.file_path}, saved to {saved_output_file_paths}"
-    except GenericProblem as e:
-        return f"Error correcting {task.file_path}: {e.get_problem}"
+def run_correct_delegate(
+file_path : str,
+to_folder_path : str,
+correct_file_delegate : Callable[[str, str, Dict[str, any]], str],
+options : Dict[str, any]) -> CorrectResult:
+    start_time = time.perf_counter()
+    with log_context(file=file_path), measure_file(correct_file_delegate.__name__) as metrics:
+        try:
+            saved_output_file_paths = correct_file_delegate(file_path, to_folder_path, options)
+        except GenericProblem as e:
+            saved_output_file_paths = None
+            problem = e.get_problem()
+        else:
+            problem = None
+    metrics.record_file_sizes(file_path, saved_output_file_paths)
+
+    duration_seconds = time.perf_counter() - start_time
+    if problem is not None:
+        return CorrectResult(file_path, False, f"Error correcting {file_path}: {problem}", duration_seconds=duration_seconds, metrics=metrics)
+    if not saved_output_file_paths:
+        return CorrectResult(file_path, False, f"Could not correct {file_path}", duration_seconds=duration_seconds, metrics=metrics)
+    return CorrectResult(file_path, True, f"Corrected {file_path}, saved to {saved_output_file_paths}", saved_output_file_paths, duration_seconds, metrics)
+
+
+def do_correct_task(task : CorrectTask) -> CorrectResult:
+    return run_correct_delegate(task.file_path, task.to_folder_path, task.correct_file_delegate, task.options)
+
+
+class CorrectionProgress:
+    """
+    Receives a correction batch's progress as it runs, see corr.jobs.CorrectionJob. Does nothing by default.
+    Methods can be called from several threads at once when a batch runs more than one pool.
+    """
+    def on_batch_started(self, file_paths : List[str], skipped_file_paths : List[str]):
+        pass
+
+    def on_task_started(self, file_path : str):
+        pass
+
+    def on_task_finished(self, result : CorrectResult):
+        pass
+
+    def on_task_cancelled(self, file_path : str):
+        pass
+
+    def is_cancelled(self) -> bool:
+        """Once this returns True, the batch stops starting new files."""
+        return False
+
+    def get_log_context(self) -> Dict[str, any]:
+        """Added to every line the batch writes to the metrics log, e.g. to say which job it's part of."""
+        return {}
+
+
+@dataclass
+class CorrectionSummary:
+    processed : int = 0
+    skipped : int = 0
+    failed : int = 0
+    cancelled : int = 0
+    # Stats of the scheduler or pipeline that ran each pool
+    scheduler_stats : Dict[str, Union[SchedulerStats, "PipelineStats"]] = field(default_factory=dict)
+    # Every corrected file's metrics added up, see corr.instrumentation
+    metrics : CorrectionMetrics = field(default_factory=CorrectionMetrics)
+
+    def add_results(self, results : List[CorrectResult]):
+        for result in results:
+            if result.success:
+                self.processed += 1
+            else:
+                self.failed += 1
+            if result.metrics is not None:
+                self.metrics.add(result.metrics)
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "processed" : self.processed,
+            "skipped" : self.skipped,
+            "failed" : self.failed,
+            "cancelled" : self.cancelled,
+            "scheduler_stats" : {name : stats.to_dict() for name, stats in self.scheduler_stats.items()},
+            "metrics" : self.metrics.to_dict(),
+        }
+
+
+def estimate_correct_task_bytes(task : Union[CorrectTask, "CompleteCorrectTask"]) -> int:
+    return estimate_task_bytes(task.file_path, task.correct_file_delegate, task.options)
+
+
+def filter_up_to_date_tasks(tasks : List, manifests : ManifestTracker, force : bool) -> Tuple[List, List]:
+    """
+    Drops tasks whose file was already corrected into its output folder, unchanged and with the same options.
+
+    :returns: The tasks left to run and the tasks that were skipped
+    """
+    if force:
+        return tasks, []
+
+    tasks_to_run = []
+    skipped_tasks = []
+    for task in tasks:
+        if manifests.is_up_to_date(task.file_path, task.to_folder_path, task.correct_file_delegate.__name__, task.options):
+            logger.debug("%s is already corrected, skipping it", task.file_path)
+            skipped_tasks.append(task)
+        else:
+            tasks_to_run.append(task)
+
+    return tasks_to_run, skipped_tasks
+
+
+def start_batch(tasks : List, manifests : ManifestTracker, options : Dict[str, any], progress : CorrectionProgress, summary : CorrectionSummary) -> List:
+    """Filters out up to date tasks and tells progress which files the batch will correct. Returns the tasks to run."""
+    tasks, skipped_tasks = filter_up_to_date_tasks(tasks, manifests, bool(options.get("force", False)))
+    summary.skipped = len(skipped_tasks)
+    progress.on_batch_started([task.file_path for task in tasks], [task.file_path for task in skipped_tasks])
+    return tasks
+
+
+def run_scheduled_tasks(
+scheduler : MemoryAwareScheduler,
+tasks : List,
+do_task : Callable,
+manifests : ManifestTracker,
+progress : CorrectionProgress,
+label : str = "Scheduler") -> List[CorrectResult]:
+    """
+    Runs correction tasks through a MemoryAwareScheduler, printing each result and the scheduler's stats,
+    recording each result in its output folder's manifest and reporting it to progress.
+    Tasks dropped because progress was cancelled are left in scheduler.cancelled_tasks.
+    """
+    task_futures = scheduler.run(
+        tasks,
+        do_task,
+        estimate_correct_task_bytes,
+        on_task_started = lambda task: progress.on_task_started(task.file_path),
+        should_stop = progress.is_cancelled
+    )
+    results = record_task_results(get_future_results(task_futures), manifests, progress)
+
+    for task in scheduler.cancelled_tasks:
+        progress.on_task_cancelled(task.file_path)
+
+    logger.info("%s stats: %s", label, scheduler.stats.to_dict())
+    return results
+
+
+def run_pipelined_tasks(
+pipeline : "ImagePipeline",
+tasks : List,
+manifests : ManifestTracker,
+progress : CorrectionProgress,
+label : str = "Pipeline") -> List[CorrectResult]:
+    """Same as run_scheduled_tasks, but through an ImagePipeline. Cancelled tasks are left in pipeline.cancelled_tasks."""
+    task_results = pipeline.run(
+        tasks,
+        on_task_started = lambda task: progress.on_task_started(task.file_path),
+        should_stop = progress.is_cancelled
+    )
+    results = record_task_results(task_results, manifests, progress)
+
+    for task in pipeline.cancelled_tasks:
+        progress.on_task_cancelled(task.file_path)
+
+    logger.info("%s stats: %s", label, pipeline.stats.to_dict())
+    return results
+
+
+def get_future_results(task_futures : Iterator[Tuple[any, concurrent.futures.Future]]) -> Iterator[Tuple[any, CorrectResult]]:
+    for task, future in task_futures:
+        try:
+            result = future.result()
+        except Exception as exc:
+            result = CorrectResult(task.file_path, False, f"Task {task} generated an exception: {exc}")
+        yield task, result
+
+
+def log_result(result : CorrectResult):
+    if result.success:
+        logger.debug(result.message)
+    else:
+        logger.warning(result.message)
+
+
+def record_task_results(task_results : Iterator[Tuple[any, CorrectResult]], manifests : ManifestTracker, progress : CorrectionProgress) -> List[CorrectResult]:
+    """
+    Prints each result as it comes in, records it in its output folder's manifest, writes its metrics to the
+    metrics log and reports it to progress.
+    """
+    metrics_log = get_metrics_log()
+    results : List[CorrectResult] = []
+    for task, result in task_results:
+        log_result(result)
+        results.append(result)
+        if result.metrics is not None:
+            metrics_log.write(task.file_path, result.success, result.metrics, progress.get_log_context())
+        manifests.record_result(
+            task.file_path,
+            task.to_folder_path,
+            task.correct_file_delegate.__name__,
+            task.options,
+            result.success,
+            result.output_paths
+        )
+        progress.on_task_finished(result)
+
+    return results
+
+
+def run_task_group(
+tasks : List,
+do_task : Callable,
+budget : MemoryBudget,
+num_workers : int,
+options : Dict[str, any],
+manifests : ManifestTracker,
+progress : CorrectionProgress,
+label : str) -> Tuple[List[CorrectResult], int, Union[SchedulerStats, "PipelineStats"]]:
+    """
+    Runs tasks through an ImagePipeline if they're all scans it can correct, otherwise through a MemoryAwareScheduler.
+    Either way the work is done by the server's worker pool, using at most num_workers of its workers.
+
+    :returns: The results, how many tasks were cancelled and the stats of whatever ran them
+    """
+    worker_pool = get_worker_pool()
+    num_workers = max(1, min(num_workers, worker_pool.num_workers))
+    # So what workers log is tagged with this batch's context, e.g. its job id
+    do_task = functools.partial(run_in_log_context, get_log_context(), do_task)
+
+    if tasks and can_pipeline(tasks, options):
+        from corr.pipeline import ImagePipeline
+        pipeline = ImagePipeline(budget, worker_pool, num_workers)
+        results = run_pipelined_tasks(pipeline, tasks, manifests, progress, label)
+        return results, len(pipeline.cancelled_tasks), pipeline.stats
+
+    scheduler = MemoryAwareScheduler(budget, num_workers, executor=worker_pool)
+    results = run_scheduled_tasks(scheduler, tasks, do_task, manifests, progress, label)
+    return results, len(scheduler.cancelled_tasks), scheduler.stats
+
+
+# Which media pool CompleteCorrector runs each delegate's tasks in
+MEDIA_POOL_NAMES = {
+    "correct_slide" : "images",
+    "correct_print" : "images",
+    "correct_audio" : "audio",
+    "correct_vhs" : "vhs",
+}
+# Cores each VHS worker's ffmpeg re-encode is given; ffmpeg does the work, the worker mostly waits on it
+VHS_FFMPEG_THREADS_PER_WORKER = 4
+
+
+def get_media_pool_sizes(pool_names : List[str], num_cores : int, options : Dict[str, any]) -> Dict[str, int]:
+    """
+    Splits the cores between the media pools that have work. Images and audio get a worker per core of their share,
+    VHS gets one worker per VHS_FFMPEG_THREADS_PER_WORKER cores since ffmpeg is multi-threaded.
+    Each pool's size can be overridden with the "<pool name>Workers" option, e.g. "vhsWorkers".
+    """
+    cores_per_pool = max(1, num_cores // max(len(pool_names), 1))
+
+    pool_sizes = {}
+    for pool_name in pool_names:
+        if pool_name == "vhs":
+            pool_size = max(1, cores_per_pool // VHS_FFMPEG_THREADS_PER_WORKER)
+        else:
+            pool_size = cores_per_pool
+        pool_sizes[pool_name] = int(options.get(f"{pool_name}Workers", pool_size))
+
+    return pool_sizes
+
+
+def run_media_pools(
+tasks : List,
+do_task : Callable,
+options : Dict[str, any],
+manifests : ManifestTracker,
+progress : CorrectionProgress,
+summary : CorrectionSummary) -> List[CorrectResult]:
+    """
+    Runs each media type's tasks in its own, independently sized group of workers, all at the same time,
+    so a batch with mixed media finishes in about as long as its slowest media type.
+    The groups share one memory budget. Results and each group's scheduler stats are added to summary.
+    If a group fails, the first failure is raised once the other groups are done.
+
+    :returns: Every task's result, in the order they finished
+    """
+    tasks_by_pool : Dict[str, List] = {}
+    for task in tasks:
+        pool_name = MEDIA_POOL_NAMES[task.correct_file_delegate.__name__]
+        tasks_by_pool.setdefault(pool_name, []).append(task)
+
+    num_cores = os.cpu_count() or 1
+    pool_sizes = get_media_pool_sizes(list(tasks_by_pool), num_cores, options)
+    budget = MemoryBudget(get_memory_budget_bytes(options))
+    logger.info("Media pool sizes: %s", pool_sizes)
+
+    # Give each VHS worker's ffmpeg its share of the VHS pool's cores
+    if "vhs" in tasks_by_pool:
+        ffmpeg_threads = max(1, (num_cores // len(pool_sizes)) // pool_sizes["vhs"])
+        for task in tasks_by_pool["vhs"]:
+            task.options = task.options | {"vhsFfmpegThreads" : ffmpeg_threads}
+
+    all_results : List[CorrectResult] = []
+    summary_lock = threading.Lock()
+    def run_pool(pool_name : str):
+        results, num_cancelled, stats = run_task_group(
+            tasks_by_pool[pool_name], do_task, budget, pool_sizes[pool_name], options, manifests, progress, f"{pool_name} pool"
+        )
+        with summary_lock:
+            all_results.extend(results)
+            summary.add_results(results)
+            summary.cancelled += num_cancelled
+            summary.scheduler_stats[pool_name] = stats
+
+    # Each pool's thread starts with this thread's log context
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(tasks_by_pool)), thread_name_prefix="media-pool") as executor:
+        pool_futures = {
+            pool_name : executor.submit(contextvars.copy_context().run, run_pool, pool_name)
+            for pool_name in tasks_by_pool
+        }
+
+    # Raised once every pool is done, so the other pools' results are still in summary
+    errors = []
+    for pool_name, future in pool_futures.items():
+        error = future.exception()
+        if error is not None:
+            logger.error("The %s pool failed", pool_name, exc_info=error)
+            errors.append(error)
+    if errors:
+        raise errors[0]
+
+    return all_results
 
 
 @dataclass
@@ -36,9 +373,13 @@ class BaseCorrector:
     expected_extensions : List[str]
     correct_file_delegate : Callable[[str, str, Dict[str, any]], str]
     options : Dict[str, any]
+    progress : CorrectionProgress = field(default_factory=CorrectionProgress)
 
-    def correct_all_files(self):
-        """Corrects all files in from_folder_path, saving the results to to_folder_path."""
+    def correct_all_files(self) -> CorrectionSummary:
+        """
+        Corrects all files in from_folder_path, saving the results to to_folder_path.
+        Files already corrected with the same options are skipped unless the "force" option is set.
+        """
 
         for folder in [self.from_folder_path, self.to_folder_path]:
             if not (os.path.exists(folder)):
@@ -53,27 +394,30 @@ class BaseCorrector:
             split_file_name = file_name.split(".")
 
             if len(split_file_name) <= 1:
-                print(f"{full_file_path} does not have a file extension! Skipping it!")
+                logger.debug("%s does not have a file extension! Skipping it!", full_file_path)
                 continue
 
             file_extension = split_file_name[-1]
             if file_extension not in self.expected_extensions:
-                print(f"{full_file_path}'s extension \"{file_extension}\" was not one of {self.expected_extensions})! Skipping it!")
+                logger.debug("%s's extension \"%s\" was not one of %s! Skipping it!", full_file_path, file_extension, self.expected_extensions)
                 continue
             
             tasks.append(CorrectTask(full_file_path, self.to_folder_path, self.correct_file_delegate, self.options))
             
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_cores) as executor:
-            futures = {executor.submit(do_correct_task, task): task for task in tasks}
-
-            for future in concurrent.futures.as_completed(futures):
-                task_id = futures[future]
-                try:
-                    result = future.result()
-                except Exception as exc:
-                    print(f"Task {task_id} generated an exception: {exc}")
-                else:
-                    print(result)
+        summary = CorrectionSummary()
+        manifests = ManifestTracker()
+        tasks = start_batch(tasks, manifests, self.options, self.progress, summary)
+
+        budget = MemoryBudget(get_memory_budget_bytes(self.options))
+        try:
+            results, summary.cancelled, summary.scheduler_stats["all"] = run_task_group(
+                tasks, do_correct_task, budget, num_cores, self.options, manifests, self.progress, "Batch"
+            )
+            summary.add_results(results)
+        finally:
+            manifests.save_all()
+
+        return summary
 
 
 @dataclass
@@ -83,13 +427,13 @@ class CompleteCorrectTask:
     correct_file_delegate : Callable[[str, str, Dict[str, any]], str]
     options : Dict[str, any]
 
+    @property
+    def to_folder_path(self) -> str:
+        return self.to_folder
+
 
-def do_complete_correct_task(task : CompleteCorrectTask):
-    try:
-        saved_output_file_paths = task.correct_file_delegate(task.file_path, task.to_folder, task.options)
-        return f"Corrected {task.file_path}, saved to {saved_output_file_paths}"
-    except GenericProblem as e:
-        return f"Error correcting {task.file_path}: {e.get_problem}"
+def do_complete_correct_task(task : CompleteCorrectTask) -> CorrectResult:
+    return run_correct_delegate(task.file_path, task.to_folder, task.correct_file_delegate, task.options)
 
 
 @dataclass
@@ -99,6 +443,8 @@ class SingleFileCorrector:
     expected_extensions: List[str]
     correct_file_delegate: Callable[[str, str, Dict[str, any]], str]
     options: Dict[str, any] = field(default_factory=dict)
+    # Set once the file has been corrected, see corr.instrumentation
+    metrics: Optional[FileMetrics] = field(default=None, init=False)
     
     def correct_file(self) -> Tuple[bool, Union[str, Exception], Union[str, None]]:
         """
@@ -124,8 +470,12 @@ class SingleFileCorrector:
             if not os.path.exists(self.to_folder_path):
                 os.makedirs(self.to_folder_path, exist_ok=True)
             
-            # Correct the file
-            output_path = self.correct_file_delegate(self.file_path, self.to_folder_path, self.options)
+            # Correct the file in an already warm worker
+            output_path, self.metrics = get_worker_pool().submit(
+                run_in_log_context, get_log_context() | { "file" : self.file_path },
+                call_measured, self.correct_file_delegate, self.file_path, self.to_folder_path, self.options
+            ).result()
+            get_metrics_log().write(self.file_path, bool(output_path), self.metrics)
             
             return True, f"File corrected successfully: {output_path}", output_path
         except CustomException as e:
@@ -133,16 +483,101 @@ class SingleFileCorrector:
         except Exception as e:
             return False, e, None
 
+@dataclass
+class BatchFileItem:
+    file_path : str
+    to_folder_path : str
+    expected_extensions : List[str]
+    correct_file_delegate : Callable[[str, str, Dict[str, any]], str]
+    options : Dict[str, any] = field(default_factory=dict)
+
+
+def get_batch_item_problem(item : BatchFileItem) -> Optional[str]:
+    """Checks a file can be corrected the same way SingleFileCorrector does. Returns what's wrong, or None."""
+    if not os.path.exists(item.file_path):
+        return f"File not found: {item.file_path}"
+    file_extension = item.file_path.split('.')[-1].lower()
+    if file_extension not in item.expected_extensions:
+        return f"Invalid file extension: {file_extension}. Expected one of {item.expected_extensions}"
+    return None
+
+
+def order_results(file_paths : List[str], results : List[CorrectResult], known_results : Dict[int, CorrectResult]) -> List[CorrectResult]:
+    """
+    Puts results back in the order their files were given.
+
+    :param known_results: Results already tied to a position in file_paths, the rest are matched up by file path
+    """
+    results_by_path : Dict[str, List[CorrectResult]] = {}
+    for result in results:
+        results_by_path.setdefault(result.file_path, []).append(result)
+
+    ordered_results = []
+    for i, file_path in enumerate(file_paths):
+        if i in known_results:
+            ordered_results.append(known_results[i])
+        elif results_by_path.get(file_path):
+            ordered_results.append(results_by_path[file_path].pop(0))
+    return ordered_results
+
+
+@dataclass
+class BatchFileCorrector:
+    """
+    Corrects a list of individual files, each with its own media type, output folder and options,
+    spread over the worker pool the same way a project is. Like SingleFileCorrector, files are corrected
+    even if their output folder's manifest says they're up to date.
+    """
+    items : List[BatchFileItem]
+    # Options for the batch as a whole, e.g. memoryBudgetMb, each item's options are used to correct it
+    options : Dict[str, any] = field(default_factory=dict)
+    progress : CorrectionProgress = field(default_factory=CorrectionProgress)
+
+    def correct_files(self) -> Tuple[CorrectionSummary, List[CorrectResult]]:
+        """
+        Returns:
+            Tuple containing:
+            - summary: Counts of the files corrected, failed and cancelled
+            - results: Each file's result in the order the items were given, files cancelled before they started have none
+        """
+        tasks : List[CorrectTask] = []
+        # By the item's position in the batch
+        invalid_results : Dict[int, CorrectResult] = {}
+        for i, item in enumerate(self.items):
+            problem = get_batch_item_problem(item)
+            if problem is not None:
+                invalid_results[i] = CorrectResult(item.file_path, False, problem)
+                continue
+            os.makedirs(item.to_folder_path, exist_ok=True)
+            tasks.append(CorrectTask(item.file_path, item.to_folder_path, item.correct_file_delegate, item.options))
+
+        summary = CorrectionSummary()
+        self.progress.on_batch_started([item.file_path for item in self.items], [])
+        for result in invalid_results.values():
+            log_result(result)
+            self.progress.on_task_finished(result)
+        summary.add_results(list(invalid_results.values()))
+
+        manifests = ManifestTracker()
+        try:
+            results = run_media_pools(tasks, do_correct_task, self.options, manifests, self.progress, summary)
+        finally:
+            manifests.save_all()
+
+        return summary, order_results([item.file_path for item in self.items], results, invalid_results)
+
+
 @dataclass
 class CompleteCorrector:
     project_folder : str
     options : Dict[str, any] = field(default_factory=dict)
+    progress : CorrectionProgress = field(default_factory=CorrectionProgress)
 
     def correct_everything(self):
         try:       
             folders = os.listdir(self.project_folder)
         except Exception as e:
-            print(f"{self.project_folder} doenst exist")
+            logger.warning("%s doesn't exist", self.project_folder)
             raise FolderNotFound(self.project_folder)
         
         if "Raw" not in folders:
@@ -151,7 +586,7 @@ class CompleteCorrector:
         raw_folder_abs_dir = os.path.join(self.project_folder, "Raw")
         
         abs_raw_subdirs = [str(f.absolute()) for f in Path(raw_folder_abs_dir).iterdir() if f.is_dir()] + [raw_folder_abs_dir]
-        print(abs_raw_subdirs)
+        logger.debug("Correcting the folders %s", abs_raw_subdirs)
         
         tasks : List[CompleteCorrectTask] = []
         for abs_raw_subdir in abs_raw_subdirs:
@@ -183,14 +618,14 @@ class CompleteCorrector:
                 # Convert the file extension and naming of the file into 
                 file_name_lower = file_name.lower()
                 if file_extension == ".wav" or file_extension == ".mp3":
-                    correct_file_delegate = correct_audio
+                    correct_file_delegate = get_delegate("correct_audio")
                 elif file_extension == ".png" or file_extension == ".jpg" or file_extension == ".jpeg" or file_extension == ".tif":
                     if "_prints_" in file_name_lower:
-                        correct_file_delegate = correct_print
+                        correct_file_delegate = get_delegate("correct_print")
                     elif "_slides_" in file_name_lower:
-                        correct_file_delegate = correct_slide
+                        correct_file_delegate = get_delegate("correct_slide")
                 elif file_extension == ".mp4":
-                    correct_file_delegate = correct_vhs
+                    correct_file_delegate = get_delegate("correct_vhs")
 
                 if correct_file_delegate != None:
                     task = CompleteCorrectTask(
@@ -201,15 +636,12 @@ class CompleteCorrector:
                     )
                     tasks.append(task)
         
-        num_cores = os.cpu_count() or 1
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_cores) as executor:
-            futures = {executor.submit(do_complete_correct_task, task): task for task in tasks}
-
-            for future in concurrent.futures.as_completed(futures):
-                task_id = futures[future]
-                try:
-                    result = future.result()
-                except Exception as exc:
-                    print(f"Task {task_id} generated an exception: {exc}")
-                else:
-                    print(result)
+        summary = CorrectionSummary()
+        manifests = ManifestTracker()
+        tasks = start_batch(tasks, manifests, self.options, self.progress, summary)
+        try:
+            run_media_pools(tasks, do_complete_correct_task, self.options, manifests, self.progress, summary)
+        finally:
+            manifests.save_all()
+
+        return summary
@@ -1,23 +1,124 @@
 import math
+from typing import List, Tuple
 import cv2
 import numpy as np
 
-def apply_mask(matrix, mask, fill_value):
-    masked = np.ma.array(matrix, mask=mask, fill_value=fill_value)
-    return masked.filled()
+# cv2.calcHist returns float32 counts, which are only exact up to 2^24. Histograms are built from
+# bands of rows no bigger than this so every partial count stays exact before being summed as int64.
+HISTOGRAM_BAND_PIXELS = 1 << 22
 
 
-def apply_threshold(matrix, low_value, high_value):
-    low_mask = matrix < low_value
-    matrix = apply_mask(matrix, low_mask, low_value)
+def apply_threshold(matrix, low_value, high_value, out=None):
+    """Saturates values below low_value and above high_value. Pass out=matrix to do this in place."""
+    return np.clip(matrix, low_value, high_value, out=out)
 
-    high_mask = matrix > high_value
-    matrix = apply_mask(matrix, high_mask, high_value)
 
-    return matrix
+def get_histogram_bins(img: np.ndarray) -> int:
+    """Returns how many histogram bins are needed to count every possible value of img's dtype."""
+    if img.dtype == np.uint8:
+        return 256
+    if img.dtype == np.uint16:
+        return 65536
+    raise ValueError(f"Unsupported image dtype for color balancing: {img.dtype}")
 
 
-def simplest_cb(img, percent):
+def get_channel_histograms(img: np.ndarray) -> np.ndarray:
+    """
+    Counts the values of each channel of an interleaved image.
+
+    :returns: An int64 array of shape (channels, bins)
+    """
+    bins = get_histogram_bins(img)
+    height, width, num_channels = img.shape
+    histograms = np.zeros((num_channels, bins), dtype=np.int64)
+
+    band_height = max(1, HISTOGRAM_BAND_PIXELS // max(width, 1))
+    for band_start in range(0, height, band_height):
+        band = img[band_start:band_start + band_height]
+        for channel_i in range(num_channels):
+            histogram = cv2.calcHist([band], [channel_i], None, [bins], [0, bins])
+            histograms[channel_i] += histogram.ravel().astype(np.int64)
+
+    return histograms
+
+
+def get_value_at_sorted_index(cumulative_histogram: np.ndarray, index: int) -> int:
+    """Returns the value that would be at index if the counted values were sorted."""
+    return int(np.searchsorted(cumulative_histogram, index, side="right"))
+
+
+def get_cut_points(histogram: np.ndarray, half_percent: float) -> Tuple[int, int]:
+    """
+    Finds the low and high percentile values of a channel from its histogram.
+    Indexes the same way a fully sorted channel would be indexed, so results match sorting exactly.
+    """
+    cumulative_histogram = np.cumsum(histogram)
+    n_cols = int(cumulative_histogram[-1])
+
+    low_val = get_value_at_sorted_index(cumulative_histogram, math.floor(n_cols * half_percent))
+    # Same bandaid as sorting: if the high index falls off the end, use the last value instead
+    high_index = math.ceil(n_cols * (1.0 - half_percent))
+    if high_index >= n_cols:
+        high_index = n_cols - 1
+    high_val = get_value_at_sorted_index(cumulative_histogram, high_index)
+
+    return low_val, high_val
+
+
+def make_stretch_lut(bins: int, dtype: np.dtype, low_val: int, high_val: int) -> np.ndarray:
+    """
+    Builds a lookup table that saturates values outside of [low_val, high_val] and scales the rest to 0-255.
+    The table is scaled with cv2.normalize so rounding is identical to normalizing the whole channel.
+    """
+    lut = np.clip(np.arange(bins), low_val, high_val).astype(dtype)
+    return cv2.normalize(lut, lut.copy(), 0, 255, cv2.NORM_MINMAX)
+
+
+def get_stretch_luts(img: np.ndarray, percent: float) -> List[np.ndarray]:
+    """Returns one stretch lookup table per channel of img."""
+    half_percent = percent / 200.0
+    bins = get_histogram_bins(img)
+
+    luts = []
+    for histogram in get_channel_histograms(img):
+        low_val, high_val = get_cut_points(histogram, half_percent)
+        luts.append(make_stretch_lut(bins, img.dtype, low_val, high_val))
+
+    return luts
+
+
+def simplest_cb(img, percent, out=None):
+    """
+    Stretches each channel so that percent / 2 of its values saturate at either end.
+    Cut points come from per-channel histograms and the clip and scale are fused into one lookup table
+    pass over the interleaved image, so channels are never split, merged or masked.
+
+    :param out: Optional preallocated array to write into. Pass out=img to color balance in place,
+        which avoids allocating a second full-size image.
+    """
+    assert img.shape[2] == 3
+    assert percent > 0 and percent < 100
+
+    luts = get_stretch_luts(img, percent)
+
+    if out is None:
+        out = np.empty_like(img)
+
+    if img.dtype == np.uint8:
+        # cv2.LUT applies a (1, 256, 3) table to all three channels in one pass
+        cv2.LUT(img, np.dstack(luts), dst=out)
+        return out
+
+    for channel_i, lut in enumerate(luts):
+        np.take(lut, img[..., channel_i], out=out[..., channel_i], mode="clip")
+    return out
+
+
+def simplest_cb_sorted(img, percent):
+    """
+    Original sort-based implementation of simplest_cb.
+    Kept as a reference to check and benchmark simplest_cb against.
+    """
     assert img.shape[2] == 3
     assert percent > 0 and percent < 100
 
@@ -49,7 +150,7 @@ def simplest_cb(img, percent):
         # saturate below the low percentile and above the high percentile
         thresholded = apply_threshold(channel, low_val, high_val)
         # scale the channel
-        normalized = cv2.normalize(thresholded, thresholded.copy(), 0, 255, cv2.NORM_MINMAX)
+        normalized = cv2.normalize(thresholded, thresholded, 0, 255, cv2.NORM_MINMAX)
         out_channels.append(normalized)
 
-    return cv2.merge(out_channels)
\ No newline at end of file
+    return cv2.merge(out_channels)
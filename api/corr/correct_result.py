@@ -0,0 +1,26 @@
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from corr.instrumentation import FileMetrics
+
+
+@dataclass
+class CorrectResult:
+    """The outcome of correcting one file."""
+    file_path : str
+    success : bool
+    message : str
+    output_paths : List[str] = field(default_factory=list)
+    duration_seconds : float = 0
+    # How correcting the file went, stage by stage, see corr.instrumentation. None if it was never corrected
+    metrics : FileMetrics = None
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "file_path" : self.file_path,
+            "success" : self.success,
+            "message" : self.message,
+            "output_paths" : self.output_paths,
+            "duration_seconds" : round(self.duration_seconds, 2),
+            "metrics" : self.metrics.to_dict() if self.metrics is not None else None,
+        }
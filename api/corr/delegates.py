@@ -0,0 +1,60 @@
+from dataclasses import dataclass
+import importlib
+from typing import Callable, Dict, List
+
+"""
+    - The correction delegates pull in cv2, numpy, librosa, pydub and soundfile. They're registered here by name
+    and their modules are only imported the first time one is called, so the server starts without any of them
+    and a worker only imports the libraries of the media it's actually given.
+    - A LazyDelegate stands in for its function everywhere one is expected: it has the function's __name__, which
+    manifests, memory estimates and media pools key on, and it pickles as just its names when sent to a worker.
+"""
+
+
+@dataclass
+class LazyDelegate:
+    """A function found by name in a module that isn't imported until the function is first called."""
+    name : str
+    module_name : str
+
+    def __post_init__(self):
+        self.__name__ = self.name
+
+    def resolve(self) -> Callable:
+        return getattr(importlib.import_module(self.module_name), self.name)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+
+# Keyed by name, each takes the file to correct, the folder to save to and the options, returning the saved paths
+CORRECT_DELEGATES : Dict[str, LazyDelegate] = {
+    "correct_slide" : LazyDelegate("correct_slide", "corr.slides.slides_correct"),
+    "correct_print" : LazyDelegate("correct_print", "corr.prints.prints_correct"),
+    "correct_audio" : LazyDelegate("correct_audio", "corr.audio.audio_correct"),
+    "correct_vhs" : LazyDelegate("correct_vhs", "corr.video.vhs_correct"),
+}
+
+# Keyed by the name of the correct_file_delegate a task uses, each corrects an already decoded scan, see corr.pipeline
+PIXEL_CORRECTORS : Dict[str, LazyDelegate] = {
+    "correct_slide" : LazyDelegate("correct_slide_pixels", "corr.slides.slides_correct"),
+    "correct_print" : LazyDelegate("correct_print_pixels", "corr.prints.prints_correct"),
+}
+
+
+def get_delegate(name : str) -> LazyDelegate:
+    """Raises a KeyError if no delegate is called name."""
+    return CORRECT_DELEGATES[name]
+
+
+def get_delegate_modules(names : List[str] = None) -> List[str]:
+    """The modules the named delegates, or all of them, live in."""
+    delegates = CORRECT_DELEGATES.values() if names is None else [get_delegate(name) for name in names]
+    return list(dict.fromkeys(delegate.module_name for delegate in delegates))
+
+
+def can_pipeline(tasks : List, options : Dict[str, any]) -> bool:
+    """Checks whether every task can go through the pipeline, unless the imagesDisablePipeline option is set."""
+    if (options or {}).get("imagesDisablePipeline", False):
+        return False
+    return all(task.correct_file_delegate.__name__ in PIXEL_CORRECTORS for task in tasks)
@@ -10,4 +10,21 @@ class FolderNotFound(CustomException):
 
 class NoRawFolderToCorrectFrom(CustomException):
     def get_response(self) -> Response:
-        return self._make_error_response(f"No \"Raw\" folder exists to correct from!", 404)
\ No newline at end of file
+        return self._make_error_response(f"No \"Raw\" folder exists to correct from!", 404)
+
+class JobNotFound(CustomException):
+    """Args consist of the id of the job that was not found"""
+    def get_response(self) -> Response:
+        return self._make_error_response(f"No correction job with the id {self.args[0]} could be found", 404)
+
+
+class JobAlreadyFinished(CustomException):
+    """Args consist of the id of the job that already finished"""
+    def get_response(self) -> Response:
+        return self._make_error_response(f"Correction job {self.args[0]} has already finished", 409)
+
+
+class InvalidBatchRequest(CustomException):
+    """Args consist of what's wrong with the request's list of files"""
+    def get_response(self) -> Response:
+        return self._make_error_response(f"Invalid batch of files to correct: {self.args[0]}", 400)
@@ -0,0 +1,141 @@
+from dataclasses import dataclass
+import os
+import struct
+from typing import Callable, Dict, Optional, Tuple
+import cv2
+import numpy as np
+from PIL import Image
+
+"""
+    - Scans are decoded once, by OpenCV, straight into a BGR numpy array, and stay BGR until they're written.
+    The DPI comes from the file's header through PIL, which never decodes the pixels.
+    - Uncompressed 8-bit RGB TIFFs, which scanners usually write, are read straight from the file into the array
+    instead. OpenCV's TIFF decoder holds extra copies of each strip, and a scan is often written as a single strip.
+    - JPEGs and TIFFs are encoded by OpenCV straight from the BGR array. OpenCV can't write a JPEG's DPI,
+    so it's patched into the JFIF header of the encoded bytes. Other formats go through PIL, which costs
+    an RGB copy and PIL's own copy of the pixels.
+"""
+
+JPEG_QUALITY = 95
+JPEG_EXTENSIONS = {".jpg", ".jpeg"}
+TIFF_EXTENSIONS = {".tif", ".tiff"}
+# JFIF density units for dots per inch
+JFIF_UNITS_DPI = 1
+# OpenCV's value for IMWRITE_TIFF_COMPRESSION meaning none, PIL saves uncompressed TIFFs by default too
+TIFF_COMPRESSION_NONE = 1
+# OpenCV's value for IMWRITE_TIFF_RESUNIT meaning inches
+TIFF_RESOLUTION_UNIT_INCH = 2
+
+ArrayAllocator = Callable[[Tuple[int, ...], np.dtype], np.ndarray]
+
+
+@dataclass
+class ScanImage:
+    """A decoded scan, in OpenCV's BGR channel order, and the DPI it was scanned at if its file had one."""
+    pixels : np.ndarray
+    dpi : Optional[Tuple[float, float]]
+
+
+def get_dpi_from_info(info : Dict[str, any]) -> Optional[Tuple[float, float]]:
+    dpi = info.get("dpi")
+    if not dpi or not dpi[0]:
+        return None
+    return (float(dpi[0]), float(dpi[1]))
+
+
+def read_dpi(path : str) -> Optional[Tuple[float, float]]:
+    """Reads an image's DPI from its header without decoding its pixels."""
+    with Image.open(path) as image:
+        return get_dpi_from_info(image.info)
+
+
+def is_raw_rgb_tiff(image : Image.Image) -> bool:
+    """Checks whether every strip of an opened TIFF is uncompressed, top-down, 8-bit RGB rows spanning its whole width."""
+    if image.format != "TIFF" or image.mode != "RGB" or getattr(image, "n_frames", 1) != 1:
+        return False
+    return all(
+        tile[0] == "raw" and tile[1][0] == 0 and tile[1][2] == image.width and tuple(tile[3]) == ("RGB", 0, 1)
+        for tile in image.tile
+    )
+
+
+def read_raw_rgb_tiff(path : str, image : Image.Image, allocate : ArrayAllocator = np.empty) -> np.ndarray:
+    """Reads an uncompressed RGB TIFF's strips straight into a BGR array."""
+    pixels = allocate((image.height, image.width, 3), np.uint8)
+    with open(path, "rb") as file:
+        for _, (_, top, _, bottom), offset, _ in image.tile:
+            file.seek(offset)
+            if file.readinto(memoryview(pixels[top:bottom]).cast("B")) != pixels[top:bottom].nbytes:
+                raise ValueError(f"{path} ended part way through its pixels")
+    cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR, dst=pixels)
+    return pixels
+
+
+def read_scan(path : str, allocate : ArrayAllocator = None) -> ScanImage:
+    """
+    Decodes an image once into a BGR array, along with its DPI.
+
+    :param allocate: Makes the array the pixels end up in from a shape and dtype, e.g. to put them in shared memory.
+    Raw TIFFs are read straight into it, anything else is decoded then copied in.
+    """
+    with Image.open(path) as image:
+        dpi = get_dpi_from_info(image.info)
+        if is_raw_rgb_tiff(image):
+            return ScanImage(read_raw_rgb_tiff(path, image, allocate or np.empty), dpi)
+
+    pixels = cv2.imread(path, cv2.IMREAD_COLOR)
+    if pixels is None:
+        raise ValueError(f"Could not decode the image {path}")
+    if allocate is not None:
+        allocated = allocate(pixels.shape, pixels.dtype)
+        np.copyto(allocated, pixels)
+        pixels = allocated
+    return ScanImage(pixels, dpi)
+
+
+def set_jpeg_dpi(encoded : np.ndarray, dpi : Tuple[float, float]) -> bytes:
+    """Writes dpi into an encoded JPEG's JFIF header, adding the header if the encoder didn't write one."""
+    data = encoded.tobytes()
+    density = struct.pack(">BHH", JFIF_UNITS_DPI, round(dpi[0]), round(dpi[1]))
+
+    # SOI, then APP0: marker, length, "JFIF\0", version, then the density fields
+    if data[2:4] == b"\xff\xe0" and data[6:11] == b"JFIF\x00":
+        return data[:13] + density + data[18:]
+
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00\x01\x01" + density + b"\x00\x00"
+    return data[:2] + app0 + data[2:]
+
+
+def write_scan(path : str, pixels : np.ndarray, dpi : Optional[Tuple[float, float]]):
+    """
+    Saves a BGR image, keeping its DPI if it has one. JPEGs are saved at JPEG_QUALITY without chroma subsampling.
+
+    :param path: Where to save the image, its extension decides the format
+    :param pixels: The image in BGR channel order
+    :param dpi: The DPI to save in the file's header, or None to leave it out
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in JPEG_EXTENSIONS:
+        params = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY, cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444]
+        could_encode, encoded = cv2.imencode(extension, pixels, params)
+        if not could_encode:
+            raise ValueError(f"Could not encode {path}")
+        with open(path, "wb") as file:
+            file.write(set_jpeg_dpi(encoded, dpi) if dpi else encoded.tobytes())
+
+    elif extension in TIFF_EXTENSIONS:
+        params = [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSION_NONE]
+        if dpi:
+            params += [
+                cv2.IMWRITE_TIFF_RESUNIT, TIFF_RESOLUTION_UNIT_INCH,
+                cv2.IMWRITE_TIFF_XDPI, round(dpi[0]),
+                cv2.IMWRITE_TIFF_YDPI, round(dpi[1])
+            ]
+        if not cv2.imwrite(path, pixels, params):
+            raise ValueError(f"Could not encode {path}")
+
+    else:
+        pil_image = Image.fromarray(cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB))
+        save_params = { "dpi" : dpi } if dpi else {}
+        pil_image.save(path, subsampling=0, quality=JPEG_QUALITY, **save_params)
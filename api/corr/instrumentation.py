@@ -0,0 +1,275 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import psutil
+
+from mwlocal.helpers import get_setting
+
+"""
+    - Each file corrected gets a FileMetrics: how long each stage of correcting it took, the peak RSS of the process
+    that corrected it and how many bytes were read and written. Delegates time their stages with
+    `with stage("decode"):`, which records into the file being measured by measure_file on the same thread, and
+    does nothing when nothing is, e.g. when a delegate is called from a script.
+    - Stages are named after what they do, so they can be compared across media: decode, detect, warp,
+    color_balance, gain, encode and ffmpeg (a transcode run by ffmpeg).
+    - On Linux the peak RSS is exact: the kernel's high water mark is reset before each file. Elsewhere it's the
+    largest RSS seen at the end of any stage. Either way it's only the correcting process, not the ffmpeg it runs.
+    - Metrics come back with each CorrectResult, are added up per batch in its CorrectionSummary (and so per job),
+    and every file's are appended to the JSON lines log in CORRECTION_METRICS_LOG, see mwlocal/settings.py.
+"""
+
+logger = logging.getLogger(__name__)
+
+STAGE_DECODE = "decode"
+STAGE_DETECT = "detect"
+STAGE_WARP = "warp"
+STAGE_COLOR_BALANCE = "color_balance"
+STAGE_GAIN = "gain"
+STAGE_ENCODE = "encode"
+STAGE_FFMPEG = "ffmpeg"
+
+# Writing this to /proc/self/clear_refs resets the process's peak RSS, VmHWM in /proc/self/status
+CLEAR_PEAK_RSS = "5"
+
+# The metrics of the file being corrected on each thread
+CURRENT = threading.local()
+
+
+@dataclass
+class StageStats:
+    seconds : float = 0
+    max_seconds : float = 0
+    count : int = 0
+
+    def add(self, seconds : float):
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.count += 1
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "total_seconds" : round(self.seconds, 2),
+            "average_seconds" : round(self.seconds / self.count, 3) if self.count else 0,
+            "max_seconds" : round(self.max_seconds, 3),
+        }
+
+
+@dataclass
+class FileMetrics:
+    """How correcting one file went, see the notes at the top."""
+    delegate_name : str
+    # Seconds spent in each stage, in the order they first ran
+    stage_seconds : Dict[str, float] = field(default_factory=dict)
+    peak_rss_bytes : int = 0
+    bytes_read : int = 0
+    bytes_written : int = 0
+    # Anything else worth keeping about the file, e.g. where a VHS was trimmed
+    details : Dict[str, any] = field(default_factory=dict)
+
+    def add_stage(self, name : str, seconds : float):
+        self.stage_seconds[name] = self.stage_seconds.get(name, 0) + seconds
+
+    def merge(self, other : "FileMetrics"):
+        """Adds in metrics measured for the same file elsewhere, e.g. in the worker that corrected a pipelined scan."""
+        for name, seconds in other.stage_seconds.items():
+            self.add_stage(name, seconds)
+        self.peak_rss_bytes = max(self.peak_rss_bytes, other.peak_rss_bytes)
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.details.update(other.details)
+
+    def record_file_sizes(self, file_path : str, output_paths : List[str]):
+        self.bytes_read = get_file_size(file_path)
+        self.bytes_written = sum(get_file_size(output_path) for output_path in output_paths or [])
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "delegate" : self.delegate_name,
+            "stage_seconds" : {name : round(seconds, 3) for name, seconds in self.stage_seconds.items()},
+            "peak_rss_mb" : round(self.peak_rss_bytes / (1024 * 1024), 1),
+            "bytes_read" : self.bytes_read,
+            "bytes_written" : self.bytes_written,
+            "details" : self.details,
+        }
+
+
+@dataclass
+class MetricsSummary:
+    """Metrics of many files added together."""
+    files : int = 0
+    stages : Dict[str, StageStats] = field(default_factory=dict)
+    peak_rss_bytes : int = 0
+    bytes_read : int = 0
+    bytes_written : int = 0
+
+    def add(self, metrics : FileMetrics):
+        self.files += 1
+        for name, seconds in metrics.stage_seconds.items():
+            self.stages.setdefault(name, StageStats()).add(seconds)
+        self.peak_rss_bytes = max(self.peak_rss_bytes, metrics.peak_rss_bytes)
+        self.bytes_read += metrics.bytes_read
+        self.bytes_written += metrics.bytes_written
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "files" : self.files,
+            "stages" : {name : stats.to_dict() for name, stats in self.stages.items()},
+            "peak_rss_mb" : round(self.peak_rss_bytes / (1024 * 1024), 1),
+            "mb_read" : round(self.bytes_read / (1024 * 1024), 1),
+            "mb_written" : round(self.bytes_written / (1024 * 1024), 1),
+        }
+
+
+@dataclass
+class CorrectionMetrics:
+    """The metrics of a batch or job, in total and by delegate."""
+    total : MetricsSummary = field(default_factory=MetricsSummary)
+    by_delegate : Dict[str, MetricsSummary] = field(default_factory=dict)
+
+    def add(self, metrics : FileMetrics):
+        self.total.add(metrics)
+        self.by_delegate.setdefault(metrics.delegate_name, MetricsSummary()).add(metrics)
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "total" : self.total.to_dict(),
+            "by_delegate" : {name : summary.to_dict() for name, summary in self.by_delegate.items()},
+        }
+
+
+def get_file_size(path : str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def get_current_metrics() -> Optional[FileMetrics]:
+    return getattr(CURRENT, "metrics", None)
+
+
+def reset_peak_rss() -> bool:
+    """Resets this process's peak RSS so it can be read per file. Returns False where that isn't possible."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write(CLEAR_PEAK_RSS)
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss_bytes() -> Optional[int]:
+    """This process's peak RSS since it was last reset, on Linux."""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_rss_bytes() -> int:
+    try:
+        return psutil.Process().memory_info().rss
+    except psutil.Error:
+        return 0
+
+
+@contextmanager
+def stage(name : str) -> Iterator[None]:
+    """Times a stage of correcting a file into the file being measured on this thread, if there is one."""
+    metrics = get_current_metrics()
+    if metrics is None:
+        yield
+        return
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_stage(name, time.perf_counter() - start_time)
+        metrics.peak_rss_bytes = max(metrics.peak_rss_bytes, get_rss_bytes())
+
+
+def record_detail(name : str, value : any):
+    """Keeps something about the file being measured on this thread, if there is one."""
+    metrics = get_current_metrics()
+    if metrics is not None:
+        metrics.details[name] = value
+
+
+@contextmanager
+def measure_file(delegate_name : str) -> Iterator[FileMetrics]:
+    """Measures correcting a file on this thread. Stages run inside are recorded into the metrics it yields."""
+    metrics = FileMetrics(delegate_name)
+    previous_metrics = get_current_metrics()
+    CURRENT.metrics = metrics
+    can_read_peak = reset_peak_rss()
+    try:
+        yield metrics
+    finally:
+        CURRENT.metrics = previous_metrics
+        peak_rss_bytes = read_peak_rss_bytes() if can_read_peak else None
+        metrics.peak_rss_bytes = max(metrics.peak_rss_bytes, peak_rss_bytes or get_rss_bytes())
+
+
+def call_measured(delegate : Callable[[str, str, Dict[str, any]], List[str]], file_path : str, to_folder_path : str, options : Dict[str, any]) -> Tuple[List[str], FileMetrics]:
+    """
+    Runs a correction delegate, measuring it. Exceptions are raised as they are, without the metrics.
+
+    :returns: What the delegate returned, and its metrics
+    """
+    with measure_file(delegate.__name__) as metrics:
+        output_paths = delegate(file_path, to_folder_path, options)
+    metrics.record_file_sizes(file_path, output_paths)
+    return output_paths, metrics
+
+
+@dataclass
+class MetricsLog:
+    """Appends a JSON line for each file corrected. Shared by every batch in the server."""
+    path : str = None
+    lock : threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        if self.path is None:
+            self.path = get_setting("CORRECTION_METRICS_LOG", None)
+
+    def write(self, file_path : str, success : bool, metrics : FileMetrics, context : Dict[str, any] = None):
+        if not self.path:
+            return
+
+        line = {
+            "time" : datetime.datetime.now().isoformat(),
+            "file_path" : file_path,
+            "success" : success,
+        } | (context or {}) | metrics.to_dict()
+        try:
+            with self.lock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                with open(self.path, "a") as file:
+                    file.write(json.dumps(line) + "\n")
+        except OSError as e:
+            logger.warning("Could not write correction metrics to %s: %s", self.path, e)
+
+
+METRICS_LOG : MetricsLog = None
+METRICS_LOG_LOCK = threading.Lock()
+
+
+def get_metrics_log() -> MetricsLog:
+    """The process-wide log, made on first use so it picks up Django's settings."""
+    global METRICS_LOG
+    with METRICS_LOG_LOCK:
+        if METRICS_LOG is None:
+            METRICS_LOG = MetricsLog()
+        return METRICS_LOG
@@ -0,0 +1,264 @@
+from dataclasses import dataclass, field
+import concurrent.futures
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Set
+
+from corr.base_correct import CorrectionProgress, CorrectionSummary, CorrectResult
+from corr.exceptions import JobAlreadyFinished, JobNotFound
+from corr.instrumentation import CorrectionMetrics
+from mwlocal.helpers import CustomException
+from mwlocal.logs import log_context
+
+"""
+    - Correcting a batch can take hours, so the job endpoints run batches in the background and return a job id
+    straight away. The job is then polled for progress and results, or cancelled.
+    - Jobs run one at a time, since each batch already uses every core. Later jobs wait in the queue.
+    - Jobs only live in memory, restarting the server forgets them.
+    - Each job also keeps a numbered log of events (files finishing, state changes) that the events endpoint streams
+    to clients as Server-Sent Events. Clients reconnecting with Last-Event-ID pick up where they left off.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Batches run at once, each already runs its own process pools
+MAX_RUNNING_JOBS = 1
+# Finished jobs kept around so their results can still be fetched
+MAX_FINISHED_JOBS = 20
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_CANCELLING = "cancelling"
+JOB_CANCELLED = "cancelled"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+FINISHED_JOB_STATES = {JOB_CANCELLED, JOB_DONE, JOB_FAILED}
+
+FILE_QUEUED = "queued"
+FILE_RUNNING = "running"
+FILE_DONE = "done"
+FILE_FAILED = "failed"
+FILE_SKIPPED = "skipped"
+FILE_CANCELLED = "cancelled"
+FINISHED_FILE_STATES = {FILE_DONE, FILE_FAILED}
+
+
+@dataclass
+class CorrectionJob(CorrectionProgress):
+    job_id : str
+    description : str
+    state : str = JOB_QUEUED
+    # Every file in the batch, in the order the batch found them
+    file_statuses : Dict[str, str] = field(default_factory=dict)
+    results : List[CorrectResult] = field(default_factory=list)
+    # Added to as each file finishes, so it can be looked at while the job runs
+    metrics : CorrectionMetrics = field(default_factory=CorrectionMetrics)
+    summary : CorrectionSummary = None
+    error : str = None
+    created_time : float = field(default_factory=time.time)
+    start_time : float = None
+    end_time : float = None
+    # Each event is a dict of its "id", "event" type and "data"
+    events : List[Dict[str, any]] = field(default_factory=list, repr=False)
+    cancel_event : threading.Event = field(default_factory=threading.Event, repr=False)
+    lock : threading.Lock = field(default_factory=threading.Lock, repr=False)
+    state_lock : threading.Lock = field(default_factory=threading.Lock, repr=False)
+    events_changed : threading.Condition = field(default_factory=threading.Condition, repr=False)
+
+    def add_event(self, event_type : str, data : Dict[str, any]):
+        with self.events_changed:
+            self.events.append({ "id" : len(self.events), "event" : event_type, "data" : data })
+            self.events_changed.notify_all()
+
+    def wait_for_events(self, first_event_id : int, timeout : float) -> List[Dict[str, any]]:
+        """Returns the events from first_event_id on, waiting up to timeout seconds for one if there are none yet."""
+        with self.events_changed:
+            self.events_changed.wait_for(lambda: len(self.events) > first_event_id, timeout)
+            return self.events[first_event_id:]
+
+    def has_no_more_events(self, first_event_id : int) -> bool:
+        """Whether the job finished and there are no events from first_event_id on, so none will ever come."""
+        # set_state adds the finishing state's event before releasing state_lock
+        with self.state_lock:
+            return self.is_finished() and len(self.events) <= first_event_id
+
+    def set_state(self, state : str, from_states : Set[str] = None) -> bool:
+        """Changes the job's state, unless from_states is given and the job isn't in one of them. Returns if it changed."""
+        with self.state_lock:
+            if from_states is not None and self.state not in from_states:
+                return False
+            self.state = state
+            self.add_event("state", { "state" : state, "error" : self.error, "progress" : self.get_progress() })
+            return True
+
+    def on_batch_started(self, file_paths : List[str], skipped_file_paths : List[str]):
+        with self.lock:
+            for file_path in file_paths:
+                self.file_statuses[file_path] = FILE_QUEUED
+            for file_path in skipped_file_paths:
+                self.file_statuses[file_path] = FILE_SKIPPED
+
+    def on_task_started(self, file_path : str):
+        with self.lock:
+            self.file_statuses[file_path] = FILE_RUNNING
+
+    def on_task_finished(self, result : CorrectResult):
+        with self.lock:
+            self.file_statuses[result.file_path] = FILE_DONE if result.success else FILE_FAILED
+            self.results.append(result)
+            if result.metrics is not None:
+                self.metrics.add(result.metrics)
+        self.add_event("file", result.to_dict() | { "progress" : self.get_progress() })
+
+    def on_task_cancelled(self, file_path : str):
+        with self.lock:
+            self.file_statuses[file_path] = FILE_CANCELLED
+
+    def is_cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def get_log_context(self) -> Dict[str, any]:
+        return { "job_id" : self.job_id }
+
+    def is_finished(self) -> bool:
+        return self.state in FINISHED_JOB_STATES
+
+    def get_elapsed_seconds(self) -> float:
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+    def get_progress(self) -> Dict[str, any]:
+        """Counts files by status and works out the throughput and how long is left at that rate."""
+        with self.lock:
+            status_counts = {status : 0 for status in [FILE_QUEUED, FILE_RUNNING, FILE_DONE, FILE_FAILED, FILE_SKIPPED, FILE_CANCELLED]}
+            for status in self.file_statuses.values():
+                status_counts[status] += 1
+
+        # Skipped files take no time, leave them out of the rate
+        total_to_correct = len(self.file_statuses) - status_counts[FILE_SKIPPED]
+        num_finished = sum(status_counts[status] for status in FINISHED_FILE_STATES)
+        elapsed_seconds = self.get_elapsed_seconds()
+        files_per_second = num_finished / elapsed_seconds if elapsed_seconds > 0 else 0
+        num_remaining = status_counts[FILE_QUEUED] + status_counts[FILE_RUNNING]
+
+        return {
+            "total_files" : len(self.file_statuses),
+            "file_counts" : status_counts,
+            "percent_done" : round(100 * num_finished / total_to_correct, 1) if total_to_correct else (100 if self.is_finished() else 0),
+            "elapsed_seconds" : round(elapsed_seconds, 2),
+            "files_per_second" : round(files_per_second, 3),
+            "eta_seconds" : round(num_remaining / files_per_second) if files_per_second > 0 and num_remaining else None,
+        }
+
+    def get_metrics(self) -> Dict[str, any]:
+        """The job's metrics so far, in total, by delegate and for each file finished."""
+        with self.lock:
+            return {
+                "job_id" : self.job_id,
+                "state" : self.state,
+                "metrics" : self.metrics.to_dict(),
+                "files" : [
+                    { "file_path" : result.file_path, "success" : result.success } | result.metrics.to_dict()
+                    for result in self.results if result.metrics is not None
+                ],
+            }
+
+    def to_dict(self, include_files : bool = False, include_results : bool = False) -> Dict[str, any]:
+        data = {
+            "job_id" : self.job_id,
+            "description" : self.description,
+            "state" : self.state,
+            "error" : self.error,
+            "created_time" : self.created_time,
+            "progress" : self.get_progress(),
+            "summary" : self.summary.to_dict() if self.summary is not None else None,
+        }
+        with self.lock:
+            if include_files:
+                data["files"] = dict(self.file_statuses)
+            if include_results:
+                data["results"] = [result.to_dict() for result in self.results]
+        return data
+
+
+@dataclass
+class JobManager:
+    """Runs correction batches in the background and keeps track of them by job id."""
+    jobs : Dict[str, CorrectionJob] = field(default_factory=dict)
+    executor : concurrent.futures.ThreadPoolExecutor = field(
+        default_factory=lambda: concurrent.futures.ThreadPoolExecutor(max_workers=MAX_RUNNING_JOBS, thread_name_prefix="correction-job"),
+        repr=False
+    )
+    lock : threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def submit(self, description : str, run_batch : Callable[[CorrectionJob], CorrectionSummary]) -> CorrectionJob:
+        """
+        Queues run_batch to run in the background.
+
+        :param run_batch: Runs the batch, reporting its progress to the job it's given
+        """
+        job = CorrectionJob(uuid.uuid4().hex, description)
+        job.set_state(JOB_QUEUED)
+        with self.lock:
+            self.forget_old_jobs()
+            self.jobs[job.job_id] = job
+        self.executor.submit(self.run_job, job, run_batch)
+        return job
+
+    def run_job(self, job : CorrectionJob, run_batch : Callable[[CorrectionJob], CorrectionSummary]):
+        with log_context(job_id=job.job_id):
+            if job.is_cancelled():
+                job.set_state(JOB_CANCELLED)
+                return
+
+            logger.info("Starting correction job %s (%s)", job.job_id, job.description)
+            job.start_time = time.time()
+            job.set_state(JOB_RUNNING)
+            final_state = JOB_FAILED
+            try:
+                job.summary = run_batch(job)
+                final_state = JOB_CANCELLED if job.summary.cancelled else JOB_DONE
+            except CustomException as e:
+                job.error = e.get_response().data["message"]
+            except Exception as e:
+                logger.exception("Correction job %s failed", job.job_id)
+                job.error = f"Error: {e}"
+            finally:
+                job.end_time = time.time()
+                job.set_state(final_state)
+                logger.info("Correction job %s (%s) finished as %s", job.job_id, job.description, job.state)
+
+    def get_job(self, job_id : str) -> CorrectionJob:
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise JobNotFound(job_id)
+        return job
+
+    def list_jobs(self) -> List[CorrectionJob]:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id : str) -> CorrectionJob:
+        """
+        Stops a job from starting any more files. Files already being corrected are left to finish,
+        since killing a worker part way through could leave half written files behind.
+        """
+        job = self.get_job(job_id)
+        if job.is_finished():
+            raise JobAlreadyFinished(job_id)
+
+        job.cancel_event.set()
+        job.set_state(JOB_CANCELLING, from_states={JOB_RUNNING})
+        return job
+
+    def forget_old_jobs(self):
+        finished_jobs = sorted((job for job in self.jobs.values() if job.is_finished()), key=lambda job: job.created_time)
+        for job in finished_jobs[:max(0, len(finished_jobs) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job.job_id]
+
+
+JOB_MANAGER = JobManager()
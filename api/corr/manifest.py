@@ -0,0 +1,171 @@
+from dataclasses import dataclass, field
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List
+
+"""
+    - Each output folder gets a manifest of the files corrected into it, so re-running a correction only redoes files
+    that changed (or whose options changed) since they were last corrected.
+    - Final checks skip the manifest, see MANIFEST_FILE_NAME.
+"""
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = ".miniware_manifest.json"
+MANIFEST_VERSION = 1
+# Bytes hashed from each end of a file for its fast hash
+FAST_HASH_CHUNK_BYTES = 64 * 1024
+# How often manifests are saved while a batch runs, so a crash doesn't lose everything done so far
+MANIFEST_SAVE_INTERVAL_SECONDS = 10
+# Only options starting with a delegate's prefix change its output
+DELEGATE_OPTION_PREFIXES = {
+    "correct_slide" : "slides",
+    "correct_print" : "prints",
+    "correct_audio" : "audio",
+    "correct_vhs" : "vhs",
+}
+# Options that change how a file is corrected but not what comes out
+NON_OUTPUT_OPTIONS = {"audioDisableStreaming", "vhsFfmpegThreads"}
+# Keys every entry has. A file whose entry is missing any of them is corrected again.
+ENTRY_KEYS = {"size", "mtime_ns", "hash", "delegate", "options", "outputs"}
+
+
+def get_fast_hash(file_path : str) -> str:
+    """Hashes a file's size and its first and last FAST_HASH_CHUNK_BYTES, without reading the rest."""
+    size = os.path.getsize(file_path)
+    hasher = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file_path, "rb") as file:
+        hasher.update(file.read(FAST_HASH_CHUNK_BYTES))
+        if size > FAST_HASH_CHUNK_BYTES:
+            file.seek(max(FAST_HASH_CHUNK_BYTES, size - FAST_HASH_CHUNK_BYTES))
+            hasher.update(file.read(FAST_HASH_CHUNK_BYTES))
+    return hasher.hexdigest()
+
+
+def normalize_options(delegate_name : str, options : Dict[str, any]) -> Dict[str, any]:
+    """Returns only the options that can change a delegate's output, sorted by key."""
+    prefix = DELEGATE_OPTION_PREFIXES.get(delegate_name, "")
+    return {
+        key : (options or {})[key]
+        for key in sorted(options or {})
+        if key.startswith(prefix) and key not in NON_OUTPUT_OPTIONS
+    }
+
+
+@dataclass
+class CorrectionManifest:
+    folder : str
+    entries : Dict[str, Dict[str, any]] = field(default_factory=dict)
+    is_dirty : bool = False
+
+    @classmethod
+    def load(cls, folder : str) -> "CorrectionManifest":
+        manifest = cls(folder)
+        try:
+            with open(manifest.get_path(), "r") as file:
+                data = json.load(file)
+            if not isinstance(data, dict) or not isinstance(data.get("entries", {}), dict):
+                raise ValueError("not a manifest")
+            if data.get("version") == MANIFEST_VERSION:
+                manifest.entries = data.get("entries", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable manifest in %s: %s", folder, e)
+        return manifest
+
+    def get_path(self) -> str:
+        return os.path.join(self.folder, MANIFEST_FILE_NAME)
+
+    def is_up_to_date(self, file_path : str, delegate_name : str, options : Dict[str, any]) -> bool:
+        """Checks whether file_path was already corrected into this folder, unchanged and with the same options."""
+        entry = self.entries.get(os.path.abspath(file_path))
+        if not isinstance(entry, dict) or not ENTRY_KEYS <= entry.keys():
+            return False
+        if entry["delegate"] != delegate_name or entry["options"] != normalize_options(delegate_name, options):
+            return False
+        if not entry["outputs"] or not all(os.path.exists(output) for output in entry["outputs"]):
+            return False
+
+        stat = os.stat(file_path)
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns != entry["mtime_ns"]:
+            # Copying a folder changes mtimes without changing files, so fall back to the hash
+            if get_fast_hash(file_path) != entry["hash"]:
+                return False
+            entry["mtime_ns"] = stat.st_mtime_ns
+            self.is_dirty = True
+
+        return True
+
+    def record(self, file_path : str, delegate_name : str, options : Dict[str, any], output_paths : List[str]):
+        stat = os.stat(file_path)
+        self.entries[os.path.abspath(file_path)] = {
+            "size" : stat.st_size,
+            "mtime_ns" : stat.st_mtime_ns,
+            "hash" : get_fast_hash(file_path),
+            "delegate" : delegate_name,
+            "options" : normalize_options(delegate_name, options),
+            "outputs" : [os.path.abspath(output) for output in output_paths],
+        }
+        self.is_dirty = True
+
+    def forget(self, file_path : str):
+        if self.entries.pop(os.path.abspath(file_path), None) is not None:
+            self.is_dirty = True
+
+    def save(self):
+        if not self.is_dirty:
+            return
+        # Write then rename so an interrupted save can't leave a half written manifest
+        temp_path = f"{self.get_path()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"version" : MANIFEST_VERSION, "entries" : self.entries}, file)
+        os.replace(temp_path, self.get_path())
+        self.is_dirty = False
+
+
+@dataclass
+class ManifestTracker:
+    """Keeps the manifests of every output folder in a batch. Safe to use from several pool threads at once."""
+    manifests : Dict[str, CorrectionManifest] = field(default_factory=dict)
+    last_save_time : float = field(default_factory=time.monotonic)
+    lock : threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def get_manifest(self, folder : str) -> CorrectionManifest:
+        folder = os.path.abspath(folder)
+        if folder not in self.manifests:
+            self.manifests[folder] = CorrectionManifest.load(folder)
+        return self.manifests[folder]
+
+    def is_up_to_date(self, file_path : str, to_folder : str, delegate_name : str, options : Dict[str, any]) -> bool:
+        with self.lock:
+            return self.get_manifest(to_folder).is_up_to_date(file_path, delegate_name, options)
+
+    def record_result(self, file_path : str, to_folder : str, delegate_name : str, options : Dict[str, any], success : bool, output_paths : List[str]):
+        with self.lock:
+            manifest = self.get_manifest(to_folder)
+            if success and output_paths:
+                manifest.record(file_path, delegate_name, options, output_paths)
+            else:
+                manifest.forget(file_path)
+
+            if time.monotonic() - self.last_save_time > MANIFEST_SAVE_INTERVAL_SECONDS:
+                self.save_all_locked()
+
+    def save_all(self):
+        with self.lock:
+            self.save_all_locked()
+
+    def save_all_locked(self):
+        for manifest in self.manifests.values():
+            try:
+                manifest.save()
+            except OSError as e:
+                logger.warning("Could not save manifest in %s: %s", manifest.folder, e)
+        self.last_save_time = time.monotonic()
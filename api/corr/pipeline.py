@@ -0,0 +1,379 @@
+from dataclasses import dataclass, field
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+import numpy as np
+
+from corr.correct_result import CorrectResult
+from corr.delegates import PIXEL_CORRECTORS
+from corr.image_io import read_scan, write_scan
+from corr.instrumentation import STAGE_DECODE, STAGE_ENCODE, FileMetrics, StageStats, measure_file
+from corr.scheduler import MemoryBudget, estimate_image_bytes
+from corr.shared_buffers import SharedArrayRef, SharedBufferPool, SharedBufferPoolStats, open_shared_array
+from mwlocal.logs import get_log_context, run_in_log_context
+
+"""
+    - Correcting a scan is reading it (waiting on the scanner NAS), correcting it, then encoding and saving it.
+    Done one after the other in each worker, cores sit idle while files are read and saved.
+    - The pipeline runs these as separate stages: reader threads prefetch and decode scans into shared memory,
+    a process pool corrects them in place, and writer threads encode and save them. Reads and writes overlap
+    with correcting, and decoded scans never get pickled between processes.
+    - Each run has its own SharedBufferPool, closed when the run ends, which reports any scan whose buffer leaked.
+    - Only delegates with a pixel corrector in corr.delegates.PIXEL_CORRECTORS can be pipelined.
+"""
+
+# Threads decoding scans ahead of the process pool. cv2 releases the GIL while decoding and encoding.
+PIPELINE_READER_THREADS = 2
+# Threads encoding and saving corrected scans
+PIPELINE_WRITER_THREADS = 2
+# Decoded scans waiting for a worker
+PIPELINE_PREFETCH_DEPTH = 4
+# Corrected scans waiting to be saved
+PIPELINE_WRITE_DEPTH = 4
+# How often a reader waiting on memory rechecks the budget
+PIPELINE_MEMORY_POLL_SECONDS = 0.2
+
+
+def correct_shared_scan(delegate_name : str, ref : SharedArrayRef, options : Dict[str, any], name : str) -> Tuple[Union[SharedArrayRef, np.ndarray, None], float, FileMetrics]:
+    """
+    Runs in a worker process. Corrects the scan in a shared buffer, writing the result over it.
+
+    :returns: The result's ref, or the result itself in the rare case it's bigger than the scan,
+    or None if there's nothing to save, how long correcting took and the metrics of correcting it
+    """
+    start_time = time.perf_counter()
+    with measure_file(delegate_name) as metrics, open_shared_array(ref) as image:
+        out = PIXEL_CORRECTORS[delegate_name](image, options, name)
+
+        if out is None:
+            result = None
+        elif out.nbytes <= ref.nbytes:
+            result = ref.with_shape(out.shape, out.dtype.str)
+            # out can overlap image, numpy copies through a temporary when it does
+            with open_shared_array(result) as result_view:
+                np.copyto(result_view, out)
+                del result_view
+        else:
+            result = out.copy()
+        # Views of the buffer have to be gone before it's closed
+        del image, out
+
+    return result, time.perf_counter() - start_time, metrics
+
+
+@dataclass
+class QueueStats:
+    """Depths sampled whenever something is put in a queue. A queue that's always full means the stage after it is the bottleneck."""
+    max_size : int = 0
+    depth_total : int = 0
+    samples : int = 0
+    max_depth : int = 0
+
+    def sample(self, depth : int):
+        self.depth_total += depth
+        self.samples += 1
+        self.max_depth = max(self.max_depth, depth)
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "max_size" : self.max_size,
+            "average_depth" : round(self.depth_total / self.samples, 2) if self.samples else 0,
+            "max_depth" : self.max_depth,
+        }
+
+
+@dataclass
+class PipelineStats:
+    tasks : int = 0
+    read : StageStats = field(default_factory=StageStats)
+    correct : StageStats = field(default_factory=StageStats)
+    write : StageStats = field(default_factory=StageStats)
+    # Time readers spent waiting for memory or for room in the prefetch queue
+    reader_wait : StageStats = field(default_factory=StageStats)
+    prefetch_queue : QueueStats = field(default_factory=QueueStats)
+    write_queue : QueueStats = field(default_factory=QueueStats)
+    shared_buffers : SharedBufferPoolStats = field(default_factory=SharedBufferPoolStats)
+    elapsed_seconds : float = 0
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "tasks" : self.tasks,
+            "stages" : {
+                "read" : self.read.to_dict(),
+                "correct" : self.correct.to_dict(),
+                "write" : self.write.to_dict(),
+                "reader_wait" : self.reader_wait.to_dict(),
+            },
+            "queues" : {
+                "prefetch" : self.prefetch_queue.to_dict(),
+                "write" : self.write_queue.to_dict(),
+            },
+            "shared_buffers" : self.shared_buffers.to_dict(),
+            "elapsed_seconds" : round(self.elapsed_seconds, 2),
+        }
+
+
+@dataclass
+class PrefetchedScan:
+    task : Any
+    ref : SharedArrayRef
+    dpi : Optional[Tuple[float, float]]
+    reserved_bytes : int
+    read_seconds : float
+
+
+@dataclass
+class ImagePipeline:
+    """
+    Corrects scans in three overlapping stages: reader threads, a process pool, then writer threads.
+    Each scan in flight reserves its estimated memory from budget, so prefetching can't run the server out of memory.
+    """
+    budget : MemoryBudget
+    executor : concurrent.futures.Executor
+    num_workers : int
+    num_readers : int = PIPELINE_READER_THREADS
+    num_writers : int = PIPELINE_WRITER_THREADS
+    prefetch_depth : int = PIPELINE_PREFETCH_DEPTH
+    write_depth : int = PIPELINE_WRITE_DEPTH
+    stats : PipelineStats = field(default_factory=PipelineStats)
+    # Tasks that were never read because should_stop returned True
+    cancelled_tasks : List[Any] = field(default_factory=list)
+
+    def run(self,
+    tasks : List[Any],
+    on_task_started : Callable[[Any], None] = None,
+    should_stop : Callable[[], bool] = None) -> Iterator[Tuple[Any, CorrectResult]]:
+        """
+        Corrects every task's file. Tasks need file_path, to_folder_path, correct_file_delegate and options.
+
+        :param on_task_started: Called with each task as its file starts being read
+        :param should_stop: Polled by the readers, once it returns True no more files are read.
+        Files already read are still corrected and saved, the rest are put in cancelled_tasks.
+        :returns: An iterator of (task, result) pairs in the order files finish
+        """
+        start_time = time.perf_counter()
+        # Passed on to the workers, the pipeline's own threads don't log
+        log_context = get_log_context()
+        self.stats = PipelineStats(tasks=len(tasks))
+        self.stats.prefetch_queue.max_size = self.prefetch_depth
+        self.stats.write_queue.max_size = self.write_depth
+        self.cancelled_tasks = []
+        if not tasks:
+            return
+
+        # The budget already bounds the scans in flight, the pool's own limit is a backstop
+        buffer_pool = SharedBufferPool(self.budget.total_bytes)
+        task_queue : queue.Queue = queue.Queue()
+        for task in tasks:
+            task_queue.put(task)
+        prefetch_queue : queue.Queue = queue.Queue(maxsize=self.prefetch_depth)
+        # Unbounded so the pool's completion callbacks never block, pipeline_slots keeps it within write_depth
+        write_queue : queue.Queue = queue.Queue()
+        # Finished results, and None for each cancelled task
+        result_queue : queue.Queue = queue.Queue()
+        stop_event = threading.Event()
+        stats_lock = threading.Lock()
+        in_flight = 0
+        in_flight_changed = threading.Condition()
+        readers_left = self.num_readers
+        readers_left_lock = threading.Lock()
+        worker_slots = threading.Semaphore(self.num_workers)
+        # Scans being corrected or waiting to be saved
+        pipeline_slots = threading.Semaphore(self.num_workers + self.write_depth)
+
+        def is_stopping() -> bool:
+            return stop_event.is_set() or (should_stop is not None and should_stop())
+
+        def reserve_memory(num_bytes : int) -> bool:
+            nonlocal in_flight
+            while not is_stopping():
+                with in_flight_changed:
+                    # A scan bigger than the whole budget goes through once nothing else has any of it reserved
+                    if self.budget.try_reserve(num_bytes, force_if_empty=True):
+                        in_flight += 1
+                        return True
+                    in_flight_changed.wait(PIPELINE_MEMORY_POLL_SECONDS)
+            return False
+
+        def release_memory(num_bytes : int):
+            nonlocal in_flight
+            self.budget.release(num_bytes)
+            with in_flight_changed:
+                in_flight -= 1
+                in_flight_changed.notify_all()
+
+        def put_prefetched(item : PrefetchedScan):
+            with stats_lock:
+                self.stats.prefetch_queue.sample(prefetch_queue.qsize())
+            prefetch_queue.put(item)
+
+        def read_scans():
+            nonlocal readers_left
+            try:
+                while True:
+                    try:
+                        task = task_queue.get_nowait()
+                    except queue.Empty:
+                        return
+                    read_task_scan(task)
+            finally:
+                with readers_left_lock:
+                    readers_left -= 1
+                    if readers_left == 0:
+                        prefetch_queue.put(None)
+
+        def read_task_scan(task : Any):
+            """Reads a task's scan and hands it to the dispatcher, or posts why it couldn't be, so every task gets a result."""
+            wait_start = time.perf_counter()
+            reserved_bytes = None
+            refs = []
+            scan = None
+            error = None
+            try:
+                try:
+                    task_bytes = estimate_image_bytes(task.file_path, task.options)
+                except Exception:
+                    task_bytes = os.path.getsize(task.file_path)
+                if not reserve_memory(task_bytes):
+                    result_queue.put((task, None))
+                    return
+                reserved_bytes = task_bytes
+                wait_seconds = time.perf_counter() - wait_start
+
+                if on_task_started is not None:
+                    on_task_started(task)
+                read_start = time.perf_counter()
+                def allocate(shape, dtype):
+                    ref, array = buffer_pool.acquire(shape, dtype, task.file_path)
+                    refs.append(ref)
+                    return array
+                scan = read_scan(task.file_path, allocate)
+                item = PrefetchedScan(task, refs[0], scan.dpi, reserved_bytes, time.perf_counter() - read_start)
+                scan = None
+            except Exception as e:
+                error = f"Error reading {task.file_path}: {e}"
+            # Outside the except, since the traceback holds views of the buffer until it's gone
+            if error is not None:
+                scan = None
+                for ref in refs:
+                    buffer_pool.release(ref)
+                if reserved_bytes is not None:
+                    release_memory(reserved_bytes)
+                result_queue.put((task, CorrectResult(task.file_path, False, error)))
+                return
+
+            put_start = time.perf_counter()
+            put_prefetched(item)
+            with stats_lock:
+                self.stats.read.add(item.read_seconds)
+                self.stats.reader_wait.add(wait_seconds + time.perf_counter() - put_start)
+
+        def dispatch_scans():
+            """Hands prefetched scans to the process pool as workers free up, passing finished ones to the writers."""
+            while True:
+                item = prefetch_queue.get()
+                if item is None:
+                    return
+                pipeline_slots.acquire()
+                worker_slots.acquire()
+                try:
+                    future = self.executor.submit(
+                        run_in_log_context,
+                        log_context | { "file" : item.task.file_path },
+                        correct_shared_scan,
+                        item.task.correct_file_delegate.__name__,
+                        item.ref,
+                        item.task.options,
+                        get_output_path(item.task)
+                    )
+                except Exception as e:
+                    # e.g. the pool is broken. The scan never reaches a writer, so it's given back here.
+                    worker_slots.release()
+                    buffer_pool.release(item.ref)
+                    release_memory(item.reserved_bytes)
+                    pipeline_slots.release()
+                    result_queue.put((item.task, CorrectResult(item.task.file_path, False, f"Error correcting {item.task.file_path}: {e}", duration_seconds=item.read_seconds)))
+                    continue
+                def on_corrected(future, item=item):
+                    worker_slots.release()
+                    with stats_lock:
+                        self.stats.write_queue.sample(write_queue.qsize())
+                    write_queue.put((item, future))
+                future.add_done_callback(on_corrected)
+
+        def write_scans():
+            while True:
+                entry = write_queue.get()
+                if entry is None:
+                    return
+                item, future = entry
+                result = self.write_scan(item, future, buffer_pool, stats_lock)
+                buffer_pool.release(item.ref)
+                release_memory(item.reserved_bytes)
+                pipeline_slots.release()
+                result_queue.put((item.task, result))
+
+        readers = [threading.Thread(target=read_scans, name=f"pipeline-reader-{i}", daemon=True) for i in range(self.num_readers)]
+        dispatcher = threading.Thread(target=dispatch_scans, name="pipeline-dispatcher", daemon=True)
+        writers = [threading.Thread(target=write_scans, name=f"pipeline-writer-{i}", daemon=True) for i in range(self.num_writers)]
+        for thread in readers + [dispatcher] + writers:
+            thread.start()
+
+        try:
+            for _ in range(len(tasks)):
+                task, result = result_queue.get()
+                if result is None:
+                    self.cancelled_tasks.append(task)
+                    continue
+                yield task, result
+        finally:
+            stop_event.set()
+            for thread in readers + [dispatcher]:
+                thread.join()
+            # Every submitted scan hands its slot back once it's been saved
+            for _ in range(self.num_workers + self.write_depth):
+                pipeline_slots.acquire()
+            for _ in writers:
+                write_queue.put(None)
+            for thread in writers:
+                thread.join()
+            buffer_pool.close()
+            self.stats.shared_buffers = buffer_pool.stats
+            self.stats.elapsed_seconds = time.perf_counter() - start_time
+
+    def write_scan(self, item : PrefetchedScan, future : concurrent.futures.Future, buffer_pool : SharedBufferPool, stats_lock : threading.Lock) -> CorrectResult:
+        file_path = item.task.file_path
+        to_path = get_output_path(item.task)
+        metrics = FileMetrics(item.task.correct_file_delegate.__name__)
+        metrics.add_stage(STAGE_DECODE, item.read_seconds)
+        try:
+            corrected, correct_seconds, worker_metrics = future.result()
+        except Exception as e:
+            return CorrectResult(file_path, False, f"Error correcting {file_path}: {e}", duration_seconds=item.read_seconds, metrics=metrics)
+        metrics.merge(worker_metrics)
+
+        write_start = time.perf_counter()
+        try:
+            # Same as the delegates, nothing is saved when there's nothing to save but the path is still returned
+            if isinstance(corrected, SharedArrayRef):
+                write_scan(to_path, buffer_pool.get_view(corrected), item.dpi)
+            elif corrected is not None:
+                write_scan(to_path, corrected, item.dpi)
+        except Exception as e:
+            return CorrectResult(file_path, False, f"Error saving {to_path}: {e}", duration_seconds=item.read_seconds + correct_seconds, metrics=metrics)
+        write_seconds = time.perf_counter() - write_start
+        metrics.add_stage(STAGE_ENCODE, write_seconds)
+        metrics.record_file_sizes(file_path, [to_path])
+
+        with stats_lock:
+            self.stats.correct.add(correct_seconds)
+            self.stats.write.add(write_seconds)
+        return CorrectResult(file_path, True, f"Corrected {file_path}, saved to {[to_path]}", [to_path], item.read_seconds + correct_seconds + write_seconds, metrics)
+
+
+def get_output_path(task : Any) -> str:
+    # Where correct_slide and correct_print save to
+    return os.path.join(task.to_folder_path, os.path.basename(task.file_path))
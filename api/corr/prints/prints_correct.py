@@ -1,42 +1,26 @@
 import os
 from typing import Dict, List, Tuple
-import cv2
-from PIL import Image
+import numpy as np
 
 from corr.color_balance import simplest_cb
+from corr.image_io import read_scan, write_scan
+from corr.instrumentation import STAGE_COLOR_BALANCE, STAGE_DECODE, STAGE_ENCODE, stage
 
 PERCENT_TO_CROP = 1
 
 
-def correct_print(from_path: str, to_dir: str, options: Dict[str, any] = None) -> List[str]:
+def correct_print_pixels(image : np.ndarray, options : Dict[str, any], name : str = "") -> np.ndarray:
     """
-    Crops and color-corrects an image of a print, then saves it to a folder.
-
-    :param from_path: The path to the print image to correct
-    :param to_dir: the directory to save the corrected image to
-    :param options: Dictionary of options that can control the correction process
-        - printsDisableCrop: If True, image cropping is not performed
-        - printsDisableColorCorrection: If True, color correction is not performed
+    Crops and color-corrects a decoded print scan, without reading or writing any files. See correct_print for options.
 
-    :returns: The name of the path saved to.
+    :param image: The BGR scan, may be color corrected in place
+    :param name: Unused, there so it can be called like correct_slide_pixels
+    :returns: The corrected image, which may be a view of image
     """
-    # Initialize options if None
-    if options is None:
-        options = {}
-    
     # Get options with default values and ensure they are boolean
     disable_crop = bool(options.get("printsDisableCrop", False))
     disable_color_correction = bool(options.get("printsDisableColorCorrection", False))
-    
-    file_name, file_extension = os.path.splitext(os.path.basename(from_path))
-    to_path = os.path.join(to_dir, f"{file_name}{file_extension}")
-
-    # Save DPI for later
-    pil_image = Image.open(from_path)
-    dpi = pil_image.info.get("dpi", (None, None))[0]
 
-    image = cv2.imread(from_path)
-    
     # Initialize output image
     out = image
     
@@ -49,11 +33,35 @@ def correct_print(from_path: str, to_dir: str, options: Dict[str, any] = None) -
     
     # Apply color correction if not disabled
     if not disable_color_correction:
-        out = simplest_cb(out, 1)
+        with stage(STAGE_COLOR_BALANCE):
+            out = simplest_cb(out, 1, out=out)
+
+    return out
+
+
+def correct_print(from_path: str, to_dir: str, options: Dict[str, any] = None) -> List[str]:
+    """
+    Crops and color-corrects an image of a print, then saves it to a folder.
+
+    :param from_path: The path to the print image to correct
+    :param to_dir: the directory to save the corrected image to
+    :param options: Dictionary of options that can control the correction process
+        - printsDisableCrop: If True, image cropping is not performed
+        - printsDisableColorCorrection: If True, color correction is not performed
+
+    :returns: The name of the path saved to.
+    """
+    # Initialize options if None
+    if options is None:
+        options = {}
+    
+    file_name, file_extension = os.path.splitext(os.path.basename(from_path))
+    to_path = os.path.join(to_dir, f"{file_name}{file_extension}")
 
-    # Convert OpenCV image (BGR) to PIL Image (RGB) and save with DPI information
-    out_rgb = cv2.cvtColor(out, cv2.COLOR_BGR2RGB)
-    pil_image_out = Image.fromarray(out_rgb)
-    pil_image_out.save(to_path, dpi=(dpi, dpi), subsampling=0, quality=95)
+    with stage(STAGE_DECODE):
+        scan = read_scan(from_path)
+    out = correct_print_pixels(scan.pixels, options)
+    with stage(STAGE_ENCODE):
+        write_scan(to_path, out, scan.dpi)
 
     return [to_path]
@@ -0,0 +1,238 @@
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import psutil
+from PIL import Image
+
+"""
+    - Correcting one file per core is fine for JPEGs but runs the server out of memory on a folder of long WAVs or tapes.
+    The scheduler estimates how much memory each task needs and only starts tasks while the total fits in a budget.
+    - Tasks are started largest first so the longest ones don't end up running alone at the end of a batch.
+    Smaller tasks backfill memory the largest waiting task doesn't fit in, but only for HEAD_OF_LINE_MAX_WAIT_SECONDS.
+    After that, nothing else starts until it has, or it would keep getting passed over until it ran alone at the end.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Share of the memory available when a batch starts that its tasks may use, unless memoryBudgetMb is given
+MEMORY_BUDGET_FRACTION = 0.75
+# A worker process with numpy, cv2 and librosa imported
+WORKER_BASE_BYTES = 150 * 1024 * 1024
+# Full size copies of a decoded scan held at once: the scan, its warped/cropped copy and the flipped copy of that
+IMAGE_WORKING_COPIES = 3
+# Copies of the decoded samples the in-memory audio path holds: float32 load, mono mix, trimmed copy and 16-bit output
+AUDIO_WORKING_COPIES = 4
+# Streamed audio only ever holds a few blocks
+AUDIO_STREAMING_BYTES = 64 * 1024 * 1024
+# The ffmpeg re-encode of a tape, which runs in its own process
+VIDEO_TASK_BYTES = 512 * 1024 * 1024
+# Used when a file's header can't be read
+UNKNOWN_FILE_SIZE_FACTOR = 10
+# How often a scheduler waiting on memory rechecks a budget shared with other schedulers
+SHARED_BUDGET_POLL_SECONDS = 1
+# How long smaller tasks can keep starting while the largest waiting task doesn't fit
+HEAD_OF_LINE_MAX_WAIT_SECONDS = 30
+
+
+def estimate_image_bytes(file_path : str, options : Dict[str, any]) -> int:
+    # Only reads the header, pixels aren't decoded until they're accessed
+    with Image.open(file_path) as image:
+        width, height = image.size
+    return width * height * 3 * IMAGE_WORKING_COPIES
+
+
+def estimate_audio_bytes(file_path : str, options : Dict[str, any]) -> int:
+    if not (options or {}).get("audioDisableStreaming", False):
+        return AUDIO_STREAMING_BYTES
+    # Only needed for the in-memory audio path, which is rarely used
+    import soundfile as sf
+    info = sf.info(file_path)
+    return info.frames * info.channels * 4 * AUDIO_WORKING_COPIES
+
+
+def estimate_video_bytes(file_path : str, options : Dict[str, any]) -> int:
+    return VIDEO_TASK_BYTES
+
+
+# Keyed by the name of the correct_file_delegate a task uses
+MEMORY_ESTIMATORS : Dict[str, Callable[[str, Dict[str, any]], int]] = {
+    "correct_slide" : estimate_image_bytes,
+    "correct_print" : estimate_image_bytes,
+    "correct_audio" : estimate_audio_bytes,
+    "correct_vhs" : estimate_video_bytes,
+}
+
+
+def estimate_task_bytes(file_path : str, correct_file_delegate : Callable, options : Dict[str, any]) -> int:
+    """Estimates the peak memory a worker needs to correct file_path with correct_file_delegate."""
+    estimator = MEMORY_ESTIMATORS.get(getattr(correct_file_delegate, "__name__", None))
+    try:
+        if estimator is not None:
+            return WORKER_BASE_BYTES + estimator(file_path, options)
+    except Exception as e:
+        logger.warning("Could not read the header of %s to estimate its memory (%s), guessing from its size", file_path, e)
+
+    return WORKER_BASE_BYTES + os.path.getsize(file_path) * UNKNOWN_FILE_SIZE_FACTOR
+
+
+def get_memory_budget_bytes(options : Dict[str, any]) -> int:
+    """Returns the memoryBudgetMb option in bytes, or a share of the currently available memory."""
+    budget_mb = (options or {}).get("memoryBudgetMb")
+    if budget_mb:
+        return int(float(budget_mb) * 1024 * 1024)
+    return int(psutil.virtual_memory().available * MEMORY_BUDGET_FRACTION)
+
+
+@dataclass
+class MemoryBudget:
+    """Memory that can be reserved by tasks. Can be shared by schedulers running in different threads."""
+    total_bytes : int
+    reserved_bytes : int = 0
+    lock : threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def try_reserve(self, num_bytes : int, force_if_empty : bool = False) -> bool:
+        """
+        Reserves num_bytes if they fit in what's left of the budget.
+        With force_if_empty, also reserves them if nothing at all is reserved, so a task bigger than the whole
+        budget can still run, but only on its own, even when several schedulers share the budget.
+        """
+        with self.lock:
+            if not (force_if_empty and self.reserved_bytes == 0) and self.reserved_bytes + num_bytes > self.total_bytes:
+                return False
+            self.reserved_bytes += num_bytes
+            return True
+
+    def release(self, num_bytes : int):
+        with self.lock:
+            self.reserved_bytes -= num_bytes
+
+
+@dataclass
+class SchedulerStats:
+    tasks : int = 0
+    budget_bytes : int = 0
+    peak_concurrency : int = 0
+    peak_projected_bytes : int = 0
+    total_wait_seconds : float = 0
+    max_wait_seconds : float = 0
+    elapsed_seconds : float = 0
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "tasks" : self.tasks,
+            "budget_mb" : round(self.budget_bytes / (1024 * 1024)),
+            "peak_concurrency" : self.peak_concurrency,
+            "peak_projected_mb" : round(self.peak_projected_bytes / (1024 * 1024)),
+            "average_wait_seconds" : round(self.total_wait_seconds / self.tasks, 2) if self.tasks else 0,
+            "max_wait_seconds" : round(self.max_wait_seconds, 2),
+            "elapsed_seconds" : round(self.elapsed_seconds, 2),
+        }
+
+
+@dataclass
+class MemoryAwareScheduler:
+    """
+    Runs tasks on a process pool, only admitting a task while it fits in what's left of the memory budget.
+    A task estimated to need more than the whole budget still runs, once nothing else has any of the budget reserved.
+
+    The budget can be shared by several schedulers running at once, e.g. one per media type.
+    So can executor, e.g. corr.worker_pool's pool, otherwise each run starts and stops its own process pool.
+    """
+    budget : MemoryBudget
+    max_workers : int = field(default_factory=lambda: os.cpu_count() or 1)
+    executor : concurrent.futures.Executor = field(default=None, repr=False)
+    # See HEAD_OF_LINE_MAX_WAIT_SECONDS
+    head_of_line_max_wait_seconds : float = HEAD_OF_LINE_MAX_WAIT_SECONDS
+    stats : SchedulerStats = field(default_factory=SchedulerStats)
+    # Tasks that were never started because should_stop returned True
+    cancelled_tasks : List[Any] = field(default_factory=list)
+
+    def run(self,
+    tasks : List[Any],
+    do_task : Callable[[Any], Any],
+    estimate_bytes : Callable[[Any], int],
+    on_task_started : Callable[[Any], None] = None,
+    should_stop : Callable[[], bool] = None) -> Iterator[Tuple[Any, concurrent.futures.Future]]:
+        """
+        Runs do_task on every task in a process pool.
+
+        :param on_task_started: Called with each task as it's submitted to the pool
+        :param should_stop: Polled while tasks are pending, once it returns True no more tasks are started.
+        Tasks already running are left to finish, the rest are put in cancelled_tasks.
+        :returns: An iterator of (task, future) pairs in the order tasks finish
+        """
+        start_time = time.perf_counter()
+        self.stats = SchedulerStats(tasks=len(tasks), budget_bytes=self.budget.total_bytes)
+        self.cancelled_tasks = []
+
+        # Largest first, so the biggest tasks don't end up running alone at the end
+        pending : List[Tuple[int, Any]] = sorted(((estimate_bytes(task), task) for task in tasks), key=lambda pair: pair[0], reverse=True)
+        running : Dict[concurrent.futures.Future, Tuple[int, Any]] = {}
+        projected_bytes = 0
+        # When the largest pending task first didn't fit
+        head_blocked_since = None
+
+        executor_context = nullcontext(self.executor) if self.executor is not None else concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        with executor_context as executor:
+            try:
+                while pending or running:
+                    if pending and should_stop is not None and should_stop():
+                        self.cancelled_tasks.extend(task for _, task in pending)
+                        pending = []
+
+                    # Admit as many pending tasks as fit, trying the largest ones first
+                    i = 0
+                    while i < len(pending) and len(running) < self.max_workers:
+                        task_bytes, task = pending[i]
+                        if not self.budget.try_reserve(task_bytes, force_if_empty=True):
+                            if i == 0:
+                                head_blocked_since = head_blocked_since or time.perf_counter()
+                                # Let memory free up for it instead of handing it to smaller tasks
+                                if time.perf_counter() - head_blocked_since > self.head_of_line_max_wait_seconds:
+                                    break
+                            i += 1
+                            continue
+
+                        if i == 0:
+                            head_blocked_since = None
+                        try:
+                            future = executor.submit(do_task, task)
+                        except BaseException:
+                            self.budget.release(task_bytes)
+                            raise
+                        pending.pop(i)
+                        running[future] = (task_bytes, task)
+                        projected_bytes += task_bytes
+                        if on_task_started is not None:
+                            on_task_started(task)
+
+                        wait_seconds = time.perf_counter() - start_time
+                        self.stats.total_wait_seconds += wait_seconds
+                        self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, wait_seconds)
+
+                    self.stats.peak_concurrency = max(self.stats.peak_concurrency, len(running))
+                    self.stats.peak_projected_bytes = max(self.stats.peak_projected_bytes, projected_bytes)
+
+                    # If tasks are waiting on memory, other schedulers sharing the budget may free some up at any time,
+                    # and pending tasks have to be dropped soon after should_stop starts returning True
+                    is_waiting_on_memory = pending and len(running) < self.max_workers
+                    timeout = SHARED_BUDGET_POLL_SECONDS if is_waiting_on_memory or (pending and should_stop is not None) else None
+                    done, _ = concurrent.futures.wait(running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        task_bytes, task = running.pop(future)
+                        projected_bytes -= task_bytes
+                        self.budget.release(task_bytes)
+                        yield task, future
+            finally:
+                # Reached with tasks still running if do_task couldn't be submitted or whoever is iterating stopped,
+                # e.g. because on_task_started raised. The budget may be shared, so give their memory back.
+                for task_bytes, _ in running.values():
+                    self.budget.release(task_bytes)
+
+        self.stats.elapsed_seconds = time.perf_counter() - start_time
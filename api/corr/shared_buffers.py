@@ -0,0 +1,236 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from multiprocessing import resource_tracker, shared_memory
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+
+"""
+    - Hands decoded images and audio between processes without copying: the parent puts an array in a shared memory
+    buffer from a SharedBufferPool and passes the buffer's SharedArrayRef (segment name, offset, shape and dtype) to
+    a worker, which opens the same memory with open_shared_array.
+    - Segments are kept and reused once their buffer is released, so a batch doesn't create, page in and unlink a
+    new segment for every scan. The pool never holds more than max_bytes, acquiring blocks until enough is released.
+    - Buffers are reference counted in the parent process. Whatever is still referenced when the pool is closed,
+    e.g. when a job finishes, is reported as a leak and freed.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Free segments kept around for reuse, beyond this the oldest are unlinked
+SHARED_POOL_MAX_FREE_BYTES = 512 * 1024 * 1024
+# A free segment is only reused for a buffer at least this fraction of its size, so small buffers don't pin big segments
+SHARED_POOL_MIN_REUSE_FRACTION = 0.5
+# How long acquire waits for room before giving up
+SHARED_POOL_ACQUIRE_TIMEOUT_SECONDS = 600
+
+
+def ensure_shared_memory_tracker():
+    """
+    Starts the resource tracker before any worker processes, so workers share it. Workers attaching to a segment
+    would otherwise start their own trackers, which unlink the segment when the worker exits.
+    """
+    if os.name == "posix":
+        resource_tracker.ensure_running()
+
+
+@dataclass(frozen=True)
+class SharedArrayRef:
+    """Where an array lives in shared memory. Cheap to pickle, so it's what gets sent to workers."""
+    segment_name : str
+    offset : int
+    shape : Tuple[int, ...]
+    dtype : str
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def with_shape(self, shape : Tuple[int, ...], dtype : str = None) -> "SharedArrayRef":
+        """The same memory seen as a different, no bigger, array, e.g. a corrected image written over its source."""
+        return SharedArrayRef(self.segment_name, self.offset, tuple(shape), dtype or self.dtype)
+
+
+def view_segment(segment : shared_memory.SharedMemory, ref : SharedArrayRef) -> np.ndarray:
+    return np.ndarray(ref.shape, np.dtype(ref.dtype), buffer=segment.buf, offset=ref.offset)
+
+
+@contextmanager
+def open_shared_array(ref : SharedArrayRef) -> Iterator[np.ndarray]:
+    """
+    Opens an array another process put in shared memory. Every view of the array has to be gone by the end of the
+    with block, copy anything that needs to outlive it.
+    """
+    segment = shared_memory.SharedMemory(name=ref.segment_name)
+    try:
+        yield view_segment(segment, ref)
+    finally:
+        try:
+            segment.close()
+        except BufferError:
+            # A traceback still holds a view, the mapping goes with it
+            pass
+
+
+@dataclass
+class SharedBuffer:
+    segment : shared_memory.SharedMemory
+    ref : SharedArrayRef
+    # What the buffer was acquired for, reported if it leaks
+    owner : str
+    ref_count : int = 1
+    acquired_time : float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class SharedBufferPoolStats:
+    acquired : int = 0
+    reused : int = 0
+    segments_created : int = 0
+    segments_unlinked : int = 0
+    peak_bytes : int = 0
+    acquire_wait_seconds : float = 0
+    leaked : int = 0
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "acquired" : self.acquired,
+            "reused" : self.reused,
+            "segments_created" : self.segments_created,
+            "segments_unlinked" : self.segments_unlinked,
+            "peak_mb" : round(self.peak_bytes / (1024 * 1024)),
+            "acquire_wait_seconds" : round(self.acquire_wait_seconds, 2),
+            "leaked" : self.leaked,
+        }
+
+
+@dataclass
+class SharedBufferPool:
+    """
+    Reference counted shared memory buffers, reusing segments as buffers are released.
+    Only the process that made the pool acquires and releases buffers, workers just open them by ref.
+    """
+    max_bytes : int
+    max_free_bytes : int = SHARED_POOL_MAX_FREE_BYTES
+    acquire_timeout_seconds : float = SHARED_POOL_ACQUIRE_TIMEOUT_SECONDS
+    stats : SharedBufferPoolStats = field(default_factory=SharedBufferPoolStats)
+    in_use : Dict[str, SharedBuffer] = field(default_factory=dict)
+    # Released segments, oldest first
+    free_segments : List[shared_memory.SharedMemory] = field(default_factory=list)
+    condition : threading.Condition = field(default_factory=threading.Condition, repr=False)
+    is_closed : bool = False
+
+    def __post_init__(self):
+        ensure_shared_memory_tracker()
+
+    def get_total_bytes(self) -> int:
+        return sum(buffer.segment.size for buffer in self.in_use.values()) + sum(segment.size for segment in self.free_segments)
+
+    def acquire(self, shape : Tuple[int, ...], dtype : np.dtype, owner : str = "") -> Tuple[SharedArrayRef, np.ndarray]:
+        """
+        Gets a buffer for an array, reusing a free segment if one is big enough. Blocks while the pool is full.
+
+        :param owner: What the buffer is for, reported if it's never released
+        :returns: The buffer's ref, with a reference count of 1, and a view of it to fill in
+        """
+        nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        wait_start = time.perf_counter()
+        with self.condition:
+            if self.is_closed:
+                raise RuntimeError("The shared buffer pool is closed")
+
+            segment = self.take_free_segment(nbytes)
+            if segment is None:
+                is_room = self.condition.wait_for(lambda: self.make_room(nbytes), self.acquire_timeout_seconds)
+                if not is_room:
+                    raise MemoryError(f"Timed out waiting for {nbytes} bytes of shared memory for {owner}")
+                segment = shared_memory.SharedMemory(create=True, size=nbytes)
+                self.stats.segments_created += 1
+            else:
+                self.stats.reused += 1
+
+            ref = SharedArrayRef(segment.name, 0, tuple(shape), np.dtype(dtype).str)
+            self.in_use[segment.name] = SharedBuffer(segment, ref, owner)
+            self.stats.acquired += 1
+            self.stats.acquire_wait_seconds += time.perf_counter() - wait_start
+            self.stats.peak_bytes = max(self.stats.peak_bytes, self.get_total_bytes())
+            return ref, view_segment(segment, ref)
+
+    def take_free_segment(self, nbytes : int) -> Optional[shared_memory.SharedMemory]:
+        """Takes the smallest free segment the buffer fits in without wasting most of it."""
+        candidates = [
+            segment for segment in self.free_segments
+            if nbytes <= segment.size and nbytes >= segment.size * SHARED_POOL_MIN_REUSE_FRACTION
+        ]
+        if not candidates:
+            return None
+        segment = min(candidates, key=lambda segment: segment.size)
+        self.free_segments.remove(segment)
+        return segment
+
+    def make_room(self, nbytes : int) -> bool:
+        """Unlinks free segments, oldest first, until nbytes more fits in max_bytes. Returns whether it does."""
+        while self.get_total_bytes() + nbytes > self.max_bytes and self.free_segments:
+            self.unlink_segment(self.free_segments.pop(0))
+        # Let a buffer bigger than the whole pool through once nothing else is using it
+        return self.get_total_bytes() + nbytes <= self.max_bytes or not self.in_use
+
+    def unlink_segment(self, segment : shared_memory.SharedMemory):
+        try:
+            segment.close()
+        except BufferError:
+            logger.warning("Shared memory segment %s is still viewed in this process, unlinking it anyway", segment.name)
+        segment.unlink()
+        self.stats.segments_unlinked += 1
+
+    def get_view(self, ref : SharedArrayRef) -> np.ndarray:
+        """A view of a buffer acquired from this pool, seen through ref. Only valid while the buffer is referenced."""
+        with self.condition:
+            return view_segment(self.in_use[ref.segment_name].segment, ref)
+
+    def retain(self, ref : SharedArrayRef):
+        with self.condition:
+            self.in_use[ref.segment_name].ref_count += 1
+
+    def release(self, ref : SharedArrayRef):
+        """Drops a reference to a buffer. Its segment is kept for reuse once nothing references it."""
+        with self.condition:
+            buffer = self.in_use[ref.segment_name]
+            buffer.ref_count -= 1
+            if buffer.ref_count > 0:
+                return
+
+            del self.in_use[ref.segment_name]
+            if self.is_closed:
+                self.unlink_segment(buffer.segment)
+            else:
+                self.free_segments.append(buffer.segment)
+                while sum(segment.size for segment in self.free_segments) > self.max_free_bytes:
+                    self.unlink_segment(self.free_segments.pop(0))
+            self.condition.notify_all()
+
+    def close(self) -> List[str]:
+        """
+        Unlinks every segment. Buffers still referenced are leaks, they're reported and freed anyway.
+
+        :returns: The owners of the leaked buffers
+        """
+        with self.condition:
+            self.is_closed = True
+            leaked_owners = [buffer.owner for buffer in self.in_use.values()]
+            for buffer in self.in_use.values():
+                age_seconds = time.monotonic() - buffer.acquired_time
+                logger.warning("Leaked shared buffer %s for %s (%d references, %.0fs old)", buffer.ref.segment_name, buffer.owner, buffer.ref_count, age_seconds)
+                self.unlink_segment(buffer.segment)
+            self.stats.leaked += len(leaked_owners)
+            self.in_use.clear()
+
+            for segment in self.free_segments:
+                self.unlink_segment(segment)
+            self.free_segments.clear()
+            self.condition.notify_all()
+
+        return leaked_owners
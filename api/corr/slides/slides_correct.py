@@ -1,12 +1,17 @@
-from typing import Dict, List
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 import cv2
 import numpy as np
 import math
 import argparse
+import logging
 import os
-from PIL import Image
 
 from corr.color_balance import simplest_cb
+from corr.image_io import read_scan, write_scan
+from corr.instrumentation import STAGE_COLOR_BALANCE, STAGE_DECODE, STAGE_DETECT, STAGE_ENCODE, STAGE_WARP, stage
+
+logger = logging.getLogger(__name__)
 
 # How far will colors be considered to be background?
 # Should be set somewhere between 15-25
@@ -20,6 +25,17 @@ ACCEPTABLE_ASPECT_RATIOS = [
 ACCEPTABLE_ASPECT_RATIO_LENIENCE = 0.04
 ACCEPTABLE_TILT = 5
 NEGATIVE_PADDING_FACTOR = 1.05
+# Background detection runs on a copy downscaled so its long edge is at most this many pixels.
+# Corners found on the copy are mapped back to full resolution for the final warp. 0 disables this.
+DETECTION_PROXY_LONG_EDGE = 1500
+# Size of the box filter that grows detected background, in full resolution pixels
+BACKGROUND_KERNEL_SIZE = 8
+THRESHHOLD_OFFSETS = [0, 1, -1, 2, -2, 4, -4]
+ASPECT_RATIO_MAP = {
+    "4:3": 1.33,
+    "3:2": 1.5,
+    "1:1": 1
+}
 
 
 def estimate_tilt_with_min_area_rect(points) -> float:
@@ -47,194 +63,287 @@ def order_points(pts):
     rect[3] = pts[np.argmax(diff)]  # bottom-left point has the largest difference (x - y)
     
     return rect
-    
 
-def correct_slide(from_path: str, to_dir: str, options: Dict[str, any] = None) -> List[str]:
+
+@dataclass
+class SlideCrop:
+    could_crop_correctly : bool = False
+    input_pts : np.ndarray = None
+    output_pts : np.ndarray = None
+    max_width : int = 0
+    max_height : int = 0
+    aspect_ratio : float = 0
+
+
+def make_detection_proxy(image : np.ndarray, long_edge : int) -> Tuple[np.ndarray, float]:
     """
-    Crops and color-corrects an image of a slide, then saves it to a folder.
+    Downscales an image so its long edge is at most long_edge pixels.
 
-    :param from_path: The path to the slide image to correct
-    :param to_dir: the directory to save the corrected image to
-    :param options: Dictionary of options that can control the correction process
-        - slidesDisableCrop: If True, image cropping is not performed
-        - slidesDisableColorCorrection: If True, color correction is not performed
-        - slidesEnforceAspectRatio: Specifies which aspect ratio to enforce when cropping
-          - "Any" (default): Allow any of the acceptable aspect ratios (1.5, 1.33, 1)
-          - "4:3": Only allow 4:3 aspect ratio (1.33)
-          - "3:2": Only allow 3:2 aspect ratio (1.5)
-          - "1:1": Only allow 1:1 aspect ratio (1)
+    :returns: The downscaled image and the scale it was downscaled by. If the image is already small enough
+        (or long_edge is 0), returns the image itself and a scale of 1.
+    """
+    height, width = image.shape[:2]
+    if not long_edge or max(height, width) <= long_edge:
+        return image, 1.0
 
-    :returns: The name of the path saved to.
+    scale = long_edge / max(height, width)
+    proxy_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    proxy = cv2.resize(image, proxy_size, interpolation=cv2.INTER_AREA)
+    # Use the exact per-axis scale that was applied to map points back later
+    return proxy, proxy_size[0] / width
+
+
+def proxy_to_full_resolution(points : np.ndarray, scale : float) -> np.ndarray:
+    """Maps pixel coordinates on a proxy made by make_detection_proxy back to the full resolution image."""
+    if scale == 1:
+        return points
+    return ((points + 0.5) / scale - 0.5).astype(np.float32)
+
+
+def get_background_distance_map(image : np.ndarray, bg_colors : List[Tuple]) -> np.ndarray:
+    """
+    Computes how far each pixel is from the closest background color, as a squared distance.
+    Computed once per image so each threshold tried is just a comparison against threshhold ** 2.
+
+    :returns: An int32 array the height and width of image
+    """
+    # Subtract as signed ints; uint8 subtraction wraps and makes slightly darker background look far away
+    signed_image = image.astype(np.int32)
+    distance_map = None
+
+    for color in bg_colors:
+        difference = signed_image - np.array(color, dtype=np.int32)
+        squared_distance = np.einsum("ijk,ijk->ij", difference, difference)
+        if distance_map is None:
+            distance_map = squared_distance
+        else:
+            np.minimum(distance_map, squared_distance, out=distance_map)
+
+    return distance_map
+
+
+def find_largest_box(distance_map : np.ndarray, threshhold : int, kernel_size : int) -> np.ndarray:
+    """
+    Finds the 4 corners of the largest rotated rectangle of non-background in an image.
+
+    :param distance_map: The image's squared distances to background, from get_background_distance_map
+    :returns: The corners, or None if no rectangle could be found
+    """
+    # Squared distances are integers, so this matches comparing the actual distance against threshhold
+    output_image = np.zeros(distance_map.shape, np.uint8)
+    output_image[distance_map < threshhold * threshhold] = 255
+
+    kernel = np.ones((kernel_size, kernel_size), np.float32)
+    output_image = cv2.filter2D(output_image, -1, kernel)
+
+    output_image = cv2.bitwise_not(output_image)
+
+    _, binary_output = cv2.threshold(output_image, 1, 255, cv2.THRESH_BINARY)
+
+    (contours, _) = cv2.findContours(binary_output, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+    # Variables to store the largest rotated rectangle
+    largest_area = 0
+    largest_box = None
+
+    # Loop through the contours to find the largest rotated rectangle
+    for contour in contours:
+        rect = cv2.minAreaRect(contour)  # Get the rotated rectangle
+        box = cv2.boxPoints(rect)       # Get the 4 corner points of the rectangle
+
+        # Calculate the area of the rectangle
+        width, height = rect[1]
+        area = width * height
+
+        # Check if this is the largest rectangle so far
+        if area > largest_area:
+            largest_area = area
+            largest_box = box
+
+    return largest_box
+
+
+def find_slide_crop(
+image : np.ndarray,
+enforce_aspect_ratio : str = "Any",
+detection_long_edge : int = DETECTION_PROXY_LONG_EDGE,
+name : str = "") -> SlideCrop:
+    """
+    Searches for the slide in a scan, trying a few background thresholds until one gives an acceptable crop.
+    Detection runs on a downscaled proxy of the image (see make_detection_proxy); the returned points are
+    always in full resolution coordinates.
+
+    :returns: The crop found, or None if nothing could be boxed at all
+    """
+    height, width, _ = image.shape
+
+    # Sample background colors from the full resolution image so the proxy uses the same colors
+    offset = SAMPLING_OFFSET_DISTANCE
+    bg_colors = [
+        tuple(image[height - offset, width // 2]),
+        tuple(image[height // 2, width - offset]),
+        tuple(image[offset, width // 2]),
+        tuple(image[height // 2, offset])
+    ]
+
+    detection_image, scale = make_detection_proxy(image, detection_long_edge)
+    kernel_size = max(1, round(BACKGROUND_KERNEL_SIZE * scale))
+    distance_map = get_background_distance_map(detection_image, bg_colors)
+
+    # Determine which aspect ratios to use based on the enforce_aspect_ratio option
+    if enforce_aspect_ratio in ASPECT_RATIO_MAP:
+        # Use only the specified aspect ratio
+        aspect_ratios_to_check = [ASPECT_RATIO_MAP[enforce_aspect_ratio]]
+    else:
+        # Use all acceptable aspect ratios if "Any" or the option is not recognized
+        aspect_ratios_to_check = ACCEPTABLE_ASPECT_RATIOS
+
+    crop = SlideCrop()
+    for threshhold_offset in THRESHHOLD_OFFSETS:
+        threshhold = BACKGROUND_CROPPING_AGGRESSION + threshhold_offset
+
+        largest_box = find_largest_box(distance_map, threshhold, kernel_size)
+        if largest_box is None:
+            logger.debug("Could not box %s!", name)
+            return None
+
+        if scale == 1:
+            largest_box = np.int32(largest_box)     # Convert to integer coordinates
+        ordered_box = order_points(proxy_to_full_resolution(largest_box, scale))
+
+        pt_A, pt_B, pt_C, pt_D = ordered_box
+
+        # Compute the difference for the top edge (A -> B)
+        delta_x = pt_B[0] - pt_A[0]
+        delta_y = pt_B[1] - pt_A[1]
+
+        # Calculate the angle in radians and convert to degrees
+        angle_radians = math.atan2(delta_y, delta_x)
+        angle_degrees = math.degrees(angle_radians)
+
+        if abs(angle_degrees) > ACCEPTABLE_TILT:
+            logger.debug("Detected tilt on %s: %.2f°", name, angle_degrees)
+            continue
+
+        width_AD = np.sqrt(((pt_A[0] - pt_D[0]) ** 2) + ((pt_A[1] - pt_D[1]) ** 2))
+        width_BC = np.sqrt(((pt_B[0] - pt_C[0]) ** 2) + ((pt_B[1] - pt_C[1]) ** 2))
+        crop.max_width = max(int(width_AD), int(width_BC))
+
+        height_AB = np.sqrt(((pt_A[0] - pt_B[0]) ** 2) + ((pt_A[1] - pt_B[1]) ** 2))
+        height_CD = np.sqrt(((pt_C[0] - pt_D[0]) ** 2) + ((pt_C[1] - pt_D[1]) ** 2))
+        crop.max_height = max(int(height_AB), int(height_CD))
+
+        crop.input_pts = np.float32([pt_A, pt_B, pt_C, pt_D])
+
+        endY = int(crop.max_height * NEGATIVE_PADDING_FACTOR)
+        endX = int(crop.max_width * NEGATIVE_PADDING_FACTOR)
+        startY = int(endY - crop.max_height)
+        startX = int(endX - crop.max_width)
+
+        crop.aspect_ratio = max(crop.max_width, crop.max_height) / min(crop.max_width, crop.max_height)
+
+        for acceptable_aspect_ratio in aspect_ratios_to_check:
+            lower_bound = acceptable_aspect_ratio * (1 - ACCEPTABLE_ASPECT_RATIO_LENIENCE)
+            upper_bound = acceptable_aspect_ratio * (1 + ACCEPTABLE_ASPECT_RATIO_LENIENCE)
+            if crop.aspect_ratio < upper_bound and crop.aspect_ratio > lower_bound:
+                crop.could_crop_correctly = True
+                break
+
+        if crop.could_crop_correctly:
+            crop.output_pts = np.float32([[-startX, -startY],
+                                [-startX, endY],
+                                [endX, endY],
+                                [endX, -startX]])
+            break
+
+    return crop
+
+
+def correct_slide_pixels(image : np.ndarray, options : Dict[str, any], name : str = "") -> Optional[np.ndarray]:
+    """
+    Crops and color-corrects a decoded slide scan, without reading or writing any files. See correct_slide for options.
+
+    :param image: The BGR scan, may be color corrected in place
+    :param name: Used in debug output
+    :returns: The corrected image, or None if no slide could be found in it
     """
-    # Initialize options if None
-    if options is None:
-        options = {}
-    
     # Get options with default values and ensure they are boolean
     disable_crop = bool(options.get("slidesDisableCrop", False))
     disable_color_correction = bool(options.get("slidesDisableColorCorrection", False))
     enforce_aspect_ratio = options.get("slidesEnforceAspectRatio", "Any")
-    
-    file_name, file_extension = os.path.splitext(os.path.basename(from_path))
-    to_path = os.path.join(to_dir, f"{file_name}{file_extension}")
-    
-    image = cv2.imread(from_path)
-    pil_image = Image.open(from_path)
-    
-    dpi = pil_image.info.get("dpi", (None, None))[0]
+    detection_long_edge = int(options.get("slidesDetectionLongEdge", DETECTION_PROXY_LONG_EDGE))
 
     # Initialize output image
     out = image
     could_crop_correctly = False
-    input_pts = None
-    output_pts = None
-    max_width = 0
-    max_height = 0
 
     # Perform cropping if not disabled
     if not disable_crop:
-        height, width, _ = image.shape
-
-        offset = SAMPLING_OFFSET_DISTANCE
-        bg_colors = [
-            tuple(image[height - offset, width // 2]),
-            tuple(image[height // 2, width - offset]),
-            tuple(image[offset, width // 2]),
-            tuple(image[height // 2, offset])
-        ]
-        
-        for threshhold_offset in [0, 1, -1, 2, -2, 4, -4]:
-            threshhold = BACKGROUND_CROPPING_AGGRESSION + threshhold_offset
-            
-            output_image = np.ones_like(image) * 0
-
-            for color in bg_colors:
-                distance = np.linalg.norm(image - np.array(color), axis=2)
-                mask = distance < threshhold
-                output_image[mask] = (255, 255, 255)
-
-            kernel = np.ones((8, 8), np.float32)
-            output_image = cv2.filter2D(output_image, -1, kernel)
-
-            output_image = cv2.bitwise_not(output_image)
-
-            gray_output = cv2.cvtColor(output_image, cv2.COLOR_BGR2GRAY)
-            _, binary_output = cv2.threshold(gray_output, 1, 255, cv2.THRESH_BINARY)
-
-            (contours, _) = cv2.findContours(binary_output, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-
-            # Variables to store the largest rotated rectangle
-            largest_area = 0
-            largest_box = None
-
-            # Loop through the contours to find the largest rotated rectangle
-            for contour in contours:
-                rect = cv2.minAreaRect(contour)  # Get the rotated rectangle
-                box = cv2.boxPoints(rect)       # Get the 4 corner points of the rectangle
-                box = np.int32(box)              # Convert to integer coordinates
-
-                # Calculate the area of the rectangle
-                width, height = rect[1]
-                area = width * height
-
-                # Check if this is the largest rectangle so far
-                if area > largest_area:
-                    largest_area = area
-                    largest_box = box
-
-            if largest_box is None:
-                print(f"Could not box {from_path}!")
-                return [to_path]
-
-            ordered_box = order_points(largest_box)
-
-            pt_A, pt_B, pt_C, pt_D = ordered_box
-
-            # Compute the difference for the top edge (A -> B)
-            delta_x = pt_B[0] - pt_A[0]
-            delta_y = pt_B[1] - pt_A[1]
-
-            # Calculate the angle in radians and convert to degrees
-            angle_radians = math.atan2(delta_y, delta_x)
-            angle_degrees = math.degrees(angle_radians)
-
-            if abs(angle_degrees) > ACCEPTABLE_TILT:
-                print(f"Detected tilt on {to_path}: {angle_degrees:.2f}°")
-                continue
-
-            width_AD = np.sqrt(((pt_A[0] - pt_D[0]) ** 2) + ((pt_A[1] - pt_D[1]) ** 2))
-            width_BC = np.sqrt(((pt_B[0] - pt_C[0]) ** 2) + ((pt_B[1] - pt_C[1]) ** 2))
-            max_width = max(int(width_AD), int(width_BC))
-
-            height_AB = np.sqrt(((pt_A[0] - pt_B[0]) ** 2) + ((pt_A[1] - pt_B[1]) ** 2))
-            height_CD = np.sqrt(((pt_C[0] - pt_D[0]) ** 2) + ((pt_C[1] - pt_D[1]) ** 2))
-            max_height = max(int(height_AB), int(height_CD))
-
-            input_pts = np.float32([pt_A, pt_B, pt_C, pt_D])
-
-            endY = int(max_height * NEGATIVE_PADDING_FACTOR)
-            endX = int(max_width * NEGATIVE_PADDING_FACTOR)
-            startY = int(endY - max_height)
-            startX = int(endX - max_width)
-
-            aspect_ratio = max(max_width, max_height) / min(max_width, max_height)
-            
-            # Determine which aspect ratios to use based on the enforce_aspect_ratio option
-            aspect_ratio_map = {
-                "4:3": 1.33,
-                "3:2": 1.5,
-                "1:1": 1
-            }
-            
-            if enforce_aspect_ratio == "Any":
-                # Use all acceptable aspect ratios
-                aspect_ratios_to_check = ACCEPTABLE_ASPECT_RATIOS
-            elif enforce_aspect_ratio in aspect_ratio_map:
-                # Use only the specified aspect ratio
-                aspect_ratios_to_check = [aspect_ratio_map[enforce_aspect_ratio]]
-            else:
-                # Default to all acceptable aspect ratios if the option is not recognized
-                aspect_ratios_to_check = ACCEPTABLE_ASPECT_RATIOS
-            
-            for acceptable_aspect_ratio in aspect_ratios_to_check:
-                lower_bound = acceptable_aspect_ratio * (1 - ACCEPTABLE_ASPECT_RATIO_LENIENCE)
-                upper_bound = acceptable_aspect_ratio * (1 + ACCEPTABLE_ASPECT_RATIO_LENIENCE)
-                if aspect_ratio < upper_bound and aspect_ratio > lower_bound:
-                    could_crop_correctly = True
-                    break
-
-            if could_crop_correctly:
-                output_pts = np.float32([[-startX, -startY],
-                                    [-startX, endY],
-                                    [endX, endY],
-                                    [endX, -startX]])
-                break
+        with stage(STAGE_DETECT):
+            crop = find_slide_crop(image, enforce_aspect_ratio, detection_long_edge, name)
+        if crop is None:
+            return None
+        could_crop_correctly = crop.could_crop_correctly
 
         # Apply cropping if it was successful
         if could_crop_correctly:
-            # Compute the perspective transform M (stretches image to fit rectangle)
-            M = cv2.getPerspectiveTransform(input_pts, output_pts)
-            
-            # Warp image by perspective transform
-            out = cv2.warpPerspective(image, M, (max_width, max_height), flags=cv2.INTER_LINEAR)
-
-            # Could probably skip doing this by rewriting order_points but whatever
-            out = cv2.flip(out, 0)
-            out = cv2.rotate(out, 0)
+            with stage(STAGE_WARP):
+                # Compute the perspective transform M (stretches image to fit rectangle)
+                M = cv2.getPerspectiveTransform(crop.input_pts, crop.output_pts)
+
+                # Warp image by perspective transform
+                out = cv2.warpPerspective(image, M, (crop.max_width, crop.max_height), flags=cv2.INTER_LINEAR)
+
+                # Could probably skip doing this by rewriting order_points but whatever
+                out = cv2.flip(out, 0)
+                out = cv2.rotate(out, 0)
         else:
-            print(f"{max_height} {max_width} {aspect_ratio}")
-            print("Could not match to a known aspect ratio!")
+            logger.debug("Could not match %s to a known aspect ratio! %s x %s is %s", name, crop.max_height, crop.max_width, crop.aspect_ratio)
             out = image
 
     # Apply color correction only if:
     # 1. Cropping is disabled OR cropping was successful, AND
     # 2. Color correction is not disabled
     if (disable_crop or could_crop_correctly) and not disable_color_correction:
-        out = simplest_cb(out, 1)
+        with stage(STAGE_COLOR_BALANCE):
+            out = simplest_cb(out, 1, out=out)
+
+    return out
+
+
+def correct_slide(from_path: str, to_dir: str, options: Dict[str, any] = None) -> List[str]:
+    """
+    Crops and color-corrects an image of a slide, then saves it to a folder.
 
-    # Convert OpenCV image (BGR) to PIL Image (RGB) and save with DPI information
-    out_rgb = cv2.cvtColor(out, cv2.COLOR_BGR2RGB)
-    pil_image_out = Image.fromarray(out_rgb)
-    pil_image_out.save(to_path, dpi=(dpi, dpi), subsampling=0, quality=95)
+    :param from_path: The path to the slide image to correct
+    :param to_dir: the directory to save the corrected image to
+    :param options: Dictionary of options that can control the correction process
+        - slidesDisableCrop: If True, image cropping is not performed
+        - slidesDisableColorCorrection: If True, color correction is not performed
+        - slidesEnforceAspectRatio: Specifies which aspect ratio to enforce when cropping
+          - "Any" (default): Allow any of the acceptable aspect ratios (1.5, 1.33, 1)
+          - "4:3": Only allow 4:3 aspect ratio (1.33)
+          - "3:2": Only allow 3:2 aspect ratio (1.5)
+          - "1:1": Only allow 1:1 aspect ratio (1)
+        - slidesDetectionLongEdge: Long edge in pixels of the downscaled copy the slide is detected on.
+          Defaults to DETECTION_PROXY_LONG_EDGE; 0 detects on the full resolution image.
+
+    :returns: The name of the path saved to.
+    """
+    # Initialize options if None
+    if options is None:
+        options = {}
+    
+    file_name, file_extension = os.path.splitext(os.path.basename(from_path))
+    to_path = os.path.join(to_dir, f"{file_name}{file_extension}")
+    
+    with stage(STAGE_DECODE):
+        scan = read_scan(from_path)
+    out = correct_slide_pixels(scan.pixels, options, to_path)
+    if out is None:
+        return [to_path]
+
+    with stage(STAGE_ENCODE):
+        write_scan(to_path, out, scan.dpi)
 
     return [to_path]
@@ -1,3 +1,847 @@
-from django.test import TestCase
+import concurrent.futures
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
+import numpy as np
+from django.test import SimpleTestCase
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
 
-# Create your tests here.
+from benchmarks.synthetic import make_synthetic_print, make_synthetic_slide
+from corr import base_correct, views
+from corr.audio import audio_correct
+from corr.color_balance import simplest_cb, simplest_cb_sorted
+from corr.correct_result import CorrectResult
+from corr.delegates import get_delegate
+from corr.jobs import JOB_DONE, JOB_RUNNING, CorrectionJob
+from corr.manifest import MANIFEST_FILE_NAME, CorrectionManifest, ManifestTracker, normalize_options
+from corr.scheduler import MemoryAwareScheduler, MemoryBudget, SchedulerStats
+from corr.shared_buffers import SharedBufferPool, open_shared_array
+from corr.worker_pool import WorkerPool, ping_worker
+from corr.slides.slides_correct import (
+    DETECTION_PROXY_LONG_EDGE,
+    find_slide_crop,
+    make_detection_proxy,
+    order_points,
+)
+from corr.video import vhs_correct
+from corr.video.vhs_correct import VideoInfo, get_stream_copy_problem, parse_keyframe_seconds, parse_video_description
+
+# How far, in full resolution pixels, a corner found on the proxy may be from the real corner
+MAX_PROXY_CORNER_ERROR = 6
+
+
+class ProxySlideDetectionTests(SimpleTestCase):
+    def assert_corners_close(self, image, true_corners, detection_long_edge = DETECTION_PROXY_LONG_EDGE):
+        crop = find_slide_crop(image, detection_long_edge = detection_long_edge)
+
+        self.assertIsNotNone(crop)
+        self.assertTrue(crop.could_crop_correctly)
+        corner_error = np.abs(crop.input_pts - order_points(true_corners)).max()
+        self.assertLess(corner_error, MAX_PROXY_CORNER_ERROR)
+
+    def test_straight_slide(self):
+        image, corners = make_synthetic_slide(4800, 3200, 3000, 2000)
+        self.assert_corners_close(image, corners)
+
+    def test_tilted_slides(self):
+        for seed, tilt in enumerate([1.5, -3, 4]):
+            with self.subTest(tilt = tilt):
+                image, corners = make_synthetic_slide(4800, 3200, 3000, 2000, tilt, seed)
+                self.assert_corners_close(image, corners)
+
+    def test_other_aspect_ratios(self):
+        for seed, (slide_width, slide_height) in enumerate([(2400, 2400), (2800, 2100), (2000, 3000)]):
+            with self.subTest(size = (slide_width, slide_height)):
+                image, corners = make_synthetic_slide(4800, 3600, slide_width, slide_height, 2, seed)
+                self.assert_corners_close(image, corners)
+
+    def test_smaller_proxy(self):
+        image, corners = make_synthetic_slide(4800, 3200, 3000, 2000, -2)
+        self.assert_corners_close(image, corners, detection_long_edge = 1200)
+
+    def test_full_resolution_detection(self):
+        image, corners = make_synthetic_slide(1500, 1000, 900, 600, 3)
+        self.assert_corners_close(image, corners, detection_long_edge = 0)
+
+    def test_small_images_are_not_downscaled(self):
+        image, _ = make_synthetic_slide(1200, 800, 750, 500)
+        proxy, scale = make_detection_proxy(image, DETECTION_PROXY_LONG_EDGE)
+
+        self.assertIs(proxy, image)
+        self.assertEqual(scale, 1)
+
+
+class ColorBalanceTests(SimpleTestCase):
+    def assert_same_as_sorted(self, image, percent):
+        expected = simplest_cb_sorted(image.copy(), percent)
+        self.assertTrue(np.array_equal(simplest_cb(image, percent), expected))
+        # In place gives the same result
+        self.assertTrue(np.array_equal(simplest_cb(image.copy(), percent, out=image), expected))
+
+    def test_random_images(self):
+        rng = np.random.default_rng(0)
+        for dtype in [np.uint8, np.uint16]:
+            for percent in [0.5, 1, 5, 25]:
+                with self.subTest(dtype = dtype, percent = percent):
+                    image = rng.integers(0, np.iinfo(dtype).max, (120, 90, 3), dtype = dtype, endpoint = True)
+                    self.assert_same_as_sorted(image, percent)
+
+    def test_small_images(self):
+        rng = np.random.default_rng(3)
+        for dtype in [np.uint8, np.uint16]:
+            for height, width in [(1, 1), (2, 3), (7, 5)]:
+                with self.subTest(dtype = dtype, size = (height, width)):
+                    image = rng.integers(0, 250, (height, width, 3), dtype = dtype)
+                    self.assert_same_as_sorted(image, 10)
+
+    def test_narrow_ranges(self):
+        rng = np.random.default_rng(1)
+        for dtype in [np.uint8, np.uint16]:
+            with self.subTest(dtype = dtype):
+                image = rng.integers(100, 140, (64, 64, 3), dtype = dtype)
+                self.assert_same_as_sorted(image, 1)
+
+    def test_flat_channels(self):
+        rng = np.random.default_rng(2)
+        for dtype in [np.uint8, np.uint16]:
+            for percent in [1, 10]:
+                with self.subTest(dtype = dtype, percent = percent):
+                    image = rng.integers(0, 200, (50, 70, 3), dtype = dtype)
+                    image[..., 1] = 77
+                    self.assert_same_as_sorted(image, percent)
+                    self.assert_same_as_sorted(np.full((50, 70, 3), 200, dtype = dtype), percent)
+
+
+def write_test_wav(path, sample_rate = 8000, seconds = 20, silence_seconds = 4, seed = 0):
+    """A stereo tone with near silence at each end, a short click in the lead-in and a quieter right channel."""
+    import soundfile as sf
+
+    rng = np.random.default_rng(seed)
+    frames = np.arange(int(seconds * sample_rate))
+    tone = 0.3 * np.sin(2 * np.pi * 440 * frames / sample_rate)
+    is_silent = (frames < silence_seconds * sample_rate) | (frames >= (seconds - silence_seconds) * sample_rate)
+    mono = np.where(is_silent, 0, tone) + rng.normal(0, 0.001, len(frames))
+    # Too short to count as the track starting
+    click_start = sample_rate
+    mono[click_start:click_start + sample_rate // 5] += 0.2
+    sf.write(path, np.stack([mono, mono * 0.5], axis = 1).astype(np.float32), sample_rate, subtype = "PCM_16")
+
+
+class AudioStreamingTests(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.wav_path = os.path.join(self.folder, "tape.wav")
+
+    def get_in_memory_trim_and_gains(self, silence_threshold_db):
+        import librosa
+
+        y, sr = librosa.load(self.wav_path, sr = None, mono = False)
+        start, end = audio_correct.get_start_and_end(librosa.to_mono(y), sr, silence_threshold_db)
+        gains = [audio_correct.compute_gain(channel[start:end], audio_correct.FINAL_DBFS) for channel in y]
+        return (start, end), gains
+
+    def get_streaming_trim_and_gains(self, silence_threshold_db):
+        import soundfile as sf
+
+        sr = sf.info(self.wav_path).samplerate
+        hop_energies, block_peaks, num_samples = audio_correct.scan_audio_blocks(self.wav_path)
+        intervals = audio_correct.get_intervals_from_hop_energies(hop_energies, num_samples, silence_threshold_db)
+        start, end = audio_correct.get_start_and_end_from_intervals(intervals, sr, num_samples)
+        peaks = audio_correct.get_channel_peaks(self.wav_path, block_peaks, start, end)
+        gains = [audio_correct.compute_gain_from_peak(peak, audio_correct.FINAL_DBFS) for peak in peaks]
+        return (start, end), gains
+
+    def test_streaming_matches_in_memory(self):
+        for seconds, silence_seconds in [(20, 4), (23.3, 5.1), (6, 0)]:
+            for silence_threshold_db in [20, 40]:
+                with self.subTest(seconds = seconds, silence_seconds = silence_seconds, silence_threshold_db = silence_threshold_db):
+                    write_test_wav(self.wav_path, seconds = seconds, silence_seconds = silence_seconds)
+                    expected_trim, expected_gains = self.get_in_memory_trim_and_gains(silence_threshold_db)
+                    trim, gains = self.get_streaming_trim_and_gains(silence_threshold_db)
+
+                    self.assertEqual(trim, expected_trim)
+                    for gain, expected_gain in zip(gains, expected_gains):
+                        self.assertAlmostEqual(gain, expected_gain, places = 5)
+
+    @skipUnless(shutil.which("ffmpeg"), "needs ffmpeg")
+    def test_failed_stream_leaves_nothing_behind(self):
+        write_test_wav(self.wav_path)
+        to_path = os.path.join(self.folder, "tape.mp3")
+        encoders = []
+        real_popen = subprocess.Popen
+        def popen(*args, **kwargs):
+            encoders.append(real_popen(*args, **kwargs))
+            return encoders[-1]
+        def write_then_fail(encoder, *args):
+            encoder.stdin.write(bytes(8000))
+            raise RuntimeError("corrupt block")
+
+        with mock.patch.object(audio_correct.subprocess, "Popen", popen), \
+        mock.patch.object(audio_correct, "write_trimmed_blocks", write_then_fail):
+            with self.assertRaises(RuntimeError):
+                audio_correct.correct_audio_streaming(self.wav_path, to_path, 20)
+
+        self.assertIsNotNone(encoders[0].returncode)
+        self.assertFalse(os.path.exists(to_path))
+
+
+def sleep_for_task(task):
+    name, task_bytes, seconds = task
+    time.sleep(seconds)
+    return name
+
+
+class SchedulerTests(SimpleTestCase):
+    def get_start_order(self, tasks, budget, max_workers = 4, **scheduler_options):
+        started = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            scheduler = MemoryAwareScheduler(budget, max_workers, executor, **scheduler_options)
+            for _ in scheduler.run(tasks, sleep_for_task, lambda task: task[1], on_task_started = lambda task: started.append(task[0])):
+                pass
+        return started
+
+    def test_backfills_around_a_task_that_does_not_fit(self):
+        # "wide" doesn't fit next to "big", so the small tasks run while it waits
+        tasks = [("big", 60, 0.3), ("wide", 50, 0.05)] + [(f"small {i}", 20, 0.05) for i in range(8)]
+        started = self.get_start_order(tasks, MemoryBudget(100))
+
+        self.assertEqual(started[0], "big")
+        self.assertGreater(started.index("wide"), 1)
+
+    def test_stops_backfilling_once_the_largest_task_waited_too_long(self):
+        tasks = [("big", 60, 0.3), ("wide", 50, 0.05)] + [(f"small {i}", 20, 0.05) for i in range(8)]
+        started = self.get_start_order(tasks, MemoryBudget(100), head_of_line_max_wait_seconds = 0)
+
+        self.assertEqual(started[:2], ["big", "wide"])
+
+    def test_oversized_tasks_run_alone_on_a_shared_budget(self):
+        budget = MemoryBudget(100)
+        reserved_when_started = []
+        def run_pool(name):
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                scheduler = MemoryAwareScheduler(budget, 1, executor)
+                tasks = [(name, 150, 0.2)]
+                for _ in scheduler.run(tasks, sleep_for_task, lambda task: task[1], on_task_started = lambda task: reserved_when_started.append(budget.reserved_bytes)):
+                    pass
+
+        threads = [threading.Thread(target = run_pool, args = (name,)) for name in ["images", "audio"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(reserved_when_started, [150, 150])
+        self.assertEqual(budget.reserved_bytes, 0)
+
+    def test_failed_submit_gives_memory_back(self):
+        budget = MemoryBudget(100)
+        tasks = [("first", 30, 0.3), ("second", 20, 0.3)]
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            real_submit = executor.submit
+            calls = []
+            def submit(*args):
+                calls.append(args)
+                if len(calls) > 1:
+                    raise RuntimeError("cannot schedule new futures after shutdown")
+                return real_submit(*args)
+
+            with mock.patch.object(executor, "submit", side_effect = submit):
+                scheduler = MemoryAwareScheduler(budget, 2, executor)
+                with self.assertRaises(RuntimeError):
+                    list(scheduler.run(tasks, sleep_for_task, lambda task: task[1]))
+
+        self.assertEqual(budget.reserved_bytes, 0)
+
+    def test_abandoned_run_gives_memory_back(self):
+        budget = MemoryBudget(100)
+        tasks = [("slow", 40, 0.5), ("fast", 30, 0.01), ("next", 20, 0.01)]
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            scheduler = MemoryAwareScheduler(budget, 2, executor)
+            results = scheduler.run(tasks, sleep_for_task, lambda task: task[1])
+            task, _ = next(results)
+            self.assertEqual(task[0], "fast")
+            # "slow" is still running
+            self.assertEqual(budget.reserved_bytes, 40)
+            results.close()
+
+        self.assertEqual(budget.reserved_bytes, 0)
+
+    def test_failing_on_task_started_gives_memory_back(self):
+        budget = MemoryBudget(100)
+        def on_task_started(task):
+            if task[0] == "second":
+                raise ValueError("could not mark the file as running")
+
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            scheduler = MemoryAwareScheduler(budget, 2, executor)
+            with self.assertRaises(ValueError):
+                list(scheduler.run([("first", 30, 0.2), ("second", 20, 0.2)], sleep_for_task, lambda task: task[1], on_task_started = on_task_started))
+
+        self.assertEqual(budget.reserved_bytes, 0)
+
+
+class MediaPoolTests(SimpleTestCase):
+    def test_a_failed_pool_fails_the_batch(self):
+        tasks = [
+            base_correct.CorrectTask("/raw/a.jpg", "/corrected", get_delegate("correct_slide"), {}),
+            base_correct.CorrectTask("/raw/b.wav", "/corrected", get_delegate("correct_audio"), {}),
+        ]
+        def run_task_group(tasks, do_task, budget, num_workers, options, manifests, progress, label):
+            if label == "audio pool":
+                raise RuntimeError("scheduler broke")
+            return [CorrectResult(task.file_path, True, "Corrected") for task in tasks], 0, SchedulerStats(len(tasks))
+
+        summary = base_correct.CorrectionSummary()
+        with mock.patch.object(base_correct, "run_task_group", run_task_group):
+            with self.assertRaises(RuntimeError), self.assertLogs("corr.base_correct", "ERROR"):
+                base_correct.run_media_pools(tasks, base_correct.do_correct_task, {"memoryBudgetMb" : 100}, ManifestTracker(), base_correct.CorrectionProgress(), summary)
+
+        # The pool that worked still finished
+        self.assertEqual(summary.processed, 1)
+        self.assertEqual(list(summary.scheduler_stats), ["images"])
+
+
+class ManifestTests(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.corrected_folder = os.path.join(self.folder, "Corrected")
+        os.makedirs(self.corrected_folder)
+        self.file_path = self.write_file(os.path.join(self.folder, "slide.jpg"), b"scan" * 1000)
+        self.output_path = self.write_file(os.path.join(self.corrected_folder, "slide.jpg"), b"corrected")
+        self.options = {"slidesCropPadding" : 4, "printsCropPadding" : 2}
+
+    def write_file(self, path, data):
+        with open(path, "wb") as file:
+            file.write(data)
+        return path
+
+    def set_mtime(self, path, mtime_ns):
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def record(self):
+        """Records the file as corrected, saves the manifest and returns a freshly loaded copy of it."""
+        manifests = ManifestTracker()
+        manifests.record_result(self.file_path, self.corrected_folder, "correct_slide", self.options, True, [self.output_path])
+        manifests.save_all()
+        return CorrectionManifest.load(self.corrected_folder)
+
+    def is_up_to_date(self, manifest, options = None):
+        return manifest.is_up_to_date(self.file_path, "correct_slide", self.options if options is None else options)
+
+    def test_unchanged_file_is_up_to_date(self):
+        self.assertTrue(self.is_up_to_date(self.record()))
+
+    def test_not_recorded_or_failed_file_is_not_up_to_date(self):
+        self.assertFalse(self.is_up_to_date(CorrectionManifest.load(self.corrected_folder)))
+
+        self.record()
+        manifests = ManifestTracker()
+        manifests.record_result(self.file_path, self.corrected_folder, "correct_slide", self.options, False, [])
+        manifests.save_all()
+        self.assertFalse(self.is_up_to_date(CorrectionManifest.load(self.corrected_folder)))
+
+    def test_changed_size(self):
+        manifest = self.record()
+        self.write_file(self.file_path, b"scan" * 1001)
+        self.assertFalse(self.is_up_to_date(manifest))
+
+    def test_touched_but_unchanged_file_is_up_to_date(self):
+        manifest = self.record()
+        self.set_mtime(self.file_path, os.stat(self.file_path).st_mtime_ns + 10**9)
+
+        self.assertTrue(self.is_up_to_date(manifest))
+        # The new mtime is kept, so the file isn't hashed again next time
+        self.assertTrue(manifest.is_dirty)
+        self.assertEqual(next(iter(manifest.entries.values()))["mtime_ns"], os.stat(self.file_path).st_mtime_ns)
+
+    def test_changed_contents_of_the_same_size(self):
+        manifest = self.record()
+        mtime_ns = os.stat(self.file_path).st_mtime_ns
+        self.write_file(self.file_path, b"SCAN" * 1000)
+        self.set_mtime(self.file_path, mtime_ns + 10**9)
+        self.assertFalse(self.is_up_to_date(manifest))
+
+    def test_changed_options(self):
+        manifest = self.record()
+        self.assertFalse(self.is_up_to_date(manifest, self.options | {"slidesCropPadding" : 8}))
+        self.assertFalse(self.is_up_to_date(manifest, self.options | {"slidesFlip" : True}))
+        # Other media's options, and options that don't change the output, don't matter
+        self.assertTrue(self.is_up_to_date(manifest, self.options | {"printsCropPadding" : 9, "audioDisableStreaming" : True}))
+
+    def test_normalize_options(self):
+        options = {"slidesB" : 2, "slidesA" : 1, "printsA" : 3, "vhsFfmpegThreads" : 4, "vhsTrimMode" : "auto", "force" : True}
+        self.assertEqual(list(normalize_options("correct_slide", options).items()), [("slidesA", 1), ("slidesB", 2)])
+        self.assertEqual(normalize_options("correct_vhs", options), {"vhsTrimMode" : "auto"})
+        self.assertEqual(normalize_options("correct_audio", None), {})
+
+    def test_changed_delegate(self):
+        manifest = self.record()
+        self.assertFalse(manifest.is_up_to_date(self.file_path, "correct_print", self.options))
+
+    def test_missing_output(self):
+        manifest = self.record()
+        os.remove(self.output_path)
+        self.assertFalse(self.is_up_to_date(manifest))
+
+    def test_force_runs_up_to_date_tasks(self):
+        self.record()
+        tasks = [base_correct.CorrectTask(self.file_path, self.corrected_folder, get_delegate("correct_slide"), self.options)]
+
+        self.assertEqual(base_correct.filter_up_to_date_tasks(tasks, ManifestTracker(), False), ([], tasks))
+        self.assertEqual(base_correct.filter_up_to_date_tasks(tasks, ManifestTracker(), True), (tasks, []))
+
+    def test_corrupt_manifests_correct_everything_again(self):
+        manifest_path = os.path.join(self.corrected_folder, MANIFEST_FILE_NAME)
+        for contents in ["{not json", "[]", '{"version": 1, "entries": []}', '{"version": 1, "entries": {"%s": {"size": 1}}}']:
+            with self.subTest(contents = contents):
+                with open(manifest_path, "w") as file:
+                    file.write(contents.replace("%s", self.file_path))
+                self.assertFalse(self.is_up_to_date(CorrectionManifest.load(self.corrected_folder)))
+
+    def test_unreadable_manifest_corrects_everything_again(self):
+        self.record()
+        manifest_path = os.path.join(self.corrected_folder, MANIFEST_FILE_NAME)
+        os.remove(manifest_path)
+        os.makedirs(manifest_path)
+
+        with self.assertLogs("corr.manifest", "WARNING"):
+            manifest = CorrectionManifest.load(self.corrected_folder)
+        self.assertFalse(self.is_up_to_date(manifest))
+
+    def test_other_manifest_version_corrects_everything_again(self):
+        self.record()
+        manifest_path = os.path.join(self.corrected_folder, MANIFEST_FILE_NAME)
+        with open(manifest_path) as file:
+            data = json.load(file)
+        data["version"] += 1
+        with open(manifest_path, "w") as file:
+            json.dump(data, file)
+        self.assertFalse(self.is_up_to_date(CorrectionManifest.load(self.corrected_folder)))
+
+
+# Long enough for a pipeline to correct a few small scans, short enough that a hang fails the test
+PIPELINE_TIMEOUT_SECONDS = 60
+
+
+class ImagePipelineTests(SimpleTestCase):
+    def setUp(self):
+        import cv2
+
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.corrected_folder = os.path.join(self.folder, "Corrected")
+        os.makedirs(self.corrected_folder)
+        self.tasks = []
+        for i in range(3):
+            file_path = os.path.join(self.folder, f"DoeJ_Prints_1_{i + 1}.jpg")
+            cv2.imwrite(file_path, make_synthetic_print(300, 200, i))
+            self.tasks.append(base_correct.CorrectTask(file_path, self.corrected_folder, get_delegate("correct_print"), {}))
+
+    def run_pipeline(self, executor, **run_options):
+        """Runs every task through an ImagePipeline, failing instead of hanging if it never finishes."""
+        from corr.pipeline import ImagePipeline
+
+        pipeline = ImagePipeline(MemoryBudget(1024 * 1024 * 1024), executor, 2)
+        results = {}
+        def run():
+            for task, result in pipeline.run(self.tasks, **run_options):
+                results[os.path.basename(task.file_path)] = result
+        thread = threading.Thread(target = run, daemon = True)
+        thread.start()
+        thread.join(PIPELINE_TIMEOUT_SECONDS)
+
+        self.assertFalse(thread.is_alive(), "the pipeline never finished")
+        self.assertEqual(pipeline.stats.shared_buffers.leaked, 0)
+        return results
+
+    def test_file_deleted_before_it_is_read(self):
+        os.remove(self.tasks[1].file_path)
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            results = self.run_pipeline(executor)
+
+        self.assertEqual(len(results), 3)
+        self.assertFalse(results["DoeJ_Prints_1_2.jpg"].success)
+        self.assertEqual([result.success for result in results.values()].count(False), 1)
+
+    def test_on_task_started_raises(self):
+        def on_task_started(task):
+            if task is self.tasks[0]:
+                raise RuntimeError("progress broke")
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            results = self.run_pipeline(executor, on_task_started = on_task_started)
+
+        self.assertFalse(results["DoeJ_Prints_1_1.jpg"].success)
+        self.assertEqual([result.success for result in results.values()].count(False), 1)
+
+    def test_pool_that_cannot_take_work(self):
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        executor.shutdown()
+        results = self.run_pipeline(executor)
+
+        self.assertEqual(len(results), 3)
+        self.assertFalse(any(result.success for result in results.values()))
+
+
+def double_shared_array(ref):
+    """Runs in a worker process, doubling an array in shared memory in place and returning its sum."""
+    with open_shared_array(ref) as array:
+        array *= 2
+        total = int(array.sum())
+        del array
+    return total
+
+
+class SharedBufferPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = SharedBufferPool(1024 * 1024)
+        self.addCleanup(self.pool.close)
+
+    def test_workers_see_and_change_the_same_memory(self):
+        ref, array = self.pool.acquire((100, 3), np.uint16, "scan")
+        array[:] = np.arange(300, dtype = np.uint16).reshape((100, 3))
+        del array
+
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            total = executor.submit(double_shared_array, ref).result()
+
+        self.assertEqual(total, 2 * sum(range(300)))
+        self.assertTrue(np.array_equal(self.pool.get_view(ref), 2 * np.arange(300).reshape((100, 3))))
+        self.pool.release(ref)
+        self.assertEqual(self.pool.close(), [])
+
+    def test_released_segments_are_reused(self):
+        ref, _ = self.pool.acquire((1000,), np.uint8, "first")
+        self.pool.release(ref)
+        reused_ref, _ = self.pool.acquire((900,), np.uint8, "second")
+        self.pool.release(reused_ref)
+        # Too small to take up the whole segment
+        small_ref, _ = self.pool.acquire((100,), np.uint8, "small")
+        self.pool.release(small_ref)
+
+        self.assertEqual(reused_ref.segment_name, ref.segment_name)
+        self.assertNotEqual(small_ref.segment_name, ref.segment_name)
+        self.assertEqual((self.pool.stats.segments_created, self.pool.stats.reused), (2, 1))
+
+    def test_retained_buffers_are_kept_until_every_reference_is_released(self):
+        ref, _ = self.pool.acquire((10,), np.uint8, "scan")
+        self.pool.retain(ref)
+        self.pool.release(ref)
+        self.assertIn(ref.segment_name, self.pool.in_use)
+        self.pool.release(ref)
+        self.assertNotIn(ref.segment_name, self.pool.in_use)
+
+    def test_close_reports_and_frees_leaked_buffers(self):
+        from multiprocessing import shared_memory
+
+        leaked_ref, _ = self.pool.acquire((10,), np.uint8, "leaked.jpg")
+        released_ref, _ = self.pool.acquire((10,), np.uint8, "released.jpg")
+        self.pool.release(released_ref)
+
+        with self.assertLogs("corr.shared_buffers", "WARNING"):
+            self.assertEqual(self.pool.close(), ["leaked.jpg"])
+        self.assertEqual(self.pool.stats.leaked, 1)
+        for ref in [leaked_ref, released_ref]:
+            with self.assertRaises(FileNotFoundError):
+                shared_memory.SharedMemory(name = ref.segment_name)
+        with self.assertRaises(RuntimeError):
+            self.pool.acquire((10,), np.uint8, "too late")
+
+    def test_acquire_waits_for_room(self):
+        pool = SharedBufferPool(1000, acquire_timeout_seconds = 10)
+        self.addCleanup(pool.close)
+        ref, _ = pool.acquire((800,), np.uint8, "first")
+        releaser = threading.Timer(0.2, pool.release, [ref])
+        releaser.start()
+
+        second_ref, _ = pool.acquire((700,), np.uint8, "second")
+        releaser.join()
+        self.assertGreater(pool.stats.acquire_wait_seconds, 0.1)
+        pool.release(second_ref)
+
+    def test_acquire_times_out(self):
+        pool = SharedBufferPool(1000, acquire_timeout_seconds = 0.1)
+        self.addCleanup(pool.close)
+        ref, _ = pool.acquire((800,), np.uint8, "first")
+
+        with self.assertRaises(MemoryError):
+            pool.acquire((800,), np.uint8, "second")
+        pool.release(ref)
+
+
+class BatchEndpointTests(SimpleTestCase):
+    def post(self, data):
+        request = APIRequestFactory().post("/corr/batch/", data, format = "json")
+        return views.correct_batch(request)
+
+    def item(self, **changes):
+        return {"file_path" : "/raw/DoeJ_Slides_1_1.jpg", "media_type" : "slide", "to_folder" : "/corrected"} | changes
+
+    def test_invalid_batches(self):
+        invalid_batches = {
+            "empty" : [],
+            "not a list" : {"items" : "DoeJ_Slides_1_1.jpg"},
+            "item not an object" : ["DoeJ_Slides_1_1.jpg"],
+            "missing file path" : [self.item(file_path = "")],
+            "file path not a string" : [self.item(file_path = ["/raw/a.jpg"])],
+            "to folder not a string" : [self.item(to_folder = 12)],
+            "media type not a string" : [self.item(media_type = ["slide"])],
+            "unknown media type" : [self.item(media_type = "film")],
+            "item options a string" : [self.item(options = "slidesCropPadding=4")],
+            "item options a list" : [self.item(options = ["force"])],
+            "batch options a list" : {"items" : [self.item()], "options" : ["force"]},
+        }
+        for name, data in invalid_batches.items():
+            with self.subTest(name):
+                response = self.post(data)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("Invalid batch of files to correct", str(response.data))
+
+    def test_results_in_the_order_given(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        bad_extension_path = os.path.join(folder, "notes.txt")
+        with open(bad_extension_path, "w") as file:
+            file.write("notes")
+        missing_path = os.path.join(folder, "DoeJ_Slides_1_1.jpg")
+
+        with self.assertLogs("corr.base_correct", "WARNING"):
+            response = self.post({"items" : [
+                self.item(file_path = missing_path, to_folder = os.path.join(folder, "Corrected"), options = None),
+                self.item(file_path = bad_extension_path, to_folder = os.path.join(folder, "Corrected"), options = {"slidesCropPadding" : 4}),
+            ], "options" : {"memoryBudgetMb" : 100}})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result["file_path"] for result in response.data["results"]], [missing_path, bad_extension_path])
+        self.assertEqual(response.data["failed"], 2)
+
+    def test_item_options_are_added_to_the_batch_options(self):
+        request = APIRequestFactory().post("/corr/batch/", {
+            "items" : [self.item(options = {"slidesCropPadding" : 4, "force" : False}), self.item()],
+            "options" : {"force" : True, "memoryBudgetMb" : 100},
+        }, format = "json")
+        corrector = views.make_batch_file_corrector(Request(request, parsers = [JSONParser()]))
+
+        self.assertEqual(corrector.items[0].options, {"force" : False, "memoryBudgetMb" : 100, "slidesCropPadding" : 4})
+        self.assertEqual(corrector.items[1].options, {"force" : True, "memoryBudgetMb" : 100})
+
+
+# What ffmpeg 7 prints about an input that can be copied, and about an old capture that has to be re-encoded
+COPYABLE_DESCRIPTION = """Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'tape.mp4':
+  Duration: 00:00:06.02, start: 0.000000, bitrate: 131 kb/s
+  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(progressive), 320x240 [SAR 1:1 DAR 4:3], 57 kb/s, 29.97 fps, 29.97 tbr, 30k tbn (default)
+  Stream #0:1[0x2](und): Audio: aac (LC) (mp4a / 0x6134706D), 48000 Hz, mono, fltp, 69 kb/s (default)
+At least one output file must be specified
+"""
+CAPTURE_DESCRIPTION = """Input #0, avi, from 'tape.avi':
+  Duration: 01:02:03.00, start: 0.000000, bitrate: 8000 kb/s
+  Stream #0:0: Video: mpeg2video (Main), yuv420p(tv, top first), 720x576 [SAR 16:15 DAR 4:3], 7500 kb/s, 25 fps, 25 tbr, 25 tbn
+  Stream #0:1: Audio: pcm_s16le ([1][0][0][0] / 0x0001), 48000 Hz, stereo, s16, 1536 kb/s
+At least one output file must be specified
+"""
+# A framecrc listing of the first packet after seeking to 2.5s in a 29.97 fps video with a keyframe every 60 frames
+KEYFRAME_LISTING = """#extradata 0:       44, 0x42a710d9
+#software: Lavf61.1.100
+#tb 0: 1/30000
+#media_type 0: video
+#codec_id 0: h264
+#dimensions 0: 320x240
+#sar 0: 1/1
+0,     -16942,     -14940,     1001,     3547, 0x218cf9c3
+"""
+
+
+class VhsProbeTests(SimpleTestCase):
+    def test_copyable_description(self):
+        info = parse_video_description(COPYABLE_DESCRIPTION)
+
+        self.assertEqual(info, VideoInfo(video_codec = "h264", fps = 29.97, audio_codec = "aac"))
+        self.assertIsNone(get_stream_copy_problem(info, ".mp4"))
+
+    def test_capture_description(self):
+        info = parse_video_description(CAPTURE_DESCRIPTION)
+
+        self.assertEqual(info, VideoInfo(video_codec = "mpeg2video", fps = 25, audio_codec = "pcm_s16le"))
+        self.assertEqual(get_stream_copy_problem(info, ".avi"), ".avi container")
+
+    def test_video_line_without_fps(self):
+        description = "  Stream #0:0: Video: h264 (High), yuv420p, 720x480, 30k tbn\n  Stream #0:1: Audio: aac (LC), 48000 Hz\n"
+
+        self.assertEqual(parse_video_description(description), VideoInfo(video_codec = "h264", audio_codec = "aac"))
+
+    def test_cover_art_is_skipped(self):
+        cover_art = "  Stream #0:2: Video: mjpeg (Baseline), yuvj420p, 600x600, 90k tbr, 90k tbn (attached pic)\n"
+
+        info = parse_video_description(cover_art + COPYABLE_DESCRIPTION)
+
+        self.assertEqual(info.video_codec, "h264")
+        self.assertEqual(info.fps, 29.97)
+
+    def test_no_streams(self):
+        self.assertEqual(parse_video_description("tape.mp4: No such file or directory\n"), VideoInfo())
+
+    def test_probe_video_reads_stderr(self):
+        process = subprocess.CompletedProcess([], 1, stdout = b"", stderr = COPYABLE_DESCRIPTION.encode())
+        with mock.patch.object(vhs_correct.subprocess, "run", return_value = process):
+            info = vhs_correct.probe_video("tape.mp4")
+
+        self.assertEqual(info, VideoInfo(video_codec = "h264", fps = 29.97, audio_codec = "aac"))
+
+    def test_stream_copy_problems(self):
+        copyable = VideoInfo(video_codec = "h264", fps = 29.97, audio_codec = "aac")
+        cases = [
+            (copyable, ".MKV", None),
+            (copyable, ".avi", ".avi container"),
+            (VideoInfo(video_codec = "mpeg4", fps = 29.97, audio_codec = "aac"), ".mp4", "mpeg4 video"),
+            (VideoInfo(fps = 29.97, audio_codec = "aac"), ".mp4", "no video"),
+            (VideoInfo(video_codec = "h264", fps = 29.97, audio_codec = "mp3"), ".mov", "mp3 audio"),
+            (VideoInfo(video_codec = "h264", fps = 29.97), ".mov", "no audio"),
+            (VideoInfo(video_codec = "h264", fps = 29.975, audio_codec = "aac"), ".mp4", None),
+            (VideoInfo(video_codec = "h264", fps = 30, audio_codec = "aac"), ".mp4", "30 fps"),
+            (VideoInfo(video_codec = "h264", audio_codec = "aac"), ".mp4", "None fps"),
+        ]
+        for info, extension, problem in cases:
+            with self.subTest(info = info, extension = extension):
+                self.assertEqual(get_stream_copy_problem(info, extension), problem)
+
+    def test_keyframe_before_seek(self):
+        # -14940 / 30000 seconds before 2.5s is the keyframe 60 frames in
+        self.assertAlmostEqual(parse_keyframe_seconds(KEYFRAME_LISTING, 2.5), 2.002)
+
+    def test_keyframe_on_seek(self):
+        listing = KEYFRAME_LISTING.replace("-16942,     -14940", "0,          0")
+
+        self.assertAlmostEqual(parse_keyframe_seconds(listing, 2.5), 2.5)
+
+    def test_keyframe_is_never_negative(self):
+        self.assertEqual(parse_keyframe_seconds(KEYFRAME_LISTING, 0.2), 0)
+
+    def test_listing_without_packets(self):
+        listing = "".join(line for line in KEYFRAME_LISTING.splitlines(keepends = True) if line.startswith("#"))
+
+        self.assertIsNone(parse_keyframe_seconds(listing, 2.5))
+        self.assertIsNone(parse_keyframe_seconds("", 2.5))
+
+    def test_failed_seek_finds_no_keyframe(self):
+        process = subprocess.CompletedProcess([], 1, stdout = KEYFRAME_LISTING.encode(), stderr = b"")
+        with mock.patch.object(vhs_correct.subprocess, "run", return_value = process):
+            self.assertIsNone(vhs_correct.find_keyframe_seconds("tape.mp4", 2.5))
+
+    @skipUnless(shutil.which("ffmpeg"), "needs ffmpeg")
+    def test_real_video(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "tape.mp4")
+            subprocess.run([
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "lavfi", "-i", "testsrc=size=160x120:rate=30000/1001",
+                "-f", "lavfi", "-i", "sine=f=440",
+                "-t", "6", "-c:v", "libx264", "-preset", "ultrafast", "-g", "60", "-pix_fmt", "yuv420p", "-c:a", "aac",
+                path
+            ], check = True)
+
+            self.assertIsNone(get_stream_copy_problem(vhs_correct.probe_video(path), ".mp4"))
+            self.assertAlmostEqual(vhs_correct.find_keyframe_seconds(path, 2.5), 2.002, places = 3)
+
+
+class WorkerPoolTests(SimpleTestCase):
+    def make_pool(self, num_workers = 2, max_tasks_per_worker = 3):
+        pool = WorkerPool(num_workers = num_workers, max_tasks_per_worker = max_tasks_per_worker, warm_up_delegates = [])
+        self.addCleanup(pool.shutdown, wait = False, cancel_futures = True)
+        return pool
+
+    def test_tasks_past_recycling_all_finish(self):
+        pool = self.make_pool()
+
+        with self.assertLogs("corr.worker_pool", "INFO"):
+            futures = [pool.submit(ping_worker) for _ in range(pool.num_workers * pool.max_tasks_per_worker * 4 + 1)]
+            done, not_done = concurrent.futures.wait(futures, timeout = PIPELINE_TIMEOUT_SECONDS)
+
+        self.assertEqual(len(not_done), 0)
+        self.assertGreater(len({future.result() for future in done}), pool.num_workers)
+        self.assertEqual(pool.stats.recycles, 4)
+        self.assertEqual(pool.running_tasks, 0)
+        self.assertTrue(pool.check_health()["healthy"])
+
+    def test_pool_without_workers_is_restarted(self):
+        pool = self.make_pool()
+        with self.assertLogs("corr.worker_pool", "INFO"):
+            executor = pool.start()
+
+            with mock.patch.object(pool, "get_worker_processes", return_value = {}):
+                health = pool.check_health()
+
+        self.assertFalse(health["healthy"])
+        self.assertTrue(health["restarted"])
+        self.assertIsNot(pool.executor, executor)
+        self.assertIn(pool.submit(ping_worker).result(timeout = PIPELINE_TIMEOUT_SECONDS), pool.get_worker_processes())
+
+    def test_unanswered_idle_pool_is_restarted(self):
+        pool = self.make_pool()
+        with self.assertLogs("corr.worker_pool", "INFO"):
+            executor = pool.start()
+            # Stands in for workers that are gone without the pool noticing, so pings are never answered
+            with mock.patch.object(executor, "submit", return_value = concurrent.futures.Future()):
+                health = pool.check_health(timeout = 0.5)
+
+        self.assertFalse(health["healthy"])
+        self.assertTrue(health["restarted"])
+        self.assertEqual(health["answered"], 0)
+        self.assertIsNot(pool.executor, executor)
+
+
+class JobEventStreamTests(SimpleTestCase):
+    def make_finished_job(self):
+        job = CorrectionJob("job", "test")
+        job.set_state(JOB_RUNNING)
+        job.add_event("file", { "file_path" : "a.jpg" })
+        job.set_state(JOB_DONE)
+        return job
+
+    def iterate_events(self, job, first_event_id):
+        # Finishes straight away, or fails after one keepalive instead of streaming forever
+        with mock.patch.object(views, "EVENT_STREAM_KEEPALIVE_SECONDS", 0.1):
+            messages = []
+            for message in views.iterate_job_events(job, first_event_id):
+                messages.append(message)
+                self.assertNotEqual(message, ": keepalive\n\n")
+        return messages
+
+    def test_finished_job_streams_remaining_events(self):
+        job = self.make_finished_job()
+
+        messages = self.iterate_events(job, 1)
+
+        self.assertTrue(messages[0].startswith("event: snapshot"))
+        self.assertEqual(len(messages), 3)
+        self.assertIn('"state": "done"', messages[-1])
+
+    def test_reconnect_after_final_event_ends(self):
+        job = self.make_finished_job()
+
+        for first_event_id in (len(job.events), len(job.events) + 5):
+            with self.subTest(first_event_id = first_event_id):
+                messages = self.iterate_events(job, first_event_id)
+
+                self.assertEqual(len(messages), 1)
+                self.assertTrue(messages[0].startswith("event: snapshot"))
+
+    def test_running_job_streams_until_it_finishes(self):
+        job = CorrectionJob("job", "test")
+        job.set_state(JOB_RUNNING)
+        finisher = threading.Timer(0.3, job.set_state, (JOB_DONE,))
+        finisher.start()
+        self.addCleanup(finisher.cancel)
+
+        with mock.patch.object(views, "EVENT_STREAM_KEEPALIVE_SECONDS", 0.1):
+            messages = list(views.iterate_job_events(job, 1))
+
+        self.assertIn(": keepalive\n\n", messages)
+        self.assertIn('"state": "done"', messages[-1])
@@ -14,4 +14,22 @@ urlpatterns = [
     path('prints/single/<str:file_path>/<str:to_folder>/', views.correct_single_print),
     path('audio/single/<str:file_path>/<str:to_folder>/', views.correct_single_audio),
     path('vhs/single/<str:file_path>/<str:to_folder>/', views.correct_single_vhs),
+    path('batch/', views.correct_batch),
+
+    # Endpoints for correcting in the background, returning a job id to poll
+    path('jobs/', views.list_jobs),
+    path('jobs/slides/<str:from_folder>/<str:to_folder>/', views.submit_slides_job),
+    path('jobs/prints/<str:from_folder>/<str:to_folder>/', views.submit_prints_job),
+    path('jobs/audio/<str:from_folder>/<str:to_folder>/', views.submit_audio_job),
+    path('jobs/vhs/<str:from_folder>/<str:to_folder>/', views.submit_vhs_job),
+    path('jobs/all/<str:project_folder>/', views.submit_all_job),
+    path('jobs/batch/', views.submit_batch_job),
+    path('jobs/<str:job_id>/', views.get_job),
+    path('jobs/<str:job_id>/results/', views.get_job_results),
+    path('jobs/<str:job_id>/metrics/', views.get_job_metrics),
+    path('jobs/<str:job_id>/cancel/', views.cancel_job),
+    path('jobs/<str:job_id>/events/', views.stream_job_events),
+
+    # Health of the worker processes every correction runs in
+    path('workers/', views.get_worker_health),
 ]
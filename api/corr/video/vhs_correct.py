@@ -1,31 +1,196 @@
+from dataclasses import dataclass
 import io
+import logging
 import os
-import time
-import datetime
-from typing import Dict, List
+import re
+from typing import Dict, List, Optional, Tuple
 import librosa
 import subprocess
 from corr.audio.audio_correct import get_start_and_end
+from corr.instrumentation import STAGE_DECODE, STAGE_DETECT, STAGE_FFMPEG, record_detail, stage
+
+"""
+    - How long each step took and where the clip was trimmed are kept in the file's metrics, see corr.instrumentation,
+    which end up in the correction metrics log rather than a log file next to the corrected video.
+    - Trimming copies the video and audio as they are when they're already what a re-encode would make (H.264 and
+    AAC at 29.97 FPS, in a container that holds them), which is only limited by how fast the file can be read.
+    A copy can only start on a keyframe, so the start is moved back to the keyframe before it, adding at most a
+    keyframe interval to the padding. Anything else, or a copy ffmpeg fails, is re-encoded as before. Which was done
+    and why is kept in the metrics' details as trim_method and trim_reason.
+    - The "vhsTrimMode" option can be TRIM_MODE_AUTO (the default) or TRIM_MODE_REENCODE to always re-encode.
+    - Probing is done with ffmpeg itself so nothing but ffmpeg needs to be installed.
+"""
+
+logger = logging.getLogger(__name__)
 
 AUDIO_SAMPLE_RATE = 1000
 CLIP_PADDING_SECONDS = 2
 DEFAULT_DB_THRESHHOLD = 15
 
+OUTPUT_FPS = 29.97
+OUTPUT_VIDEO_CODEC = "h264"
+OUTPUT_AUDIO_CODEC = "aac"
+# How far a source's frame rate can be from OUTPUT_FPS and still be copied
+FPS_TOLERANCE = 0.01
+# Containers ffmpeg can copy H.264 and AAC into
+STREAM_COPY_EXTENSIONS = {".mp4", ".m4v", ".mov", ".mkv"}
+
+TRIM_MODE_AUTO = "auto"
+TRIM_MODE_REENCODE = "reencode"
+TRIM_METHOD_STREAM_COPY = "stream_copy"
+TRIM_METHOD_REENCODE = "reencode"
+
+# From the stream lines ffmpeg prints about its input, e.g.
+# "Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p, 720x480, 1500 kb/s, 29.97 fps, ..."
+VIDEO_STREAM_PATTERN = re.compile(r"Stream #\d+:\d+\S*: Video: (\w+)(.*)")
+AUDIO_STREAM_PATTERN = re.compile(r"Stream #\d+:\d+\S*: Audio: (\w+)")
+# Searched for in the rest of a video stream's line, which doesn't always have it
+FPS_PATTERN = re.compile(r"([\d.]+) fps")
+# Cover art is listed as a video stream, but isn't the video
+ATTACHED_PICTURE_MARKER = "(attached pic)"
+
+
+@dataclass
+class VideoInfo:
+    video_codec : Optional[str] = None
+    fps : Optional[float] = None
+    audio_codec : Optional[str] = None
+
+
+def probe_video(from_path : str) -> VideoInfo:
+    """Reads the codecs and frame rate of a video's first video and audio streams from ffmpeg's description of it."""
+    # With no output ffmpeg describes the input and exits with an error, which is expected
+    process = subprocess.run(["ffmpeg", "-hide_banner", "-i", from_path], capture_output=True)
+    return parse_video_description(process.stderr.decode('utf-8', errors='replace'))
+
+
+def parse_video_description(description : str) -> VideoInfo:
+    """Reads the codecs and frame rate of the first video and audio streams in what ffmpeg prints about its input."""
+    info = VideoInfo()
+    for video_match in VIDEO_STREAM_PATTERN.finditer(description):
+        if ATTACHED_PICTURE_MARKER in video_match.group(2):
+            continue
+        info.video_codec = video_match.group(1)
+        fps_match = FPS_PATTERN.search(video_match.group(2))
+        if fps_match:
+            info.fps = float(fps_match.group(1))
+        break
+    audio_match = AUDIO_STREAM_PATTERN.search(description)
+    if audio_match:
+        info.audio_codec = audio_match.group(1)
+    return info
+
+
+def get_stream_copy_problem(info : VideoInfo, file_extension : str) -> Optional[str]:
+    """Why a video can't be trimmed by copying its streams, or None if it can."""
+    if file_extension.lower() not in STREAM_COPY_EXTENSIONS:
+        return f"{file_extension} container"
+    if info.video_codec != OUTPUT_VIDEO_CODEC:
+        return f"{info.video_codec or 'no'} video"
+    if info.audio_codec != OUTPUT_AUDIO_CODEC:
+        return f"{info.audio_codec or 'no'} audio"
+    if info.fps is None or abs(info.fps - OUTPUT_FPS) > FPS_TOLERANCE:
+        return f"{info.fps} fps"
+    return None
+
+
+def find_keyframe_seconds(from_path : str, seconds : float) -> Optional[float]:
+    """
+    Where the keyframe a stream copy starting at seconds would start at is, at or before seconds.
+
+    Copies the first video packet after seeking to seconds as a frame hash listing. ffmpeg seeks to the keyframe
+    before, and gives its timestamp relative to seconds, in the time base listed in the "#tb" header.
+    """
+    process = subprocess.run([
+        "ffmpeg",
+        "-hide_banner", "-loglevel", "error",
+        "-ss", str(seconds),
+        "-i", from_path,
+        "-map", "0:v:0",
+        "-c", "copy",
+        "-frames:v", "1",
+        "-f", "framecrc",
+        "pipe:1"
+    ], capture_output=True)
+    if process.returncode != 0:
+        return None
+
+    return parse_keyframe_seconds(process.stdout.decode('utf-8', errors='replace'), seconds)
+
+
+def parse_keyframe_seconds(frame_listing : str, seconds : float) -> Optional[float]:
+    """Where the first packet in a framecrc listing of a copy starting at seconds is, or None if there isn't one."""
+    time_base = None
+    for line in frame_listing.splitlines():
+        if line.startswith("#tb 0:"):
+            numerator, denominator = line.split(":", 1)[1].strip().split("/")
+            time_base = int(numerator) / int(denominator)
+        elif line and not line.startswith("#") and time_base is not None:
+            # stream index, dts, pts, duration, size, checksum
+            pts = int(line.split(",")[2])
+            return max(seconds + pts * time_base, 0)
+    return None
+
+
+def trim_by_stream_copy(from_path : str, to_path : str, start_seconds : float, end_seconds : float) -> Tuple[bool, float]:
+    """
+    Copies start_seconds to end_seconds of a video to to_path without re-encoding it, starting on the keyframe
+    at or before start_seconds.
+
+    :returns: Whether it worked, and where the copy starts
+    """
+    keyframe_seconds = find_keyframe_seconds(from_path, start_seconds)
+    if keyframe_seconds is None:
+        return False, start_seconds
+
+    process = subprocess.run([
+        "ffmpeg",
+        "-y",
+        "-hide_banner", "-loglevel", "error",
+        "-ss", f"{keyframe_seconds:.6f}",  # Seek on the input, landing exactly on the keyframe
+        "-to", str(end_seconds),
+        "-i", from_path,
+        "-map", "0:v:0",
+        "-map", "0:a:0",
+        "-c", "copy",
+        "-avoid_negative_ts", "make_zero",
+        to_path
+    ], capture_output=True)
+    if process.returncode != 0:
+        logger.warning("Could not copy %s to %s, re-encoding it instead: %s", from_path, to_path, process.stderr.decode('utf-8', errors='replace'))
+        return False, start_seconds
+    return True, keyframe_seconds
+
+
+def trim_by_reencoding(from_path : str, to_path : str, start_seconds : float, end_seconds : float, ffmpeg_threads : Optional[int]):
+    thread_args = ["-threads", str(ffmpeg_threads)] if ffmpeg_threads else []
+    subprocess.run([
+        "ffmpeg",
+        "-y",
+        "-ss", str(start_seconds),  # Start at second x, seeking on the input rather than decoding up to it
+        "-to", str(end_seconds),  # End at second y
+        "-i", from_path,  # Input video file
+        "-r", str(OUTPUT_FPS),  # Enforce 29.97 FPS
+        "-c:v", "libx264",  # Video codec
+        "-c:a", "aac",  # Audio codec
+        *thread_args,
+        to_path  # Output file
+    ], check=True)
+
+
 def correct_vhs(from_path : str, to_dir : str, options: Dict[str, any]) -> List[str]:
-    # Start timing and record start time
-    start_time = time.time()
-    start_datetime = datetime.datetime.now()
-    
     # Initialize options if None
     if options is None:
         options = {}
     
     # Get silence threshold option with default value
     silence_threshold_db = options.get("vhsSilenceThreshholdDb", 16)
+    # Set by CompleteCorrector so VHS workers running at once split the cores instead of each taking all of them
+    ffmpeg_threads = options.get("vhsFfmpegThreads")
+    trim_mode = options.get("vhsTrimMode", TRIM_MODE_AUTO)
     
     file_name, file_extension = os.path.splitext(os.path.basename(from_path))
     to_path = os.path.join(to_dir, f"{file_name}{file_extension}")
-    log_path = os.path.join(to_dir, f"{file_name}_correction_log.txt")
     
     command = [
         "ffmpeg", 
@@ -36,16 +201,18 @@ def correct_vhs(from_path : str, to_dir : str, options: Dict[str, any]) -> List[
         "-f", "wav",  # Output audio format
         "pipe:1"  # Pipe output to stdout
     ]
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    print("starting decode")
-    audio_data, error = process.communicate()
-    if process.returncode != 0:
-        print(f"Error extracting audio: {error.decode('utf-8')}")
-        return None
-    print("done with decode")
-    audio_buffer = io.BytesIO(audio_data)
-    audio, sr = librosa.load(audio_buffer, sr=None)
-    start_audio_seconds, end_audio_seconds = get_start_and_end(audio, sr, silence_threshold_db)
+    with stage(STAGE_DECODE):
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        audio_data, error = process.communicate()
+        if process.returncode != 0:
+            logger.error("Error extracting audio from %s: %s", from_path, error.decode('utf-8', errors='replace'))
+            return None
+        audio_buffer = io.BytesIO(audio_data)
+        audio, sr = librosa.load(audio_buffer, sr=None)
+
+    with stage(STAGE_DETECT):
+        start_audio_seconds, end_audio_seconds = get_start_and_end(audio, sr, silence_threshold_db)
+        stream_copy_problem = "vhsTrimMode is reencode" if trim_mode == TRIM_MODE_REENCODE else get_stream_copy_problem(probe_video(from_path), file_extension)
     start_audio_seconds /= AUDIO_SAMPLE_RATE
     end_audio_seconds /= AUDIO_SAMPLE_RATE
     
@@ -53,44 +220,28 @@ def correct_vhs(from_path : str, to_dir : str, options: Dict[str, any]) -> List[
     start_seconds = max(start_audio_seconds - CLIP_PADDING_SECONDS, 0)
     end_seconds = end_audio_seconds + CLIP_PADDING_SECONDS
     
-    print(f"Audio timing: {start_audio_seconds}, {end_audio_seconds}")
-    print(f"Final timing: {start_seconds}, {end_seconds}")
-    
-    subprocess.run([
-        "ffmpeg",
-        "-y",
-        "-i", from_path,  # Input video file
-        "-ss", str(start_seconds),  # Start at second x
-        "-to", str(end_seconds),  # End at second y
-        "-r", "29.97",  # Enforce 29.97 FPS
-        "-c:v", "libx264",  # Video codec
-        "-c:a", "aac",  # Audio codec
-        # "-threads", str(num_threads), # Use all available threads
-        to_path  # Output file
-    ], check=True)
+    with stage(STAGE_FFMPEG):
+        copied = False
+        if stream_copy_problem is None:
+            copied, start_seconds = trim_by_stream_copy(from_path, to_path, start_seconds, end_seconds)
+            if not copied:
+                stream_copy_problem = "stream copy failed"
+        if not copied:
+            trim_by_reencoding(from_path, to_path, start_seconds, end_seconds, ffmpeg_threads)
+    trim_method = TRIM_METHOD_STREAM_COPY if copied else TRIM_METHOD_REENCODE
+
+    logger.debug("Audio timing: %s, %s", start_audio_seconds, end_audio_seconds)
+    logger.debug("Final timing: %s, %s", start_seconds, end_seconds)
+    logger.debug("Trimmed by %s%s", trim_method, f" ({stream_copy_problem})" if stream_copy_problem else "")
+    record_detail("silence_threshold_db", silence_threshold_db)
+    record_detail("audio_start_seconds", round(float(start_audio_seconds), 2))
+    record_detail("audio_end_seconds", round(float(end_audio_seconds), 2))
+    record_detail("clip_start_seconds", round(float(start_seconds), 2))
+    record_detail("clip_end_seconds", round(float(end_seconds), 2))
+    record_detail("trim_method", trim_method)
+    if stream_copy_problem:
+        record_detail("trim_reason", stream_copy_problem)
 
-    # End timing and record end time
-    end_time = time.time()
-    end_datetime = datetime.datetime.now()
-    total_time = end_time - start_time
-    
-    # Log the information - append to file instead of overwriting
-    with open(log_path, 'a') as log_file:
-        log_file.write(f"\n\n========================================\n")
-        log_file.write(f"VHS Correction Log - {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}\n")
-        log_file.write(f"========================================\n")
-        log_file.write(f"File name: {os.path.basename(from_path)}\n")
-        log_file.write(f"Start time: {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}\n")
-        log_file.write(f"End time: {end_datetime.strftime('%Y-%m-%d %H:%M:%S')}\n")
-        log_file.write(f"Total correction time: {total_time:.2f} seconds ({total_time/60:.2f} minutes)\n")
-        log_file.write(f"Silence threshold: {silence_threshold_db} dB\n")
-        log_file.write(f"Audio start time: {start_audio_seconds:.2f} seconds\n")
-        log_file.write(f"Audio end time: {end_audio_seconds:.2f} seconds\n")
-        log_file.write(f"Final clip start: {start_seconds:.2f} seconds\n")
-        log_file.write(f"Final clip end: {end_seconds:.2f} seconds\n")
-        log_file.write(f"Final clip duration: {end_seconds - start_seconds:.2f} seconds\n")
-    
-    print(f"VHS correction log saved to: {log_path}")
     return [to_path]
 
 # Unused code, constants and imports:
@@ -1,19 +1,28 @@
-from typing import Callable, Dict, List, Tuple, Union, Any
+from typing import Callable, Dict, Iterator, List, Tuple, Union, Any
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
+import json
+import logging
 import os
 
 from mwlocal.helpers import CustomException, make_message
 from mwlocal.path_utils import fix_path
-from corr.base_correct import BaseCorrector, CompleteCorrector, SingleFileCorrector
-from .prints import prints_correct
-from .slides import slides_correct
-from .audio import audio_correct
-from .video import vhs_correct
+from corr.base_correct import BaseCorrector, BatchFileCorrector, BatchFileItem, CompleteCorrector, CorrectionSummary, SingleFileCorrector
+from corr.delegates import get_delegate
+from corr.exceptions import InvalidBatchRequest
+from corr.instrumentation import FileMetrics
+from corr.jobs import FINISHED_JOB_STATES, JOB_MANAGER, CorrectionJob
+from corr.worker_pool import get_worker_pool
+
+logger = logging.getLogger(__name__)
 
 PHOTO_EXTENSIONS = ["jpg", "jpeg", "tif", "tiff"]
 AUDIO_EXTENSIONS = ["mp3", "wav"]
 VIDEO_EXTENSIONS = ["mp4"]
+# How often an idle event stream sends a comment, so proxies and browsers don't drop the connection
+EVENT_STREAM_KEEPALIVE_SECONDS = 15
 
 def correct_folder(
 from_folder : str,
@@ -36,19 +45,19 @@ options : Dict[str, any]):
     """
     try:
         corrector = BaseCorrector(from_folder, to_folder, allowed_extensions, correct_file_delegate, options)
-        corrector.correct_all_files()
+        summary = corrector.correct_all_files()
     except CustomException as e:
         return e.get_response()
 
-    return Response(data=make_message("All done!"))
+    return Response(data=make_message("All done!") | summary.to_dict())
 
 
-# Media type configuration map
+# Media type configuration map, delegates are only imported once they're used, see corr.delegates
 MEDIA_CONFIG = {
-    'slide': (PHOTO_EXTENSIONS, slides_correct.correct_slide),
-    'print': (PHOTO_EXTENSIONS, prints_correct.correct_print),
-    'audio': (AUDIO_EXTENSIONS, audio_correct.correct_audio),
-    'vhs': (VIDEO_EXTENSIONS, vhs_correct.correct_vhs)
+    'slide': (PHOTO_EXTENSIONS, get_delegate('correct_slide')),
+    'print': (PHOTO_EXTENSIONS, get_delegate('correct_print')),
+    'audio': (AUDIO_EXTENSIONS, get_delegate('correct_audio')),
+    'vhs': (VIDEO_EXTENSIONS, get_delegate('correct_vhs'))
 }
 
 
@@ -68,9 +77,9 @@ def get_media_config(media_type: str) -> Tuple[List[str], Callable]:
     return MEDIA_CONFIG[media_type]
 
 
-def correct_folder_media(request, from_folder: str, to_folder: str, media_type: str) -> Response:
+def make_folder_corrector(request, from_folder: str, to_folder: str, media_type: str) -> BaseCorrector:
     """
-    Generic function to correct all files of a specific media type in a folder.
+    Creates a BaseCorrector for all files of a specific media type in a folder.
     
     Args:
         request: The HTTP request
@@ -79,24 +88,35 @@ def correct_folder_media(request, from_folder: str, to_folder: str, media_type:
         media_type: Type of media to correct ('slide', 'print', 'audio', or 'vhs')
         
     Returns:
-        HTTP response with the result of the correction
+        A BaseCorrector configured for the specified media type
     """
     # Fix paths that may have lost their leading slash
     from_folder = fix_path(from_folder)
     to_folder = fix_path(to_folder)
     
-    print(f"Using from folder: {from_folder}")
-    print(f"Using to folder: {to_folder}")
+    logger.info("Requested to correct %s files in %s, saving to %s", media_type, from_folder, to_folder)
     
     options = get_options_from_request(request)
     extensions, delegate = get_media_config(media_type)
+        
+    return BaseCorrector(from_folder, to_folder, extensions, delegate, options)
+
+
+def correct_folder_media(request, from_folder: str, to_folder: str, media_type: str) -> Response:
+    """
+    Generic function to correct all files of a specific media type in a folder.
     
-    if media_type == 'audio':
-        print("requested to correct audio!")
-    elif media_type == 'vhs':
-        print("requested to correct video!")
+    Args:
+        request: The HTTP request
+        from_folder: Source folder containing files to correct
+        to_folder: Destination folder for corrected files
+        media_type: Type of media to correct ('slide', 'print', 'audio', or 'vhs')
         
-    return correct_folder(from_folder, to_folder, extensions, delegate, options)
+    Returns:
+        HTTP response with the result of the correction
+    """
+    corrector = make_folder_corrector(request, from_folder, to_folder, media_type)
+    return correct_folder(corrector.from_folder_path, corrector.to_folder_path, corrector.expected_extensions, corrector.correct_file_delegate, corrector.options)
 
 
 @api_view(['POST'])
@@ -119,7 +139,7 @@ def correct_vhs(request, from_folder : str, to_folder : str):
     return correct_folder_media(request, from_folder, to_folder, 'vhs')
 
 
-def handle_single_file_correction_response(result: Tuple[bool, Union[str, Exception], Any]) -> Response:
+def handle_single_file_correction_response(result: Tuple[bool, Union[str, Exception], Any], metrics: FileMetrics = None) -> Response:
     """
     Handles the response from a SingleFileCorrector.correct_file() call.
     
@@ -128,6 +148,7 @@ def handle_single_file_correction_response(result: Tuple[bool, Union[str, Except
             - success: Boolean indicating if the correction was successful
             - message: Success message or exception
             - output_path: Path to the corrected file if successful, None otherwise
+        metrics: The corrector's metrics, included in a successful response
             
     Returns:
         A Response object with the appropriate status code and message
@@ -135,7 +156,7 @@ def handle_single_file_correction_response(result: Tuple[bool, Union[str, Except
     success, message, output_path = result
     
     if success:
-        return Response(data=make_message(message))
+        return Response(data=make_message(message) | { "metrics" : metrics.to_dict() if metrics is not None else None })
     elif isinstance(message, CustomException):
         return message.get_response()
     elif isinstance(message, FileNotFoundError):
@@ -195,12 +216,12 @@ def correct_single_media(request, file_path: str, to_folder: str, media_type: st
     file_path = fix_path(file_path)
     to_folder = fix_path(to_folder)
     
-    print(f"Using file path: {file_path}")
-    print(f"Using to folder: {to_folder}")
+    logger.debug("Requested to correct the %s %s, saving to %s", media_type, file_path, to_folder)
     
     options = get_options_from_request(request)
     corrector = create_single_file_corrector(file_path, to_folder, media_type, options)
-    return handle_single_file_correction_response(corrector.correct_file())
+    result = corrector.correct_file()
+    return handle_single_file_correction_response(result, corrector.metrics)
 
 
 @api_view(['POST'])
@@ -223,6 +244,68 @@ def correct_single_vhs(request, file_path: str, to_folder: str):
     return correct_single_media(request, file_path, to_folder, 'vhs')
 
 
+def make_batch_file_corrector(request) -> BatchFileCorrector:
+    """
+    Creates a BatchFileCorrector from a request whose body is a list of files to correct, or an object with that
+    list as "items" and options for the whole batch as "options". Each item needs a file_path, a media_type
+    ('slide', 'print', 'audio', or 'vhs') and a to_folder, and can have its own options on top of the batch's.
+
+    Raises:
+        InvalidBatchRequest: If the body isn't a list of items like that
+    """
+    data = request.data
+    items_data = data.get("items") if isinstance(data, dict) else data
+    if not isinstance(items_data, list) or not items_data:
+        raise InvalidBatchRequest("expected a non-empty list of files")
+    batch_options = get_options_from_request(request) or {}
+    if not isinstance(batch_options, dict):
+        raise InvalidBatchRequest("options is not an object")
+
+    items = []
+    for i, item_data in enumerate(items_data):
+        if not isinstance(item_data, dict):
+            raise InvalidBatchRequest(f"item {i} is not an object")
+        required_keys = ["file_path", "media_type", "to_folder"]
+        missing_keys = [key for key in required_keys if not item_data.get(key)]
+        if missing_keys:
+            raise InvalidBatchRequest(f"item {i} is missing {missing_keys}")
+        non_string_keys = [key for key in required_keys if not isinstance(item_data[key], str)]
+        if non_string_keys:
+            raise InvalidBatchRequest(f"item {i}'s {non_string_keys} should be strings")
+        if item_data["media_type"] not in MEDIA_CONFIG:
+            raise InvalidBatchRequest(f"item {i} has an invalid media type: {item_data['media_type']}")
+        item_options = item_data.get("options") or {}
+        if not isinstance(item_options, dict):
+            raise InvalidBatchRequest(f"item {i}'s options is not an object")
+
+        extensions, delegate = get_media_config(item_data["media_type"])
+        items.append(BatchFileItem(
+            file_path=fix_path(item_data["file_path"]),
+            to_folder_path=fix_path(item_data["to_folder"]),
+            expected_extensions=extensions,
+            correct_file_delegate=delegate,
+            options=batch_options | item_options
+        ))
+
+    return BatchFileCorrector(items, batch_options)
+
+
+@api_view(['POST'])
+def correct_batch(request):
+    """
+    Corrects a list of individual files at once, spread over the worker pool.
+
+    Returns:
+        HTTP response with each file's result, in the order they were given, and a summary of the batch
+    """
+    try:
+        summary, results = make_batch_file_corrector(request).correct_files()
+    except CustomException as e:
+        return e.get_response()
+
+    return Response(data=make_message("All done!") | { "results" : [result.to_dict() for result in results] } | summary.to_dict())
+
+
 @api_view(['POST'])
 def correct_all(request, project_folder : str):
     """
@@ -235,16 +318,181 @@ def correct_all(request, project_folder : str):
     Returns:
         HTTP response with the result of the correction
     """
-    print(request.body)
+    logger.debug("Correct all request: %s", request.body)
     try:
-        # Fix path that may have lost its leading slash
-        project_folder = fix_path(project_folder)
-        print(f"Using project folder: {project_folder}")
-        
-        options = get_options_from_request(request)
-        complete_corrector = CompleteCorrector(project_folder=project_folder, options=options)
-        complete_corrector.correct_everything()
+        summary = make_complete_corrector(request, project_folder).correct_everything()
     except CustomException as e:
         return e.get_response()
 
-    return Response(data=make_message("All done!"))
+    return Response(data=make_message("All done!") | summary.to_dict())
+
+
+def make_complete_corrector(request, project_folder : str) -> CompleteCorrector:
+    # Fix path that may have lost its leading slash
+    project_folder = fix_path(project_folder)
+    logger.info("Requested to correct everything in %s", project_folder)
+
+    options = get_options_from_request(request)
+    return CompleteCorrector(project_folder=project_folder, options=options)
+
+
+def submit_correction_job(description : str, corrector : Union[BaseCorrector, BatchFileCorrector, CompleteCorrector]) -> Response:
+    """
+    Starts correcting in the background, see corr.jobs.
+
+    Returns:
+        HTTP 202 response with the new job's id and state
+    """
+    def run_batch(job : CorrectionJob) -> CorrectionSummary:
+        corrector.progress = job
+        if isinstance(corrector, CompleteCorrector):
+            return corrector.correct_everything()
+        if isinstance(corrector, BatchFileCorrector):
+            return corrector.correct_files()[0]
+        return corrector.correct_all_files()
+
+    job = JOB_MANAGER.submit(description, run_batch)
+    return Response(data=make_message(f"Started {description}") | job.to_dict(), status=202)
+
+
+def submit_folder_media_job(request, from_folder : str, to_folder : str, media_type : str) -> Response:
+    corrector = make_folder_corrector(request, from_folder, to_folder, media_type)
+    return submit_correction_job(f"correcting {media_type} files in {corrector.from_folder_path}", corrector)
+
+
+@api_view(['POST'])
+def submit_slides_job(request, from_folder : str, to_folder : str):
+    return submit_folder_media_job(request, from_folder, to_folder, 'slide')
+
+
+@api_view(['POST'])
+def submit_prints_job(request, from_folder : str, to_folder : str):
+    return submit_folder_media_job(request, from_folder, to_folder, 'print')
+
+
+@api_view(['POST'])
+def submit_audio_job(request, from_folder : str, to_folder : str):
+    return submit_folder_media_job(request, from_folder, to_folder, 'audio')
+
+
+@api_view(['POST'])
+def submit_vhs_job(request, from_folder : str, to_folder : str):
+    return submit_folder_media_job(request, from_folder, to_folder, 'vhs')
+
+
+@api_view(['POST'])
+def submit_all_job(request, project_folder : str):
+    corrector = make_complete_corrector(request, project_folder)
+    return submit_correction_job(f"correcting everything in {corrector.project_folder}", corrector)
+
+
+@api_view(['POST'])
+def submit_batch_job(request):
+    try:
+        corrector = make_batch_file_corrector(request)
+    except CustomException as e:
+        return e.get_response()
+    return submit_correction_job(f"correcting a batch of {len(corrector.items)} files", corrector)
+
+
+@api_view(['GET'])
+def list_jobs(request):
+    return Response(data={ "jobs" : [job.to_dict() for job in JOB_MANAGER.list_jobs()] })
+
+
+@api_view(['GET'])
+def get_job(request, job_id : str):
+    """Returns a job's state, progress and the status of each of its files."""
+    try:
+        job = JOB_MANAGER.get_job(job_id)
+    except CustomException as e:
+        return e.get_response()
+
+    return Response(data=job.to_dict(include_files=True))
+
+
+@api_view(['GET'])
+def get_job_results(request, job_id : str):
+    """Returns the result of each file a job has finished so far: success, output paths, error message and duration."""
+    try:
+        job = JOB_MANAGER.get_job(job_id)
+    except CustomException as e:
+        return e.get_response()
+
+    return Response(data=job.to_dict(include_results=True))
+
+
+@api_view(['GET'])
+def get_job_metrics(request, job_id : str):
+    """Returns how long each stage of correcting a job's files took, their peak memory and bytes read and written."""
+    try:
+        job = JOB_MANAGER.get_job(job_id)
+    except CustomException as e:
+        return e.get_response()
+
+    return Response(data=job.get_metrics())
+
+
+@api_view(['POST'])
+def cancel_job(request, job_id : str):
+    try:
+        job = JOB_MANAGER.cancel(job_id)
+    except CustomException as e:
+        return e.get_response()
+
+    return Response(data=make_message(f"Cancelling {job.description}") | job.to_dict())
+
+
+@api_view(['GET'])
+def get_worker_health(request):
+    """Pings the correction workers, restarting them if one died. Returns 503 if they had to be restarted."""
+    health = get_worker_pool().check_health()
+    return Response(data=health, status=200 if health["healthy"] else 503)
+
+
+
+def format_server_sent_event(event : Dict[str, any]) -> str:
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+def iterate_job_events(job : CorrectionJob, first_event_id : int) -> Iterator[str]:
+    """Yields a job's events as Server-Sent Events from first_event_id on, until the job finishes."""
+    # Lets a client that connects part way through draw the whole job before the next event arrives
+    yield f"event: snapshot\ndata: {json.dumps(job.to_dict(include_files=True))}\n\n"
+
+    next_event_id = first_event_id
+    # A client reconnecting after the last event of a finished job would otherwise be sent keepalives forever
+    while not job.has_no_more_events(next_event_id):
+        events = job.wait_for_events(next_event_id, EVENT_STREAM_KEEPALIVE_SECONDS)
+        if not events:
+            yield ": keepalive\n\n"
+            continue
+
+        for event in events:
+            yield format_server_sent_event(event)
+            if event["event"] == "state" and event["data"]["state"] in FINISHED_JOB_STATES:
+                return
+        next_event_id = events[-1]["id"] + 1
+
+
+@require_GET
+def stream_job_events(request, job_id : str):
+    """
+    Streams a job's progress as Server-Sent Events: a "file" event as each file finishes and a "state" event as the
+    job's state changes, each with the job's elapsed time, files/sec and ETA. The stream ends when the job does.
+    A plain Django view since DRF's content negotiation rejects the text/event-stream Accept header.
+    """
+    try:
+        job = JOB_MANAGER.get_job(job_id)
+    except CustomException as e:
+        error_response = e.get_response()
+        return JsonResponse(error_response.data, status=error_response.status_code)
+
+    # Browsers resend the last id they saw when reconnecting
+    last_event_id = request.headers.get("Last-Event-ID")
+    first_event_id = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+
+    response = StreamingHttpResponse(iterate_job_events(job, first_event_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
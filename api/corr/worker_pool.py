@@ -0,0 +1,282 @@
+from dataclasses import dataclass, field
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import psutil
+
+from corr.delegates import CORRECT_DELEGATES, get_delegate_modules
+from corr.shared_buffers import ensure_shared_memory_tracker
+from mwlocal.helpers import get_setting
+from mwlocal.logs import configure_worker_logging, get_log_levels, get_worker_log_queue
+
+"""
+    - Every correction endpoint submits its work into one long-lived process pool owned by the Django process,
+    instead of starting a pool per request. Starting workers and importing cv2, numpy and librosa in them takes
+    seconds, which used to be paid again by every request, however small.
+    - Workers are warmed up when the pool starts, importing the libraries of the delegates in
+    CORRECTION_WORKER_WARM_UP, so the first file corrected doesn't pay for it. Other delegates are imported the first
+    time a worker is given one. On POSIX the modules are preloaded into the forkserver, so workers forked to replace
+    recycled ones start warm too.
+    - Workers are replaced after CORRECTION_WORKER_MAX_TASKS tasks each, so memory a worker holds on to
+    (fragmentation, caches, leaks in native libraries) can't keep growing for the life of the server. Once the pool
+    has been given that many tasks per worker, new tasks go to a fresh set of workers and the old ones exit after
+    finishing what they were given. ProcessPoolExecutor's own max_tasks_per_child isn't used, since before Python
+    3.12 it doesn't always replace the workers it retires, and the pool stops running anything.
+    - A pool whose worker died, e.g. killed for running out of memory, is broken for good. It's replaced the next
+    time something is submitted to it or its health is checked.
+    - The size and recycling are set in Django's settings, see mwlocal/settings.py.
+    - Workers log through a queue the server's log listener reads, at the server's log level, see mwlocal.logs.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Used when Django's settings don't say, 0 workers means one per core
+DEFAULT_WORKERS = 0
+DEFAULT_WORKER_MAX_TASKS = 50
+# How long a health check waits for every worker to answer
+HEALTH_CHECK_TIMEOUT_SECONDS = 10
+# Imported in every worker before it takes any tasks
+BASE_WARM_UP_MODULES = ["corr.base_correct"]
+# Imported as well as a delegate's own module when workers are warmed up for it
+DELEGATE_WARM_UP_MODULES = {
+    "correct_slide" : ["corr.pipeline"],
+    "correct_print" : ["corr.pipeline"],
+    # librosa only loads these the first time they're used
+    "correct_audio" : ["librosa.core", "librosa.effects"],
+    "correct_vhs" : ["librosa.core", "librosa.effects"],
+}
+
+
+def get_warm_up_modules(delegate_names : List[str]) -> List[str]:
+    modules = BASE_WARM_UP_MODULES + get_delegate_modules(delegate_names)
+    for delegate_name in delegate_names:
+        modules += DELEGATE_WARM_UP_MODULES.get(delegate_name, [])
+    return list(dict.fromkeys(modules))
+
+
+def warm_up_worker(module_names : List[str], log_queue : Optional[multiprocessing.Queue] = None, log_levels : Dict[str, int] = None):
+    """Runs in each worker as it starts. A module that can't be imported is left for the task needing it to report."""
+    configure_worker_logging(log_queue, log_levels or {})
+    for module_name in module_names:
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            logger.warning("Worker %s could not import %s to warm up: %s", os.getpid(), module_name, e)
+
+
+def ping_worker(delay_seconds : float = 0) -> int:
+    """Answers a health check. The delay keeps a worker busy so the checks sent with it go to the other workers."""
+    time.sleep(delay_seconds)
+    return os.getpid()
+
+
+def get_multiprocessing_context(warm_up_modules : List[str]) -> multiprocessing.context.BaseContext:
+    """
+    Workers aren't forked from the server, which has threads running. The forkserver, where there is one, forks
+    each worker from a process that already imported warm_up_modules.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(warm_up_modules)
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+@dataclass
+class WorkerPoolStats:
+    started_time : float = None
+    tasks_submitted : int = 0
+    restarts : int = 0
+    recycles : int = 0
+    last_health_check_time : float = None
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "started_time" : self.started_time,
+            "tasks_submitted" : self.tasks_submitted,
+            "restarts" : self.restarts,
+            "recycles" : self.recycles,
+            "last_health_check_time" : self.last_health_check_time,
+        }
+
+
+@dataclass
+class WorkerPool(concurrent.futures.Executor):
+    """
+    A process pool that outlives the requests using it, starting its workers warm and recycling them.
+    It's an Executor, so it can be handed to anything that takes one, but shutting it down is left to the server.
+    """
+    num_workers : int = None
+    max_tasks_per_worker : int = None
+    # Names of the delegates whose libraries workers import before taking any tasks
+    warm_up_delegates : List[str] = None
+    executor : Optional[concurrent.futures.ProcessPoolExecutor] = field(default=None, repr=False)
+    stats : WorkerPoolStats = field(default_factory=WorkerPoolStats)
+    # Tasks given to the current executor, which is replaced once it's had max_tasks_per_worker for each worker
+    executor_tasks : int = field(default=0, init=False, repr=False)
+    # Tasks submitted that haven't finished, across every executor
+    running_tasks : int = field(default=0, init=False, repr=False)
+    lock : threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        if self.num_workers is None:
+            self.num_workers = int(get_setting("CORRECTION_WORKERS", DEFAULT_WORKERS))
+        if self.num_workers <= 0:
+            self.num_workers = os.cpu_count() or 1
+        if self.max_tasks_per_worker is None:
+            self.max_tasks_per_worker = int(get_setting("CORRECTION_WORKER_MAX_TASKS", DEFAULT_WORKER_MAX_TASKS))
+        if self.warm_up_delegates is None:
+            self.warm_up_delegates = list(get_setting("CORRECTION_WORKER_WARM_UP", CORRECT_DELEGATES.keys()))
+
+    def start(self) -> concurrent.futures.ProcessPoolExecutor:
+        """Starts the workers, if they aren't already, without waiting for them to warm up."""
+        with self.lock:
+            if self.executor is None:
+                self.executor = self.make_executor()
+                self.executor_tasks = 0
+            return self.executor
+
+    def make_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        # Workers have to share the parent's resource tracker, see corr.shared_buffers
+        ensure_shared_memory_tracker()
+        warm_up_modules = get_warm_up_modules(self.warm_up_delegates)
+        context = get_multiprocessing_context(warm_up_modules)
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers = self.num_workers,
+            mp_context = context,
+            initializer = warm_up_worker,
+            initargs = (warm_up_modules, get_worker_log_queue(context), get_log_levels())
+        )
+        # Workers are only started as tasks come in, so give every one of them something to start on now
+        for _ in range(self.num_workers):
+            executor.submit(ping_worker)
+        self.stats.started_time = time.time()
+        logger.info("Started %d correction workers, each recycled after %s tasks", self.num_workers, self.max_tasks_per_worker or "unlimited")
+        return executor
+
+    def restart(self, broken_executor : concurrent.futures.ProcessPoolExecutor = None) -> concurrent.futures.ProcessPoolExecutor:
+        """
+        Replaces the workers. When broken_executor is given, only replaces them if they're still that executor's,
+        so threads that all found the same pool broken replace it once.
+        """
+        with self.lock:
+            if broken_executor is not None and self.executor is not broken_executor:
+                return self.executor
+            old_executor = self.executor
+            self.executor = self.make_executor()
+            self.executor_tasks = 0
+            self.stats.restarts += 1
+        if old_executor is not None:
+            logger.warning("Correction workers were restarted")
+            old_executor.shutdown(wait=False, cancel_futures=True)
+        return self.executor
+
+    def recycle(self, old_executor : concurrent.futures.ProcessPoolExecutor):
+        """Sends new tasks to fresh workers, letting old_executor's finish the tasks they were given and exit."""
+        with self.lock:
+            if self.executor is not old_executor:
+                return
+            self.executor = self.make_executor()
+            self.executor_tasks = 0
+            self.stats.recycles += 1
+        logger.info("Recycling correction workers after %d tasks each", self.max_tasks_per_worker)
+        old_executor.shutdown(wait=False)
+
+    def submit(self, fn : Callable, /, *args, **kwargs) -> concurrent.futures.Future:
+        executor = self.start()
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            logger.error("A correction worker died, restarting the workers")
+            executor = self.restart(executor)
+            future = executor.submit(fn, *args, **kwargs)
+        with self.lock:
+            self.stats.tasks_submitted += 1
+            self.running_tasks += 1
+            self.executor_tasks += 1
+            should_recycle = bool(self.max_tasks_per_worker) and self.executor_tasks >= self.num_workers * self.max_tasks_per_worker
+        future.add_done_callback(self.on_task_done)
+        if should_recycle:
+            self.recycle(executor)
+        return future
+
+    def on_task_done(self, future : concurrent.futures.Future):
+        with self.lock:
+            self.running_tasks -= 1
+
+    def shutdown(self, wait : bool = True, *, cancel_futures : bool = False):
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def get_worker_processes(self, executor : concurrent.futures.ProcessPoolExecutor = None) -> Dict[int, multiprocessing.process.BaseProcess]:
+        # ProcessPoolExecutor doesn't expose its processes, but keeps them by pid
+        return dict(getattr(executor or self.executor, "_processes", None) or {})
+
+    def check_health(self, timeout : float = HEALTH_CHECK_TIMEOUT_SECONDS) -> Dict[str, any]:
+        """
+        Pings every worker, restarting the pool if it's broken. Workers busy correcting files can't answer
+        until they finish, so an unresponsive pool isn't necessarily unhealthy, but one with no workers, or where
+        none answered while nothing was running, is dead and is restarted too.
+
+        :returns: Whether the pool is healthy, how many workers answered and each worker's pid, liveness and memory
+        """
+        executor = self.start()
+        restarted = False
+        answered_pids : List[int] = []
+        try:
+            futures = [executor.submit(ping_worker, 0.1) for _ in range(self.num_workers)]
+            done, _ = concurrent.futures.wait(futures, timeout=timeout)
+            answered_pids = sorted({future.result() for future in done})
+        except BrokenProcessPool:
+            logger.error("A correction worker died, restarting the workers")
+            self.restart(executor)
+            restarted = True
+
+        workers = []
+        for pid, process in self.get_worker_processes(executor).items():
+            rss_mb = None
+            try:
+                rss_mb = round(psutil.Process(pid).memory_info().rss / (1024 * 1024))
+            except psutil.Error:
+                pass
+            workers.append({ "pid" : pid, "alive" : process.is_alive(), "rss_mb" : rss_mb })
+
+        if not restarted and (not workers or (not answered_pids and self.running_tasks == 0)):
+            logger.error("No correction worker answered a health check, restarting the workers")
+            self.restart(executor)
+            restarted = True
+
+        self.stats.last_health_check_time = time.time()
+        return {
+            "healthy" : not restarted and all(worker["alive"] for worker in workers),
+            "restarted" : restarted,
+            "num_workers" : self.num_workers,
+            "max_tasks_per_worker" : self.max_tasks_per_worker,
+            "warm_up_delegates" : self.warm_up_delegates,
+            "answered" : len(answered_pids),
+            "workers" : workers,
+            "stats" : self.stats.to_dict(),
+        }
+
+
+WORKER_POOL : WorkerPool = None
+WORKER_POOL_LOCK = threading.Lock()
+
+
+def get_worker_pool() -> WorkerPool:
+    """The process-wide pool, made on first use so it picks up Django's settings."""
+    global WORKER_POOL
+    with WORKER_POOL_LOCK:
+        if WORKER_POOL is None:
+            WORKER_POOL = WorkerPool()
+        return WORKER_POOL
@@ -2,6 +2,7 @@ from dataclasses import dataclass
 import os
 from typing import List
 
+from corr.manifest import MANIFEST_FILE_NAME
 from mwlocal.helpers import NAMES_TO_DRIVES
 
 @dataclass
@@ -45,7 +46,7 @@ class BaseGroupInfo(BaseProjectInfo):
         
         file_names : List[str] = []
         for (_, _, found_file_names) in os.walk(folder):
-            file_names.extend(found_file_names)
+            file_names.extend(name for name in found_file_names if name != MANIFEST_FILE_NAME)
             # Don't try to look into deeper folders
             break
 
@@ -1,12 +1,21 @@
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
 import os
 import re
-from functools import reduce
-from PIL import Image
+from typing import Dict, List, Optional
 
 from .base import BaseGroupInfo
-from sheets.exceptions import (FinalCheckError)
+from mwlocal.helpers import get_setting
+from mwlocal.media_metadata import MediaMetadata, get_metadata_cache
+from sheets.exceptions import (FinalCheckErrors, FinalCheckProblem)
+
+"""
+    - final_check checks every file in a group and reports every problem it finds at once, as a FinalCheckErrors,
+    so a group with many problems doesn't have to be rechecked after fixing each one.
+    - DPIs are read through the media metadata cache on FINAL_CHECK_SCAN_THREADS threads, see mwlocal/media_metadata.py
+    and other/metadata_scan.py. Checking names is quick, so it's done on the calling thread.
+"""
 
 
 class PhotoMediaType(Enum):
@@ -41,6 +50,28 @@ ALLOWED_SCAN_TYPES = {
     PhotoMediaType.NEGS :   [PhotoScanType.REGULAR, PhotoScanType.HANDSCAN]
 }
 
+@dataclass
+class FileCheck:
+    """What checking one file found."""
+    problems : List[FinalCheckProblem] = field(default_factory=list)
+    index_number : Optional[int] = None
+    photo_scan_type : Optional[PhotoScanType] = None
+
+
+# Splits a file name like DoeJ_Slides_1_12_HS.jpg into its parts
+FILE_NAME_SPLITTER = re.compile(r"[.|_]")
+# Splits a group identifier like 12B into its number and letter
+NUMBER_LETTER_SPLITTER = re.compile(r"(\d+)([A-Za-z]*)$")
+DEFAULT_SCAN_THREADS = 32
+
+
+def get_number_and_letter(group_identifier : str) -> Optional[tuple]:
+    match = NUMBER_LETTER_SPLITTER.match(group_identifier)
+    if match is None:
+        return None
+    return int(match[1]) if match[1] != "" else 0, match[2]
+
+
 @dataclass
 class PhotoFinalCheckQuery(BaseGroupInfo):
     dpi : int
@@ -51,122 +82,151 @@ class PhotoFinalCheckQuery(BaseGroupInfo):
     # is_tif : bool
     
     
-    def raise_exception(self,
+    def make_problem(self,
     expected : any,
     found : any,
     field_name : str,
-    file_name : str):
-        raise FinalCheckError(f"Incorrect {field_name} in {file_name}: Expected {expected}, found {found}")
-    
-
-    def raise_exception_if_nequal(self,
-    expected : any,
-    found : any,
-    field_name : str):
-        if(expected != found):
-            raise FinalCheckError(f"Incorrect {field_name}: Expected {expected}, found {found}")
+    file_name : str = None) -> FinalCheckProblem:
+        if file_name is None:
+            message = f"Incorrect {field_name}: Expected {expected}, found {found}"
+        else:
+            message = f"Incorrect {field_name} in {file_name}: Expected {expected}, found {found}"
+        return FinalCheckProblem(message, file_name, field_name, expected, found)
 
 
-    def raise_exception_if_nequal_file(self,
+    def check_equal(self,
+    problems : List[FinalCheckProblem],
     expected : any,
     found : any,
     field_name : str,
-    file_name : str):
+    file_name : str = None):
         if(expected != found):
-            self.raise_exception(expected, found, field_name, file_name)
+            problems.append(self.make_problem(expected, found, field_name, file_name))
 
 
-    def final_check(self):
+    def check_file(self, file_name : str, metadata : MediaMetadata) -> FileCheck:
+        """Checks everything about one file, carrying on past problems where the rest of its name can still be read."""
+        check = FileCheck()
+        problems = check.problems
+
+        # Split the file name on _'s to read each part
+        split = FILE_NAME_SPLITTER.split(file_name)
+        split_len = len(split)
+        
+        # File names should only ever include either 5 (if including scan type) or 6 (if implying it's a regular scan) split strings
+        if split_len != 5 and split_len != 6:
+            problems.append(self.make_problem("<name>_<media>_<group number>_<index number>_<optional scan format>.<file extension>", file_name, "name format", file_name))
+            return check
+        
+        split_i = 0
+
+        # Make sure the name is correct
+        expected_name = f"{self.client_last_name}{self.client_first_name[0]}"
+        self.check_equal(problems, expected_name, split[split_i], "client name", file_name)
+        split_i += 1
+        
+        # Make sure the media type is correct
+        self.check_equal(problems, self.media_type.value, split[split_i], "media type", file_name)
+        split_i += 1
+        
+        # Make sure group identifier is correct, comparing its number and letter
+        if(self.group_identifier is not None):
+            expected_number_letter = get_number_and_letter(self.group_identifier)
+            found_number_letter = get_number_and_letter(split[split_i])
+            if found_number_letter is None or expected_number_letter != found_number_letter:
+                problems.append(self.make_problem(self.group_identifier, split[split_i], "group identifier", file_name))
+        split_i += 1
+        
+        # Keep the index number to check later
+        try:
+            check.index_number = int(split[split_i])
+        except ValueError:
+            problems.append(self.make_problem("a number", split[split_i], "index number", file_name))
+        split_i += 1
+
+        # If the file name was long enough to indicate it includes the scan type, check it
+        is_photo_scan_type_in_name = split_len == 6
+        if is_photo_scan_type_in_name:
+            photo_scan_type = name_to_photo_scan_type(split[split_i])
+        else:
+            photo_scan_type = PhotoScanType.REGULAR
+        if(not photo_scan_type in ALLOWED_SCAN_TYPES[self.media_type]):
+            allowed_types_names = ", ".join(scan_type.value for scan_type in ALLOWED_SCAN_TYPES[self.media_type])
+            problems.append(self.make_problem(allowed_types_names, photo_scan_type.value if photo_scan_type is not None else split[split_i], "scan_type", file_name))
+        else:
+            check.photo_scan_type = photo_scan_type
+        split_i += 1
+        
+        # Check that the extension is jpg or tif
+        if split_len == 6:
+            if split[split_i] != "jpg" and split[split_i] != "tif":
+                problems.append(self.make_problem("tif or jpg", split[split_i], "file extension", file_name))
+        
+        # Check that the DPI is correct, showing whole DPIs as they're written
+        img_dpi = int(metadata.dpi) if metadata.dpi is not None and metadata.dpi.is_integer() else metadata.dpi
+        self.check_equal(problems, self.dpi, img_dpi, "dpi", file_name)
+
+        return check
+
+
+    def find_index_number_problems(self, index_numbers : List[int]) -> List[FinalCheckProblem]:
+        """Index numbers should count up from 1 with none missing or repeated."""
+        problems = []
+        last_seen_index_number = 0
+        for index_number in sorted(index_numbers):
+            if index_number == last_seen_index_number:
+                problems.append(FinalCheckProblem(f"Two files have the group number {last_seen_index_number}!", field_name="index number", found=index_number))
+                continue
+            if index_number != last_seen_index_number + 1:
+                for missing_index_number in range(last_seen_index_number + 1, index_number):
+                    problems.append(FinalCheckProblem(f"Did not find an index number for {missing_index_number}!", field_name="index number", expected=missing_index_number))
+            last_seen_index_number = index_number
+        return problems
+
+
+    def find_problems(self) -> List[FinalCheckProblem]:
+        """Checks every file in the group, returning every problem found, in the order of the files."""
         split_project_name = self.formatted_project_name.split("_")
         fixed_project_name = f"{split_project_name[0]}_Photo_{split_project_name[2]}"
         self.formatted_project_name = fixed_project_name
 
         file_names = self.get_media_file_paths(self.is_corrected)
+        media_folder = self.get_media_folder()
+        file_paths = [os.path.join(media_folder, file_name) for file_name in file_names]
 
-        counts = {
+        threads = max(1, get_setting("FINAL_CHECK_SCAN_THREADS", DEFAULT_SCAN_THREADS))
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="final-check") as executor:
+            # Only the files that changed since they were last checked are read
+            file_metadata = get_metadata_cache().get_many(file_paths, executor.map)
+
+        counts : Dict[PhotoScanType, int] = {
             PhotoScanType.REGULAR : 0,
             PhotoScanType.HANDSCAN : 0,
             PhotoScanType.OVERSIZED : 0
         }
-
-        seen_index_numbers = []
-        for file_name in file_names:
-            # Split the file name on _'s to read each part
-            split = re.split(r"[.|_]", file_name)
-            
-            split_len = len(split)
-            
-            # File names should only ever include either 5 (if including scan type) or 6 (if implying it's a regular scan) split strings
-            if split_len != 5 and split_len != 6:
-                self.raise_exception("<name>_<media>_<group number>_<index number>_<optional scan format>.<file extension>", file_name, "name format", file_name)
-            
-            split_i = 0
-
-            # Make sure the name is correct
-            expected_name = f"{self.client_last_name}{self.client_first_name[0]}"
-            self.raise_exception_if_nequal_file(expected_name, split[split_i], "client name", file_name)
-            split_i += 1
-            
-            # Make sure the media type is correct
-            self.raise_exception_if_nequal_file(self.media_type.value, split[split_i], "media type", file_name)
-            split_i += 1
-            
-            # Make sure group identifier is correct
-            if(self.group_identifier is not None):
-                # Split into number and letter, then check both
-                number_letter_splitter = r"(\d+)([A-Za-z]*)$"
-                expected_match = re.match(number_letter_splitter, self.group_identifier)
-                found_match = re.match(number_letter_splitter, split[split_i])
-                
-                expected_number = expected_match[1]
-                expected_number = int(expected_number) if expected_number != "" else 0
-                found_number = expected_match[1]
-                found_number = int(found_number) if found_number != "" else 0
-
-                if ((expected_match == None) != (found_match == None)) or (expected_match[2] != found_match[2]) or (expected_number != found_number):
-                    self.raise_exception(self.group_identifier, split[split_i], "group identifier", file_name)
-            split_i += 1
-            
-            # Add index number to the list to check later
-            seen_index_numbers.append(int(split[split_i]))
-            split_i += 1
-
-            # If the file name was long enough to indicate it includes the scan type, check it
-            photo_scan_type : PhotoScanType
-            is_photo_scan_type_in_name = split_len == 6
-            if is_photo_scan_type_in_name:
-                photo_scan_type = name_to_photo_scan_type(split[split_i])
-            else:
-                photo_scan_type = PhotoScanType.REGULAR
-            if(not photo_scan_type in ALLOWED_SCAN_TYPES[self.media_type]):
-                # The [2:] removes the first ", "
-                allowed_types_names = reduce(lambda list, scan_type: f"{list}, {scan_type.value}", ALLOWED_SCAN_TYPES[self.media_type])[2:]
-                self.raise_exception(allowed_types_names, photo_scan_type if photo_scan_type is not None else split[split_i], "scan_type", file_name)
-            counts[photo_scan_type] += 1
-            split_i += 1
-            
-            # Check that the extension is jpg or tif
-            if split_len == 6:
-                if split[split_i] != "jpg" and split[split_i] != "tif":
-                    self.raise_exception("tif or jpg", split[split_i], "file extension", file_name)
-            
-            # Check that the DPI is correct
-            img_path = os.path.join(self.get_media_folder(), file_name)
-            img = Image.open(img_path)
-            img_dpi = img.info.get("dpi", (None, None))[0]
-            self.raise_exception_if_nequal_file(self.dpi, img_dpi, "dpi", file_name)
+        problems : List[FinalCheckProblem] = []
+        index_numbers : List[int] = []
+        for file_name, metadata in zip(file_names, file_metadata):
+            check = self.check_file(file_name, metadata)
+            problems.extend(check.problems)
+            if check.index_number is not None:
+                index_numbers.append(check.index_number)
+            if check.photo_scan_type is not None:
+                counts[check.photo_scan_type] += 1
         
         # Make sure all index numbers are in order
-        seen_index_numbers.sort()
-        last_seen_index_number = 0
-        for index_number in seen_index_numbers:
-            if index_number == last_seen_index_number:
-                raise FinalCheckError(f"Two files have the group number {last_seen_index_number}!")
-            if index_number != last_seen_index_number + 1:
-                raise FinalCheckError(f"Did not find an index number for {last_seen_index_number + 1}!")
-            last_seen_index_number = index_number
+        problems.extend(self.find_index_number_problems(index_numbers))
 
         # Make sure media counts are correct
-        self.raise_exception_if_nequal(self.count_reg, counts[PhotoScanType.REGULAR], "regular scanned photos")
-        self.raise_exception_if_nequal(self.count_hs, counts[PhotoScanType.HANDSCAN], "handscanned photos")
-        self.raise_exception_if_nequal(self.count_oshs, counts[PhotoScanType.OVERSIZED], "oversized handscanned photos")
\ No newline at end of file
+        self.check_equal(problems, self.count_reg, counts[PhotoScanType.REGULAR], "regular scanned photos")
+        self.check_equal(problems, self.count_hs, counts[PhotoScanType.HANDSCAN], "handscanned photos")
+        self.check_equal(problems, self.count_oshs, counts[PhotoScanType.OVERSIZED], "oversized handscanned photos")
+
+        return problems
+
+
+    def final_check(self):
+        """Raises a FinalCheckErrors with every problem in the group, if there are any."""
+        problems = self.find_problems()
+        if problems:
+            raise FinalCheckErrors(problems)
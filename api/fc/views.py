@@ -1,16 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+import logging
+from typing import List
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from .fc.prints import (PhotoFinalCheckQuery, PhotoMediaType)
-from sheets.sheets_requests import (SheetsRequest, SheetsResponse, RangeRequest)
+from mwlocal.helpers import get_setting
+from mwlocal.logs import get_log_context, run_in_log_context
+from sheets.sheets_requests import (SheetsRequest, SheetsResponse, SheetTable, RangeRequest)
 from sheets.exceptions import (
     CustomException,
     UnknownException,
-    MultiGroupCustomException,
-    MultiGroupUnknownException
+    FinalCheckErrors,
+    FinalCheckProblem,
+    GroupCheckResult,
+    MultiGroupFinalCheckErrors
 )
 
-from sheets.photo_row import PhotoRow
+from sheets.photo_row import (
+    PHOTO_CORRECTED_COLUMN,
+    PHOTO_IDENTIFIER_COLUMN,
+    PHOTO_ROW_LENGTH,
+    PHOTO_TABLE_FIRST_ROW,
+    PhotoRow
+)
+
+logger = logging.getLogger(__name__)
+
+# Groups final checked at once. Each reads its files on FINAL_CHECK_SCAN_THREADS threads of its own
+DEFAULT_GROUP_THREADS = 4
 
 @api_view(['GET'])
 def photo(request,
@@ -44,6 +63,8 @@ photo_type : str):
     try:
         slides_final_checker.final_check()
         return Response(data={"message" : "All good!"})
+    except CustomException as custom_exception:
+        return custom_exception.get_response()
     except Exception as e:
         return Response(data={"message" : str(e)}, status = status.HTTP_422_UNPROCESSABLE_ENTITY)
 
@@ -66,44 +87,64 @@ def check_photo_row(request, spreadsheet_id : str, group_identifier : str):
         return UnknownException(str(e)).get_response()
 
 
+def check_group(group_identifier : str, photo_row : PhotoRow) -> GroupCheckResult:
+    """Final checks one group, turning anything that goes wrong into its problems."""
+    try:
+        photo_row.to_final_check_query(group_identifier).final_check()
+        return GroupCheckResult(group_identifier, [])
+    except FinalCheckErrors as final_check_errors:
+        return GroupCheckResult(group_identifier, final_check_errors.args[0])
+    except CustomException as custom_exception:
+        return GroupCheckResult(group_identifier, [FinalCheckProblem(custom_exception.get_response().data["message"])])
+    except Exception as e:
+        return GroupCheckResult(group_identifier, [FinalCheckProblem(str(e))])
+
+
 @api_view(["GET"])
 def check_all_photo_rows(request, spreadsheet_id : str):
-    current_group = ""
-
     try:
-        # First, get all group identifiers so we know how many groups long this is
-        identifiers_request = SheetsRequest(spreadsheet_id, [RangeRequest("Photo Trns", "A11", "A")], False)
-        identifiers_response = identifiers_request.execute()
-        identifiers = identifiers_response.values[0]
-
-        # Next, get the corrected column and every photo group
-        ranges : RangeRequest = [RangeRequest("Photo Trns", f"D11", "D")]
-        for i, _ in enumerate(identifiers):
-            ranges.append(RangeRequest("Photo Trns", f"A{11 + i}", f"X{11 + i}"))
-        all_groups_request = SheetsRequest(spreadsheet_id, ranges, True)
+        # Get the client's name and the whole Photo Trns table in one go, along with the project name. The table is
+        # sent column by column, so the identifier and corrected columns arrive as lists
+        all_groups_request = SheetsRequest(spreadsheet_id, [
+            RangeRequest("Customer Info", "E6", "F6", 2),
+            RangeRequest("Photo Trns", f"A{PHOTO_TABLE_FIRST_ROW}", "X", PHOTO_ROW_LENGTH, as_table=True),
+        ], get_title=True, columnar=True)
         all_groups_response = all_groups_request.execute()
-        corrected_row = all_groups_response.values[0]
-
-        # Initialize the first row to get the project name and stuff, i don't care if this is inefficient
-        iterating_photo_row = PhotoRow(all_groups_response.values[1])
-        iterating_photo_row.pull_from_sheet(spreadsheet_id, identifiers[0])
-
-        # Final check every group
-        for i, sheets_group_row in enumerate(all_groups_response.values[1:]):
-            current_group = identifiers[i]
-            iterating_photo_row.init_from_received_data(corrected_row, sheets_group_row)
-            final_check_query : PhotoFinalCheckQuery = iterating_photo_row.to_final_check_query(identifiers[i])
-            final_check_query.final_check()
-            print(f"{current_group} is clear!")
-        
-        return Response(data={"message" : "All good!"})
-    
     except CustomException as custom_exception:
-        multi_group_custom_exception = MultiGroupCustomException(custom_exception)
-        multi_group_custom_exception.group_identifier = current_group
-        return multi_group_custom_exception.get_response()
-    
+        return custom_exception.get_response()
     except Exception as e:
-        multi_group_unknown_exception = MultiGroupUnknownException(custom_exception)
-        multi_group_unknown_exception.group_identifier = current_group
-        return multi_group_unknown_exception.get_response()
+        return UnknownException(str(e)).get_response()
+
+    name_row = all_groups_response.values[0]
+    photo_table : SheetTable = all_groups_response.values[1]
+    corrected_row = photo_table.get_column(PHOTO_CORRECTED_COLUMN)
+    # Rows without an identifier aren't groups
+    identifiers : List[str] = []
+    group_rows : List[List[str]] = []
+    for i, identifier in enumerate(photo_table.get_column(PHOTO_IDENTIFIER_COLUMN)):
+        if identifier != "":
+            identifiers.append(identifier)
+            group_rows.append(photo_table.get_row(i))
+
+    # Every group is built from the one response, then final checked at once
+    def check_row(group_identifier : str, sheets_group_row : List[str]) -> GroupCheckResult:
+        try:
+            photo_row = PhotoRow()
+            photo_row.init_from_batch_data(name_row, all_groups_response.title, corrected_row, sheets_group_row)
+        except CustomException as custom_exception:
+            return GroupCheckResult(group_identifier, [FinalCheckProblem(custom_exception.get_response().data["message"])])
+        return check_group(group_identifier, photo_row)
+
+    threads = max(1, get_setting("FINAL_CHECK_GROUP_THREADS", DEFAULT_GROUP_THREADS))
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="check-groups") as executor:
+        results = list(executor.map(run_in_log_context, repeat(get_log_context()), repeat(check_row), identifiers, group_rows))
+
+    for result in results:
+        logger.debug("%s is %s", result.group_identifier, "clear!" if result.passed else f"not clear, with {len(result.problems)} problems")
+
+    if all(result.passed for result in results):
+        return Response(data={
+            "message" : "All good!",
+            "groups" : [result.to_dict() for result in results],
+        })
+    return MultiGroupFinalCheckErrors(results).get_response()
@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mwlocal.settings')
 
 application = get_asgi_application()
+
+# Warm up the correction workers now rather than on the first correction request
+from corr.worker_pool import get_worker_pool
+get_worker_pool().start()
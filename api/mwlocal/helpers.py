@@ -10,6 +10,12 @@ def make_message(message : str):
     return { "message" : message }
 
 
+def get_setting(name : str, default : any) -> any:
+    # Benchmarks and scripts run without Django configured
+    from django.conf import settings
+    return getattr(settings, name, default) if settings.configured else default
+
+
 class CustomException(ABC, Exception):
     @abstractmethod
     def get_response(self) -> Response:
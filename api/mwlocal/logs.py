@@ -0,0 +1,153 @@
+import atexit
+from contextlib import contextmanager
+import contextvars
+import datetime
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+import queue
+import sys
+import threading
+from typing import Callable, Dict, Iterator, Optional
+
+"""
+    - Everything in the API logs through the logging module, with a logger per module (logging.getLogger(__name__)).
+    It's configured in LOGGING in mwlocal/settings.py, where LOG_LEVEL sets the verbosity. Per-file detail is
+    logged at DEBUG, so it's only written when asked for.
+    - Records are put on a queue and written to stdout by a single listener thread, so threads handling requests
+    never wait on the console. Correction workers put theirs on a multiprocessing queue the same listener's output
+    reads, see corr.worker_pool, so lines from many processes are never interleaved and workers never block on I/O.
+    - log_context() adds fields like the job id and file being corrected to every record logged inside it. They're
+    written after the message, or as their own keys with LOG_FORMAT "json". Context doesn't follow work into new
+    threads or processes on its own, see run_in_log_context.
+"""
+
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_JSON = "json"
+TEXT_FORMAT = "%(asctime)s %(levelname)-7s %(processName)s %(name)s: %(message)s"
+
+LOG_CONTEXT : contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+
+# Set by BackgroundHandler, which workers' records are forwarded to
+OUTPUT_HANDLER : Optional[logging.Handler] = None
+WORKER_QUEUE : Optional[multiprocessing.Queue] = None
+WORKER_LISTENER : Optional[QueueListener] = None
+WORKER_QUEUE_LOCK = threading.Lock()
+
+
+def get_log_context() -> Dict[str, any]:
+    return LOG_CONTEXT.get()
+
+
+@contextmanager
+def log_context(**fields) -> Iterator[None]:
+    """Adds fields to every record logged inside, on this thread, on top of any context already set."""
+    token = LOG_CONTEXT.set(LOG_CONTEXT.get() | fields)
+    try:
+        yield
+    finally:
+        LOG_CONTEXT.reset(token)
+
+
+def run_in_log_context(context : Dict[str, any], function : Callable, *args, **kwargs) -> any:
+    """
+    Runs function with context as its log context. Submit this to an executor, with the submitting thread's
+    get_log_context(), so records the function logs in another thread or process are tagged the same way.
+    """
+    with log_context(**context):
+        return function(*args, **kwargs)
+
+
+class ContextFilter(logging.Filter):
+    """Attaches the log context to records as they're logged, before they're queued."""
+    def filter(self, record : logging.LogRecord) -> bool:
+        # Records forwarded from a worker already have the worker's context
+        if not hasattr(record, "context"):
+            record.context = get_log_context()
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record : logging.LogRecord) -> str:
+        text = super().format(record)
+        context = getattr(record, "context", None)
+        if context:
+            text += " [" + " ".join(f"{name}={value}" for name, value in context.items()) + "]"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """Writes each record as a line of JSON, with its context as keys of their own."""
+    def format(self, record : logging.LogRecord) -> str:
+        line = {
+            "time" : datetime.datetime.fromtimestamp(record.created).isoformat(),
+            "level" : record.levelname,
+            "logger" : record.name,
+            "process" : record.processName,
+            "message" : record.getMessage(),
+        } | getattr(record, "context", {})
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Queues records for a listener thread that writes them to stdout. Used as the root handler in LOGGING,
+    where format is LOG_FORMAT_TEXT or LOG_FORMAT_JSON.
+    """
+    def __init__(self, format : str = LOG_FORMAT_TEXT):
+        super().__init__(queue.SimpleQueue())
+        global OUTPUT_HANDLER
+        OUTPUT_HANDLER = logging.StreamHandler(sys.stdout)
+        OUTPUT_HANDLER.setFormatter(JsonFormatter() if format == LOG_FORMAT_JSON else TextFormatter())
+        self.addFilter(ContextFilter())
+        self.listener = QueueListener(self.queue, OUTPUT_HANDLER)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def prepare(self, record : logging.LogRecord) -> logging.LogRecord:
+        # The record stays in this process, so it doesn't need QueueHandler's copy with its message formatted
+        return record
+
+
+def get_worker_log_queue(context : multiprocessing.context.BaseContext) -> Optional[multiprocessing.Queue]:
+    """
+    A queue correction workers made with context can log to, whose records are written with this process's.
+    None if logging hasn't been set up with a BackgroundHandler, e.g. in scripts.
+    """
+    global WORKER_QUEUE, WORKER_LISTENER
+    with WORKER_QUEUE_LOCK:
+        if WORKER_QUEUE is None and OUTPUT_HANDLER is not None:
+            WORKER_QUEUE = context.Queue()
+            WORKER_LISTENER = QueueListener(WORKER_QUEUE, OUTPUT_HANDLER)
+            WORKER_LISTENER.start()
+            atexit.register(WORKER_LISTENER.stop)
+        return WORKER_QUEUE
+
+
+def get_log_levels() -> Dict[str, int]:
+    """The level of the root logger and of every logger given one, so workers can be set up the same way."""
+    levels = { "" : logging.getLogger().level }
+    for name, logger in logging.Logger.manager.loggerDict.items():
+        if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+            levels[name] = logger.level
+    return levels
+
+
+def configure_worker_logging(log_queue : Optional[multiprocessing.Queue], levels : Dict[str, int]):
+    """Runs in each correction worker as it starts, sending everything it logs to log_queue at the server's levels."""
+    if log_queue is None:
+        return
+    handler = QueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
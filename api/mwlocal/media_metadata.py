@@ -0,0 +1,228 @@
+from contextlib import closing
+from dataclasses import dataclass, field
+import logging
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from PIL import Image
+import mutagen
+
+"""
+    - Final checks read the DPI of every image and the length of every audio and video file, usually of a project
+    that hasn't changed since it was last checked. What was read is kept in a SQLite database, MEDIA_METADATA_CACHE
+    in mwlocal/settings.py, shared by every app and request in the server.
+    - Entries are keyed by absolute path and are only used while the file's size and mtime (in ns) are what they
+    were when it was read, so a file that changed, or was renamed to a new path, is read again. Checking a project
+    again costs a stat of each file, plus reading the ones that changed.
+    - Only headers are read. PIL's Image.open parses a file's header and stops before the pixels, and mutagen
+    reads lengths from the stream headers. A file they parse is cached with what they found, even if that's no DPI
+    or length, as is one mutagen doesn't recognise. A read that raises, which on the NAS can be a timeout, isn't
+    cached, so the file is read again next time instead of being stuck with nothing known about it.
+    - Setting MEDIA_METADATA_CACHE to an empty string reads every file every time.
+"""
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.tif', '.tiff', '.png'}
+# Bumped when what's stored changes, which empties the cache
+SCHEMA_VERSION = 2
+# SQLite limits how many parameters a query can have
+LOOKUP_CHUNK_SIZE = 500
+# Seconds a connection waits for another thread's write to finish
+LOCK_TIMEOUT_SECONDS = 30
+
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS media_metadata (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        file_type TEXT,
+        dpi REAL,
+        width INTEGER,
+        height INTEGER,
+        duration REAL,
+        codec TEXT
+    )
+"""
+COLUMNS = ["file_type", "dpi", "width", "height", "duration", "codec"]
+
+
+@dataclass
+class MediaMetadata:
+    """What's known about a media file. Anything that couldn't be read is None."""
+    # The format PIL or mutagen read it as, e.g. JPEG, TIFF, MP3, WAVE or MP4
+    file_type : Optional[str] = None
+    # x-resolution, as saved in the file
+    dpi : Optional[float] = None
+    width : Optional[int] = None
+    height : Optional[int] = None
+    # Seconds
+    duration : Optional[float] = None
+    codec : Optional[str] = None
+    # False if reading the file raised, in which case it isn't cached
+    was_read : bool = field(default=True, compare=False)
+
+
+# The size and mtime_ns of a file, which must match for a cached entry to be used
+FileKey = Tuple[int, int]
+
+
+@dataclass
+class CacheStats:
+    hits : int = 0
+    misses : int = 0
+    lock : threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, hits : int, misses : int):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+    def to_dict(self) -> Dict[str, int]:
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+        }
+
+
+def read_media_metadata(file_path : str) -> MediaMetadata:
+    """
+    Reads a file's headers, as an image if its extension is one and otherwise with mutagen.
+    If that raises, returns nothing known about the file with was_read False.
+    """
+    metadata = MediaMetadata()
+    try:
+        if os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS:
+            with Image.open(file_path) as img:
+                metadata.file_type = img.format
+                metadata.width, metadata.height = img.size
+                dpi = img.info.get('dpi')
+                if isinstance(dpi, tuple) and len(dpi) > 0:
+                    metadata.dpi = float(dpi[0])
+        else:
+            media = mutagen.File(file_path)
+            if media is not None:
+                metadata.file_type = type(media).__name__
+                info = getattr(media, 'info', None)
+                metadata.duration = getattr(info, 'length', None)
+                metadata.codec = getattr(info, 'codec', None)
+    except Exception as e:
+        logger.debug("Could not read the metadata of %s: %s", file_path, e)
+        return MediaMetadata(was_read=False)
+    return metadata
+
+
+def get_file_key(file_path : str) -> Optional[FileKey]:
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+@dataclass
+class MetadataCache:
+    """The cache in the notes at the top. Safe to use from many threads at once."""
+    path : str = None
+    # Counted across every lookup since the server started
+    stats : CacheStats = field(default_factory=CacheStats)
+    lock : threading.Lock = field(default_factory=threading.Lock, repr=False)
+    is_set_up : bool = field(default=False, init=False)
+
+    def __post_init__(self):
+        if self.path is None:
+            # Scripts and benchmarks can use the cache without Django configured
+            from django.conf import settings
+            self.path = getattr(settings, "MEDIA_METADATA_CACHE", None) if settings.configured else None
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT_SECONDS)
+        with self.lock:
+            if not self.is_set_up:
+                # Lets lookups read while another thread writes
+                connection.execute("PRAGMA journal_mode=WAL")
+                if connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                    connection.execute("DROP TABLE IF EXISTS media_metadata")
+                    connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                connection.execute(CREATE_TABLE)
+                connection.commit()
+                self.is_set_up = True
+        return connection
+
+    def lookup(self, connection : sqlite3.Connection, paths : List[str], keys : List[Optional[FileKey]]) -> Dict[str, MediaMetadata]:
+        """The cached metadata of each path whose size and mtime haven't changed since it was read."""
+        found : Dict[str, MediaMetadata] = {}
+        key_by_path = dict(zip(paths, keys))
+        for start in range(0, len(paths), LOOKUP_CHUNK_SIZE):
+            chunk = paths[start:start + LOOKUP_CHUNK_SIZE]
+            rows = connection.execute(
+                f"SELECT path, size, mtime_ns, {', '.join(COLUMNS)} FROM media_metadata WHERE path IN ({', '.join('?' * len(chunk))})",
+                chunk
+            )
+            for path, size, mtime_ns, *values in rows:
+                if key_by_path[path] == (size, mtime_ns):
+                    found[path] = MediaMetadata(*values)
+        return found
+
+    def store(self, connection : sqlite3.Connection, entries : Iterable[Tuple[str, FileKey, MediaMetadata]]):
+        connection.executemany(
+            f"INSERT OR REPLACE INTO media_metadata (path, size, mtime_ns, {', '.join(COLUMNS)}) VALUES ({', '.join('?' * (len(COLUMNS) + 3))})",
+            [(path, *key, *(getattr(metadata, column) for column in COLUMNS)) for path, key, metadata in entries]
+        )
+        connection.commit()
+
+    def get_many(self,
+    file_paths : List[str],
+    map_function : Callable[[Callable, List[str]], Iterable] = map,
+    stats : CacheStats = None) -> List[MediaMetadata]:
+        """
+        The metadata of each file, in order, reading and caching any not in the cache.
+
+        :param map_function: Runs the stats and reads, e.g. a MetadataScanner's map_files to do them on threads
+        :param stats: Also counts the hits and misses here, e.g. for a single check
+        """
+        if not self.path:
+            self.count(0, len(file_paths), stats)
+            return list(map_function(read_media_metadata, file_paths))
+
+        abs_paths = [os.path.abspath(file_path) for file_path in file_paths]
+        key_by_path = dict(zip(abs_paths, map_function(get_file_key, abs_paths)))
+        paths = list(key_by_path)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with closing(self.connect()) as connection:
+                found = self.lookup(connection, paths, [key_by_path[path] for path in paths])
+                missing = [path for path in paths if path not in found]
+                read = list(map_function(read_media_metadata, missing))
+                # Files that are gone can't be checked for changes next time, and failed reads are retried, so neither are kept
+                self.store(connection, [
+                    (path, key_by_path[path], metadata)
+                    for path, metadata in zip(missing, read)
+                    if key_by_path[path] is not None and metadata.was_read
+                ])
+        except sqlite3.Error as e:
+            logger.warning("Could not use the media metadata cache at %s: %s", self.path, e)
+            return list(map_function(read_media_metadata, file_paths))
+
+        found.update(zip(missing, read))
+        self.count(len(paths) - len(missing), len(missing), stats)
+        return [found[path] for path in abs_paths]
+
+    def count(self, hits : int, misses : int, stats : Optional[CacheStats]):
+        self.stats.add(hits, misses)
+        if stats is not None:
+            stats.add(hits, misses)
+
+
+METADATA_CACHE : MetadataCache = None
+METADATA_CACHE_LOCK = threading.Lock()
+
+
+def get_metadata_cache() -> MetadataCache:
+    """The process-wide cache, made on first use so it picks up Django's settings."""
+    global METADATA_CACHE
+    with METADATA_CACHE_LOCK:
+        if METADATA_CACHE is None:
+            METADATA_CACHE = MetadataCache()
+        return METADATA_CACHE
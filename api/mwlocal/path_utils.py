@@ -1,6 +1,9 @@
+import logging
 import os
 import re
 
+logger = logging.getLogger(__name__)
+
 def fix_path(path: str) -> str:
     """
     Converts backslashes to forward slashes if the path is not a Windows absolute path.
@@ -18,5 +21,5 @@ def fix_path(path: str) -> str:
         # This is not a Windows absolute path, convert backslashes to forward slashes
         path = path.replace('\\', '/')
     
-    print(f"Fixed path: {path}")
+    logger.debug("Fixed path: %s", path)
     return path
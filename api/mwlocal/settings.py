@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -125,3 +126,47 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Correction worker pool, see corr/worker_pool.py
+# Worker processes shared by every correction request, 0 means one per core
+CORRECTION_WORKERS = int(os.environ.get('CORRECTION_WORKERS', 0))
+# Tasks each worker runs before it's replaced with a fresh one, 0 means never
+CORRECTION_WORKER_MAX_TASKS = int(os.environ.get('CORRECTION_WORKER_MAX_TASKS', 50))
+# Delegates whose libraries workers import as they start, see corr/delegates.py. Others are imported on first use
+CORRECTION_WORKER_WARM_UP = [name for name in os.environ.get('CORRECTION_WORKER_WARM_UP', 'correct_slide,correct_print,correct_audio,correct_vhs').split(',') if name]
+
+# JSON lines log of how correcting each file went, see corr/instrumentation.py. Set to an empty string to turn it off
+CORRECTION_METRICS_LOG = os.environ.get('CORRECTION_METRICS_LOG', str(BASE_DIR / 'logs' / 'correction_metrics.jsonl'))
+
+# Logging, see mwlocal/logs.py. LOG_LEVEL DEBUG includes what happens to each file, LOG_FORMAT "json" writes JSON lines
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# For everything that isn't the API's own code, e.g. numba logs its compiler at DEBUG
+LIBRARY_LOG_LEVEL = os.environ.get('LIBRARY_LOG_LEVEL', 'WARNING').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'background': {
+            'class': 'mwlocal.logs.BackgroundHandler',
+            'format': LOG_FORMAT,
+        },
+    },
+    'loggers': {
+        package: { 'level': LOG_LEVEL } for package in ['corr', 'fc', 'other', 'sheets', 'mwlocal']
+    },
+    'root': {
+        'handlers': ['background'],
+        'level': LIBRARY_LOG_LEVEL,
+    },
+}
+
+# Threads final checks read file headers on, see other/metadata_scan.py. Mostly waiting on the NAS, so it's well above the core count
+FINAL_CHECK_SCAN_THREADS = int(os.environ.get('FINAL_CHECK_SCAN_THREADS', 32))
+
+# SQLite cache of the DPI, length etc. final checks read from media files, see mwlocal/media_metadata.py. Set to an empty string to turn it off
+MEDIA_METADATA_CACHE = os.environ.get('MEDIA_METADATA_CACHE', str(BASE_DIR / 'cache' / 'media_metadata.sqlite3'))
+
+# Groups check_all_photo_rows final checks at once, each reading its files on FINAL_CHECK_SCAN_THREADS threads
+FINAL_CHECK_GROUP_THREADS = int(os.environ.get('FINAL_CHECK_GROUP_THREADS', 4))
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mwlocal.settings')
 
 application = get_wsgi_application()
+
+# Warm up the correction workers now rather than on the first correction request
+from corr.worker_pool import get_worker_pool
+get_worker_pool().start()
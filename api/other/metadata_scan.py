@@ -0,0 +1,91 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import logging
+from typing import Callable, List, Optional, TypeVar
+
+from mwlocal.helpers import get_setting
+from mwlocal.media_metadata import CacheStats, MediaMetadata, MetadataCache, get_metadata_cache
+
+"""
+    - manual_final_check reads a little from every file in a client's folder: the DPI of each image and the length
+    of each audio and video file. Archives live on a NAS, where each read is mostly waiting on the network, so the
+    reads are spread over many threads. Threads, not processes, since there's next to no work to do between reads.
+    - Metadata is read through the cache in mwlocal.media_metadata, so only files that changed since they were last
+    checked are read, and only their headers. Each file's stat, and the read of each that changed, runs on the pool.
+    - Results come back in the order the files were given, so anything adding them up gets the same answer as
+    reading them one by one.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Enough to keep a NAS busy. Each thread spends almost all of its time waiting on a read.
+DEFAULT_SCAN_THREADS = 32
+
+T = TypeVar("T")
+
+
+def get_whole_dpi(metadata : MediaMetadata) -> Optional[int]:
+    """The x-resolution an image was saved with, or None if it has none or can't be read."""
+    try:
+        return int(metadata.dpi) if metadata.dpi is not None else None
+    except (ValueError, OverflowError):
+        return None
+
+
+@dataclass
+class MetadataScanner:
+    """
+    Reads file metadata and walks folders on bounded thread pools. Use it with `with`, which shuts the pools down.
+    With threads set to 1 nothing is run on another thread.
+    """
+    threads : int = None
+    # Defaults to the server's
+    cache : MetadataCache = None
+    # Hits and misses of this scanner's lookups
+    cache_stats : CacheStats = field(default_factory=CacheStats)
+    # Files and folders get separate pools, since each folder waits on its files' reads
+    file_executor : Optional[Executor] = field(default=None, init=False, repr=False)
+    folder_executor : Optional[Executor] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.threads is None:
+            self.threads = get_setting("FINAL_CHECK_SCAN_THREADS", DEFAULT_SCAN_THREADS)
+        self.threads = max(1, self.threads)
+        if self.cache is None:
+            self.cache = get_metadata_cache()
+
+    def __enter__(self) -> "MetadataScanner":
+        if self.threads > 1:
+            self.file_executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="scan-files")
+            self.folder_executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="scan-folders")
+        return self
+
+    def __exit__(self, *exc_info):
+        for executor in (self.file_executor, self.folder_executor):
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        self.file_executor = self.folder_executor = None
+        if self.cache_stats.hits or self.cache_stats.misses:
+            logger.info("Read the metadata of %d files, %d of them from the cache", self.cache_stats.hits + self.cache_stats.misses, self.cache_stats.hits)
+
+    def map_files(self, function : Callable[[str], T], file_paths : List[str]) -> List[T]:
+        """function of each file, in the order of file_paths."""
+        if self.file_executor is None:
+            return [function(file_path) for file_path in file_paths]
+        return list(self.file_executor.map(function, file_paths))
+
+    def map_folders(self, function : Callable[..., T], *arg_lists : List[any]) -> List[T]:
+        """function of each folder's arguments, in order. function can use map_files but not map_folders."""
+        if self.folder_executor is None:
+            return list(map(function, *arg_lists))
+        return list(self.folder_executor.map(function, *arg_lists))
+
+    def read_metadata(self, file_paths : List[str]) -> List[MediaMetadata]:
+        return self.cache.get_many(file_paths, self.map_files, self.cache_stats)
+
+    def read_image_dpis(self, file_paths : List[str]) -> List[Optional[int]]:
+        return [get_whole_dpi(metadata) for metadata in self.read_metadata(file_paths)]
+
+    def read_media_lengths(self, file_paths : List[str]) -> List[Optional[float]]:
+        """Each file's length in seconds, or None if it can't be read."""
+        return [metadata.duration for metadata in self.read_metadata(file_paths)]
@@ -1,3 +1,108 @@
-from django.test import TestCase
+import errno
+import os
+import tempfile
+from unittest import mock
+from django.test import SimpleTestCase
+from PIL import Image
 
-# Create your tests here.
+from mwlocal import media_metadata
+from mwlocal.media_metadata import CacheStats, MediaMetadata, MetadataCache
+from other.metadata_scan import MetadataScanner
+
+
+def write_test_jpeg(path, dpi = None):
+    image = Image.new("RGB", (40, 30), (120, 90, 60))
+    if dpi is None:
+        image.save(path, "JPEG")
+    else:
+        image.save(path, "JPEG", dpi = (dpi, dpi))
+
+
+class MetadataCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.folder = directory.name
+        self.cache = MetadataCache(os.path.join(self.folder, "cache", "media_metadata.sqlite3"))
+
+    def get(self, file_paths):
+        stats = CacheStats()
+        return self.cache.get_many(file_paths, stats = stats), stats
+
+    def test_dpi_is_cached(self):
+        path = os.path.join(self.folder, "scan.jpg")
+        write_test_jpeg(path, dpi = 600)
+
+        first, first_stats = self.get([path])
+        second, second_stats = self.get([path])
+
+        self.assertEqual(first[0].dpi, 600)
+        self.assertEqual(second, first)
+        self.assertEqual((first_stats.hits, first_stats.misses), (0, 1))
+        self.assertEqual((second_stats.hits, second_stats.misses), (1, 0))
+
+    def test_parsed_image_without_dpi_is_cached(self):
+        path = os.path.join(self.folder, "scan.jpg")
+        write_test_jpeg(path)
+
+        self.get([path])
+        with mock.patch.object(media_metadata, "read_media_metadata") as read:
+            metadata, stats = self.get([path])
+
+        read.assert_not_called()
+        self.assertEqual(metadata[0], MediaMetadata(file_type = "JPEG", width = 40, height = 30))
+        self.assertEqual((stats.hits, stats.misses), (1, 0))
+
+    def test_unrecognised_file_is_cached(self):
+        path = os.path.join(self.folder, "notes.txt")
+        with open(path, "w") as file:
+            file.write("not media")
+
+        first, _ = self.get([path])
+        second, stats = self.get([path])
+
+        self.assertEqual(first[0], MediaMetadata())
+        self.assertTrue(first[0].was_read)
+        self.assertEqual(second, first)
+        self.assertEqual((stats.hits, stats.misses), (1, 0))
+
+    def test_failed_read_is_not_cached(self):
+        path = os.path.join(self.folder, "scan.jpg")
+        write_test_jpeg(path, dpi = 300)
+
+        with mock.patch.object(media_metadata.Image, "open", side_effect = OSError(errno.EIO, "Input/output error")):
+            failed, _ = self.get([path])
+        metadata, stats = self.get([path])
+
+        self.assertFalse(failed[0].was_read)
+        self.assertIsNone(failed[0].dpi)
+        self.assertEqual(metadata[0].dpi, 300)
+        self.assertEqual((stats.hits, stats.misses), (0, 1))
+        # Read successfully this time, so now it's cached
+        self.assertEqual(self.get([path])[1].hits, 1)
+
+    def test_changed_file_is_read_again(self):
+        path = os.path.join(self.folder, "scan.jpg")
+        write_test_jpeg(path, dpi = 300)
+        self.get([path])
+
+        write_test_jpeg(path, dpi = 600)
+        os.utime(path, ns = (0, os.stat(path).st_mtime_ns + 1_000_000_000))
+        metadata, stats = self.get([path])
+
+        self.assertEqual(metadata[0].dpi, 600)
+        self.assertEqual((stats.hits, stats.misses), (0, 1))
+
+    def test_scanner_reads_through_the_cache(self):
+        paths = [os.path.join(self.folder, f"scan_{i}.jpg") for i in range(5)]
+        for i, path in enumerate(paths):
+            write_test_jpeg(path, dpi = 100 * (i + 1) if i % 2 == 0 else None)
+
+        with self.assertLogs("other.metadata_scan", "INFO"):
+            with MetadataScanner(threads = 4, cache = self.cache) as scanner:
+                first = scanner.read_image_dpis(paths)
+                second = scanner.read_image_dpis(paths)
+
+        self.assertEqual(first, [100, None, 300, None, 500])
+        self.assertEqual(second, first)
+        self.assertEqual((scanner.cache_stats.hits, scanner.cache_stats.misses), (5, 5))
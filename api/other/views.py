@@ -1,14 +1,17 @@
 from django.shortcuts import render
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
+import logging
 import os
 import re
 from pathlib import Path
 import mimetypes
-from PIL import Image
-import mutagen
+from corr.manifest import MANIFEST_FILE_NAME
 from mwlocal.helpers import make_message
 from mwlocal.path_utils import fix_path
+from other.metadata_scan import MetadataScanner
+
+logger = logging.getLogger(__name__)
 
 # File extensions to process
 IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.tif', '.tiff']
@@ -46,7 +49,14 @@ def find_client_name_in_path(path):
     return None, None
 
 
-def process_directory(dir_path, base_folder_path, problematic_files, is_subfolder=True, recursive=True):
+def make_problematic_files():
+    return {
+        "incorrect name": [],
+        "unrecognized file type": []
+    }
+
+
+def process_directory(dir_path, base_folder_path, problematic_files, is_subfolder=True, recursive=True, scanner=None):
     """
     Process a directory and its files, categorizing them by type.
     
@@ -56,6 +66,7 @@ def process_directory(dir_path, base_folder_path, problematic_files, is_subfolde
         problematic_files: Dictionary to collect problematic files
         is_subfolder: Whether this is a subfolder (for naming convention checks)
         recursive: Whether to process files recursively (including subdirectories)
+        scanner: MetadataScanner to read the files' metadata with, or None to read them one by one
         
     Returns:
         Dictionary with folder data
@@ -73,12 +84,14 @@ def process_directory(dir_path, base_folder_path, problematic_files, is_subfolde
         # Get all files recursively
         for root, _, files in os.walk(dir_path):
             for file in files:
+                if file == MANIFEST_FILE_NAME:
+                    continue
                 file_path = os.path.join(root, file)
                 all_files.append(file_path)
     else:
         # Get only files directly in the directory (non-recursive)
         for item in os.scandir(dir_path):
-            if item.is_file():
+            if item.is_file() and item.name != MANIFEST_FILE_NAME:
                 all_files.append(item.path)
     
     # Process files by type
@@ -88,9 +101,7 @@ def process_directory(dir_path, base_folder_path, problematic_files, is_subfolde
     other_files = []
     
     for file_path in all_files:
-        # Print the absolute path of the file
-        abs_path = os.path.abspath(file_path)
-        print(f"Processing file: {abs_path}")
+        logger.debug("Processing file: %s", os.path.abspath(file_path))
         
         file_name = os.path.basename(file_path)
         _, file_ext = os.path.splitext(file_name)
@@ -102,39 +113,78 @@ def process_directory(dir_path, base_folder_path, problematic_files, is_subfolde
             if not file_name.startswith(expected_prefix):
                 rel_path = os.path.relpath(file_path, base_folder_path)
                 problematic_files["incorrect name"].append(rel_path)
-                print(f"  - Incorrect name: {file_name} (expected prefix: {expected_prefix})")
+                logger.debug("Incorrect name: %s (expected prefix: %s)", file_name, expected_prefix)
         
         # Categorize by file type
         if file_ext in IMAGE_EXTENSIONS:
             image_files.append(file_path)
-            print(f"  - Categorized as image: {file_ext}")
+            logger.debug("Categorized %s as image", file_name)
         elif file_ext in AUDIO_EXTENSIONS:
             audio_files.append(file_path)
-            print(f"  - Categorized as audio: {file_ext}")
+            logger.debug("Categorized %s as audio", file_name)
         elif file_ext in VIDEO_EXTENSIONS:
             video_files.append(file_path)
-            print(f"  - Categorized as video: {file_ext}")
+            logger.debug("Categorized %s as video", file_name)
         else:
             other_files.append(file_path)
             rel_path = os.path.relpath(file_path, base_folder_path)
             problematic_files["unrecognized file type"].append(rel_path)
-            print(f"  - Unrecognized file type: {file_ext}")
+            logger.debug("Unrecognized file type: %s", file_name)
     
     # Process image files
     if image_files:
-        folder_data["images"] = process_image_files(image_files)
+        folder_data["images"] = process_image_files(image_files, scanner)
     
     # Process audio files
     if audio_files:
-        folder_data["audio"] = process_audio_files(audio_files)
+        folder_data["audio"] = process_audio_files(audio_files, scanner)
     
     # Process video files
     if video_files:
-        folder_data["video"] = process_video_files(video_files)
+        folder_data["video"] = process_video_files(video_files, scanner)
     
     return folder_data
 
 
+def check_folder(folder_path, subdirs, scanner):
+    """
+    Analyzes a folder's own files and everything in each of its subdirectories, the subdirectories in parallel
+    on the scanner's threads. The result is the same as doing them one at a time, in order.
+    
+    Args:
+        folder_path: Path to the folder to analyze
+        subdirs: Paths of its immediate subdirectories
+        scanner: MetadataScanner to run on
+        
+    Returns:
+        The result manual_final_check responds with
+    """
+    def check_directory(dir_path, is_subfolder):
+        # Each directory collects its own problems, so they can be added up in order afterwards
+        folder_problematic_files = make_problematic_files()
+        folder_data = process_directory(dir_path, folder_path, folder_problematic_files, is_subfolder=is_subfolder, recursive=is_subfolder, scanner=scanner)
+        return folder_data, folder_problematic_files
+    
+    # The main folder is processed non-recursively, its subdirectories recursively
+    dir_paths = [folder_path] + subdirs
+    checked = scanner.map_folders(check_directory, dir_paths, [False] + [True] * len(subdirs))
+    
+    result = {}
+    problematic_files = make_problematic_files()
+    for dir_path, (folder_data, folder_problematic_files) in zip(dir_paths, checked):
+        for problem, rel_paths in folder_problematic_files.items():
+            problematic_files[problem].extend(rel_paths)
+        
+        # Add folder data to result
+        if folder_data:
+            result["Main Folder" if dir_path == folder_path else os.path.basename(dir_path)] = folder_data
+    
+    # Add problematic files to result
+    result["problematic_files"] = problematic_files
+    
+    return result
+
+
 @api_view(['POST'])
 def manual_final_check(request, folder_path):
     """
@@ -149,7 +199,7 @@ def manual_final_check(request, folder_path):
     """
     # Fix path for cross-platform compatibility
     folder_path = fix_path(folder_path)
-    print(f"Using folder path: {folder_path}")
+    logger.debug("Using folder path: %s", folder_path)
     
     # Check if folder exists
     if not os.path.exists(folder_path):
@@ -161,39 +211,24 @@ def manual_final_check(request, folder_path):
     except Exception as e:
         return Response(data=make_message(f"Error accessing folder: {str(e)}"), status=500)
     
-    result = {}
-    problematic_files = {
-        "incorrect name": [],
-        "unrecognized file type": []
-    }
-    
-    # Process the main folder (non-recursively)
-    main_folder_data = process_directory(folder_path, folder_path, problematic_files, is_subfolder=False, recursive=False)
-    if main_folder_data:
-        result["Main Folder"] = main_folder_data
-    
-    # Process each immediate subdirectory
-    for subdir in subdirs:
-        folder_name = os.path.basename(subdir)
-        folder_data = process_directory(subdir, folder_path, problematic_files)
-        
-        # Add folder data to result
-        if folder_data:
-            result[folder_name] = folder_data
-    
-    # Add problematic files to result
-    result["problematic_files"] = problematic_files
+    with MetadataScanner() as scanner:
+        result = check_folder(folder_path, subdirs, scanner)
     
     return Response(data=result)
 
 
-def process_image_files(image_files):
+def process_image_files(image_files, scanner=None):
     """Process image files and return statistics."""
     normal_count = 0
     handscans_count = 0
     oversized_handscans_count = 0
     dpi_values = set()
     
+    # Check DPI, reading only each file's header
+    dpis = (scanner or MetadataScanner(threads=1)).read_image_dpis(image_files)
+    # If we can't read a DPI, we'll handle it below
+    dpi_values.update(dpi for dpi in dpis if dpi is not None)
+    
     for file_path in image_files:
         file_name = os.path.basename(file_path)
         
@@ -204,18 +239,6 @@ def process_image_files(image_files):
             handscans_count += 1
         else:
             normal_count += 1
-        
-        # Check DPI
-        try:
-            with Image.open(file_path) as img:
-                if hasattr(img, 'info') and 'dpi' in img.info:
-                    dpi = img.info['dpi']
-                    # Use the x-resolution as the DPI value
-                    if isinstance(dpi, tuple) and len(dpi) > 0:
-                        dpi_values.add(int(dpi[0]))
-        except Exception:
-            # If we can't read the DPI, we'll handle it below
-            pass
     
     # Determine DPI status
     if len(dpi_values) == 1:
@@ -233,25 +256,21 @@ def process_image_files(image_files):
     }
 
 
-def process_audio_files(audio_files):
+def process_audio_files(audio_files, scanner=None):
     """Process audio files and return statistics."""
     file_count = len(audio_files)
     total_length = 0.0
     file_types = set()
     
-    for file_path in audio_files:
+    lengths = (scanner or MetadataScanner(threads=1)).read_media_lengths(audio_files)
+    for file_path, length in zip(audio_files, lengths):
         _, file_ext = os.path.splitext(file_path)
         file_ext = file_ext.lower().lstrip('.')
         file_types.add(file_ext)
         
-        # Get audio length
-        try:
-            audio = mutagen.File(file_path)
-            if audio is not None and hasattr(audio, 'info') and hasattr(audio.info, 'length'):
-                total_length += audio.info.length
-        except Exception:
-            # If we can't read the length, we'll just skip it
-            pass
+        # If we can't read the length, we'll just skip it
+        if length is not None:
+            total_length += length
     
     return {
         "files": file_count,
@@ -260,20 +279,16 @@ def process_audio_files(audio_files):
     }
 
 
-def process_video_files(video_files):
+def process_video_files(video_files, scanner=None):
     """Process video files and return statistics."""
     file_count = len(video_files)
     total_length = 0.0
     
-    for file_path in video_files:
-        # Get video length
-        try:
-            video = mutagen.File(file_path)
-            if video is not None and hasattr(video, 'info') and hasattr(video.info, 'length'):
-                total_length += video.info.length
-        except Exception:
-            # If we can't read the length, we'll just skip it
-            pass
+    # Summed in order, so the total is the same however many threads read them
+    for length in (scanner or MetadataScanner(threads=1)).read_media_lengths(video_files):
+        # If we can't read the length, we'll just skip it
+        if length is not None:
+            total_length += length
     
     return {
         "files": file_count,
@@ -295,7 +310,7 @@ def delete_files(request, folder_path):
     """
     # Fix path for cross-platform compatibility
     folder_path = fix_path(folder_path)
-    print(f"Using folder path: {folder_path}")
+    logger.debug("Using folder path: %s", folder_path)
     
     # Check if folder exists
     if not os.path.exists(folder_path):
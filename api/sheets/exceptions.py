@@ -1,3 +1,5 @@
+from dataclasses import dataclass
+from typing import Dict, List
 from rest_framework.response import Response
 from mwlocal.helpers import CustomException
 
@@ -32,17 +34,80 @@ class FinalCheckError(CustomException):
         return self._make_error_response(self.args[0], 422)
     
 
-class MultiGroupCustomException(CustomException):
-    """Args consist of a CustomException"""
-    group_identifier : str
+@dataclass
+class FinalCheckProblem:
+    """One thing a final check found wrong. file_name is None for problems with the group as a whole."""
+    message : str
+    file_name : str = None
+    field_name : str = None
+    expected : any = None
+    found : any = None
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "message" : self.message,
+            "file" : self.file_name,
+            "field" : self.field_name,
+            "expected" : to_json_value(self.expected),
+            "found" : to_json_value(self.found),
+        }
+
+
+def to_json_value(value : any) -> any:
+    return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+
+
+class FinalCheckErrors(CustomException):
+    """Args consist of a list of every FinalCheckProblem found"""
+    def __str__(self) -> str:
+        problems : List[FinalCheckProblem] = self.args[0]
+        if len(problems) == 1:
+            return problems[0].message
+        return f"{len(problems)} problems: " + "; ".join(problem.message for problem in problems)
 
     def get_response(self) -> Response:
-        return self._make_error_response(f"Error in group {self.group_identifier}: {self.args[0]}", 422)
+        return Response(
+            data = {
+                "message" : str(self),
+                "problems" : [problem.to_dict() for problem in self.args[0]],
+            },
+            status = 422
+        )
 
- 
-class MultiGroupUnknownException(CustomException):
-    """Args consist of a normal unhandled Exception"""
+
+@dataclass
+class GroupCheckResult:
+    """How final checking one group of a multi-group check went. problems is empty if it passed."""
     group_identifier : str
+    problems : List[FinalCheckProblem]
+
+    @property
+    def passed(self) -> bool:
+        return not self.problems
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "group" : self.group_identifier,
+            "passed" : self.passed,
+            "problems" : [problem.to_dict() for problem in self.problems],
+        }
+
+
+class MultiGroupFinalCheckErrors(CustomException):
+    """Args consist of a GroupCheckResult for every group checked, at least one of which failed"""
+    def __str__(self) -> str:
+        results : List[GroupCheckResult] = self.args[0]
+        failed = [result for result in results if not result.passed]
+        return f"{len(failed)} of {len(results)} groups have problems: " + "; ".join(
+            f"{result.group_identifier}: {result.problems[0].message}" + (f" (and {len(result.problems) - 1} more)" if len(result.problems) > 1 else "")
+            for result in failed
+        )
 
     def get_response(self) -> Response:
-        return self._make_error_response({"message" : f"Error in group {self.group_identifier}: {str(self.args[0])}"}, 500)
\ No newline at end of file
+        return Response(
+            data = {
+                "message" : str(self),
+                "groups" : [result.to_dict() for result in self.args[0]],
+            },
+            status = 422
+        )
@@ -13,6 +13,13 @@ from .exceptions import (NoGroupFound, InvalidValue)
 from .base_rows import BaseMediaRow
 
 
+# Photo Trns has a row per group from row 11, in columns A to X
+PHOTO_TABLE_FIRST_ROW = 11
+PHOTO_ROW_LENGTH = 24
+PHOTO_IDENTIFIER_COLUMN = 0
+PHOTO_CORRECTED_COLUMN = 3
+
+
 @dataclass
 class PhotoRow(BaseMediaRow):
     dpi = 0
@@ -53,6 +60,12 @@ class PhotoRow(BaseMediaRow):
         self._init_photo_row_from_sheet(group_row)
 
 
+    def init_from_batch_data(self, name_row : List[str], project_name : str, corrected_row : List[str], group_row : List[str]):
+        """For when everything about the group was already requested, e.g. along with every other group."""
+        self._init_base_project_from_sheet(name_row, project_name)
+        self.init_from_received_data(corrected_row, group_row)
+
+
     def pull_from_sheet(self, spreadsheet_id : str, group_identifier : str):
         """ If sheets row is already known, specify in known_sheets_row to save a request """
         # First, find the row where this request is from
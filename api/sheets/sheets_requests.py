@@ -1,5 +1,6 @@
+from itertools import chain, zip_longest
 import os.path
-from typing import List
+from typing import List, Union
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -12,10 +13,56 @@ from sheets.exceptions import GoogleSheetsError, UnknownException
 
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
 
+"""
+    - Each range in a SheetsRequest comes back as a flat list of its cells, row by row, which suits single rows and
+    columns. A range requested with as_table=True comes back as a SheetTable instead, so a whole table like every
+    group in Photo Trns can be fetched as one range and split into rows locally, rather than one range per row.
+    - With columnar=True Google sends each range column by column. A SheetTable is kept as columns either way, so a
+    columnar table is used as it arrives, and a column like every group's identifier is a list already.
+    Ranges that aren't tables are still flattened in the order they're sent, so in a columnar request they should be
+    single rows or columns.
+    - Google leaves off empty cells at the end of each row (or column), and whole empty ranges. They're read as "".
+"""
+
+
+@dataclass
+class SheetTable:
+    """A range of cells kept as a table, stored as its columns."""
+    columns : List[List[str]]
+    row_count : int
+
+    @staticmethod
+    def from_columns(columns : List[List[str]], width : int = None) -> "SheetTable":
+        table = SheetTable(columns, max((len(column) for column in columns), default=0))
+        table.pad_to_width(width)
+        return table
+
+    @staticmethod
+    def from_rows(rows : List[List[str]], width : int = None) -> "SheetTable":
+        columns = [list(column) for column in zip_longest(*rows, fillvalue="")]
+        table = SheetTable(columns, len(rows))
+        table.pad_to_width(width)
+        return table
+
+    def pad_to_width(self, width : int = None):
+        if width is not None:
+            self.columns += [[] for _ in range(max(width - len(self.columns), 0))]
+
+    def get_column(self, index : int) -> List[str]:
+        column = self.columns[index]
+        return column + [""] * (self.row_count - len(column))
+
+    def get_row(self, index : int) -> List[str]:
+        return [column[index] if index < len(column) else "" for column in self.columns]
+
+    def get_rows(self) -> List[List[str]]:
+        return [self.get_row(index) for index in range(self.row_count)]
+
 
 @dataclass
 class SheetsResponse:
-    values : List[List[str]]
+    # A list of cells for each range requested, or a SheetTable for each requested with as_table
+    values : List[Union[List[str], SheetTable]]
     title : str
     response_code : int = 200
     response_error : str = None
@@ -33,7 +80,9 @@ class RangeRequest:
     tab_name : str
     from_cell : str
     to_cell : str
+    # Cells to pad the range to, or columns for a table
     pad_to_amount : int = None
+    as_table : bool = False
 
     def gen_sheets_range(self):
         return f"'{self.tab_name}'!{self.from_cell}:{self.to_cell}"
@@ -45,6 +94,7 @@ class SheetsRequest:
     spreadsheet_id : str
     ranges : List[RangeRequest]
     get_title : bool = False
+    columnar : bool = False
     service = None
 
     def get_service(self):
@@ -85,19 +135,23 @@ class SheetsRequest:
             # Make the request
             result = self.service.spreadsheets().values().batchGet(
                 spreadsheetId = self.spreadsheet_id,
-                ranges = converted_ranges
+                ranges = converted_ranges,
+                majorDimension = "COLUMNS" if self.columnar else "ROWS"
             ).execute()
             
             # Build up ranges to return
-            ranges : List[str] = []
-            for i, value_range in enumerate(result["valueRanges"]):
-                range = []
-
-                for row in value_range["values"]:
-                    for val in row:
-                        range.append(val)
-
-                pad_to_amount = self.ranges[i].pad_to_amount
+            ranges : List[Union[List[str], SheetTable]] = []
+            for range_request, value_range in zip(self.ranges, result["valueRanges"]):
+                # Google leaves out "values" when the whole range is empty
+                values = value_range.get("values", [])
+                pad_to_amount = range_request.pad_to_amount
+
+                if range_request.as_table:
+                    make_table = SheetTable.from_columns if self.columnar else SheetTable.from_rows
+                    ranges.append(make_table(values, pad_to_amount))
+                    continue
+
+                range = list(chain.from_iterable(values))
                 if pad_to_amount != None:
                     range += [""] * max(pad_to_amount - len(range), 0)
 
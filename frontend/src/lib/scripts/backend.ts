@@ -23,7 +23,8 @@ export function sanitizePartOfURI(endpoint : string) : string {
 }
 
 
-export async function makeBackendCall(endpoint : string, requestMethod : string = "GET", body : any = null) : Promise<void> {
+// Resolves with the response's JSON body, or an empty object if it has none
+export async function makeBackendCall(endpoint : string, requestMethod : string = "GET", body : any = null) : Promise<any> {
     return new Promise(async(resolve, reject) => {
         let backendAddress = `${getBackendAddress()}/${endpoint}`;
 
@@ -42,9 +43,10 @@ export async function makeBackendCall(endpoint : string, requestMethod : string
                 const responseJson = await response.json().catch(() => ({})); // Prevent json parsing errors
                 console.log(responseJson);
                 reject(responseJson["message"] ?? "Unknown backend error!");
+                return;
             }
 
-            resolve();
+            resolve(await response.json().catch(() => ({})));
         } catch (error) {
             if(error instanceof Error) {
                 const humanReadableErrorMessages = new Map<String, string>([